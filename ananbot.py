@@ -32,7 +32,6 @@ from aiogram.enums import ContentType
 from aiogram.filters import Command,CommandObject
 
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.base import StorageKey
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
 
@@ -59,6 +58,7 @@ from datetime import datetime, timezone, timedelta
 from pathlib import Path
 from lz_mysql import MySQLPool
 from lz_pgsql import PGPool
+from watermark.watermark_pool import WatermarkPool
 from shared_config import SharedConfig
 from lexicon_manager import LexiconManager
 SharedConfig.load()
@@ -306,7 +306,7 @@ async def on_set_thumb_photo(message: Message):
 )
 async def handle_x_media_when_waiting(message: Message, state: FSMContext, reply_to: Message):
     """
-    仅在等待态才处理；把 file_unique_id 写到 FSM。
+    仓库人回覆的媒体：唤醒等待中的请求，并把 file_id 写进 file_extension（超时后才到的也照写）。
     """
     # if await state.get_state() != ProductPreviewFSM.waiting_for_x_media.state:
     #     print(f"【Telethon】收到非等待态的私聊媒体，跳过处理。当前状态：{await state.get_state()}", flush=True)
@@ -334,6 +334,10 @@ async def handle_x_media_when_waiting(message: Message, state: FSMContext, reply
     print(f"✅ [X-MEDIA] 收到 {file_type}，file_unique_id={file_unique_id} {file_id}，"
           f"from={message.from_user.id}，reply_to_msg_id={reply_to.message_id}", flush=True)
 
+    # 被回覆的 ask 消息文字就是当初请求的 uid（回来的文件 uid 可能不同）
+    asked_file_unique_id = (reply_to.text or "").strip() or None
+    Media.resolve_x_file(file_unique_id, file_id, asked_file_unique_id)
+
     user_id = int(message.from_user.id) if message.from_user else None
     
     lz_var.bot_username = await get_bot_username()
@@ -347,10 +351,6 @@ async def handle_x_media_when_waiting(message: Message, state: FSMContext, reply
     )
 
 
-    # 把结果写回 FSM
-    await state.update_data({"x_file_unique_id": file_unique_id})
-    await state.update_data({"x_file_id": file_id})
-
 
 
 def build_report_type_keyboard(file_unique_id: str, transaction_id: int) -> InlineKeyboardMarkup:
@@ -2132,33 +2132,9 @@ async def set_preview_thumb(user_id: int, phpto_profile, state: FSMContext, cont
     invalidate_cached_product(content_id)
    
 async def get_media_form_x(state: FSMContext, target_file_unique_id: str):
-    storage = state.storage
-    received_file_id = None
-    x_uid = lz_var.x_man_bot_id         
-    x_chat_id = x_uid                     # 私聊里 chat_id == user_id
-    me = await bot.get_me()
-    key = StorageKey(bot_id=me.id, chat_id=x_chat_id, user_id=x_uid)
-
-
-    await storage.set_state(key, ProductPreviewFSM.waiting_for_x_media.state)
-    await storage.set_data(key, {})  # 清空
-
-    await bot.send_message(chat_id=lz_var.x_man_bot_id, text=f"{target_file_unique_id}")
-    # await callback_query.answer("...已通知其他机器人更新，请稍后自动刷新", show_alert=True)
-    timeout_sec = 12
-    max_loop = int((timeout_sec / 0.9) + 0.9)
-    for _ in range(max_loop):
-        data = await storage.get_data(key)
-        x_file_id = data.get("x_file_id")
-        if x_file_id:
-            received_file_id = x_file_id
-            # 清掉对方上下文的等待态
-            await storage.set_state(key, None)
-            await storage.set_data(key, {})
-            print(f"  ✅ [X-MEDIA] 收到 file_id={received_file_id}", flush=True)
-            break
-
-        await asyncio.sleep(0.9)
+    received_file_id = await Media.fetch_file_by_file_uid_from_x(state, target_file_unique_id, 12)
+    if received_file_id:
+        print(f"  ✅ [X-MEDIA] 收到 file_id={received_file_id}", flush=True)
     return received_file_id
 ############
 #  投稿     
@@ -6509,6 +6485,11 @@ async def main():
         except Exception as e:
             print(f"⚠️ AnanBOTPool._reset_pool 失败（忽略）: {e}", flush=True)
 
+        try:
+            await asyncio.to_thread(WatermarkPool.shutdown)
+        except Exception as e:
+            print(f"⚠️ WatermarkPool.shutdown 失败（忽略）: {e}", flush=True)
+
         for _name, _bot in (("bot", bot), ("publish_bot", publish_bot), ("switchbot", switchbot)):
             try:
                 await _bot.session.close()
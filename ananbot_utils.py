@@ -11,6 +11,7 @@ import asyncio
 import pymysql
 from typing import Optional
 from lz_memory_cache import MemoryCache
+from lz_mysql_pool import MySQLPoolManager
 import lz_var
 from lz_config import AES_KEY
 from utils.aes_crypto import AESCrypto
@@ -18,6 +19,7 @@ from utils.aes_crypto import AESCrypto
 
 class AnanBOTPool(LYBase):
     _pool = None
+    _managed = None  # lz_mysql_pool.ManagedPool：按闲置时间校验连接，不再每次 ping
     _pool_lock = asyncio.Lock()  # 新增：并发安全
     _acq_sem = asyncio.Semaphore(16)      # 新增：总限流（前台+后台）
     _bg_sem  = asyncio.Semaphore(4)       # 新增：后台写入专用限流
@@ -69,9 +71,10 @@ class AnanBOTPool(LYBase):
                     base_delay = float(os.getenv("ANANBOT_DB_INIT_BASE_DELAY", "1.0"))
                     max_delay = float(os.getenv("ANANBOT_DB_INIT_MAX_DELAY", "12.0"))
 
+                    cls._managed = MySQLPoolManager.register("ananbot", **kwargs)
                     for i in range(max_retry):
                         try:
-                            cls._pool = await aiomysql.create_pool(**kwargs)
+                            cls._pool = await cls._managed.open()
                             host = kwargs.get("host", "")
                             port = kwargs.get("port", "")
                             db = kwargs.get("db", "")
@@ -115,9 +118,8 @@ class AnanBOTPool(LYBase):
         async with cls._pool_lock:
             if cls._pool:
                 try:
-                    cls._pool.close()
                     # 防止被外层 wait_for 取消，且限制等待时长
-                    await asyncio.wait_for(asyncio.shield(cls._pool.wait_closed()), timeout=20)
+                    await asyncio.wait_for(asyncio.shield(cls._managed.close()), timeout=20)
                 except Exception as e:
                     print(f"⚠️ wait_closed 异常(忽略): {e}")
                 finally:
@@ -156,38 +158,36 @@ class AnanBOTPool(LYBase):
         # ☆ 关键：统一经由总信号量限流
         async with cls._acq_sem:
             try:
-                conn = await asyncio.wait_for(cls._pool.acquire(), timeout=20)
-                try:
-                    await conn.ping()
-                except Exception:
-                    await cls._reset_pool()
-                    await cls.init_pool()
-                    conn = await asyncio.wait_for(cls._pool.acquire(), timeout=20)
-                    await conn.ping()
+                # 只有闲置过久 / 刚出过错时才 ping，热路径不多一次往返
+                conn = await cls._managed.acquire(timeout=20)
                 cursor = await conn.cursor(aiomysql.DictCursor)
                 return conn, cursor
             except Exception:
                 await cls._reset_pool()
                 await cls.init_pool()
-                conn = await asyncio.wait_for(cls._pool.acquire(), timeout=20)
+                conn = await cls._managed.acquire(timeout=20)
                 cursor = await conn.cursor(aiomysql.DictCursor)
                 return conn, cursor
 
 
     @classmethod
-    async def release(cls, conn, cursor):
+    async def release(cls, conn, cursor, error: bool = False):
         try:
             await cursor.close()
         except Exception as e:
             print(f"⚠️ 关闭 cursor 时失败: {e}")
 
         try:
-            # ✅ 关键防呆：避免重复释放或非法连接释放
-            if hasattr(cls._pool, "_used") and conn in cls._pool._used:
-                cls._pool.release(conn)
+            # ✅ 关键防呆：避免重复释放或非法连接释放（ManagedPool.release 内部检查）
+            if cls._managed is not None:
+                cls._managed.release(conn, error=error)
         except Exception as e:
             print(f"⚠️ 释放连接失败: {e}")
 
+    @classmethod
+    def pool_stats(cls) -> dict:
+        return cls._managed.stats() if cls._managed else {}
+
 
 
     @classmethod
@@ -254,8 +254,8 @@ class AnanBOTPool(LYBase):
             except (pymysql.err.OperationalError, aiomysql.OperationalError, ConnectionResetError) as e:
                 if not cls._is_transient_mysql_error(e) or i == attempts - 1:
                     raise
-                # 连接可能已坏，重置连接池 + 退避后重试
-                await cls._reset_pool()
+                # 连接可能已坏：先标记，接下来取连接都会校验；退避后重试
+                cls._managed.mark_suspect()
                 await asyncio.sleep(delay)
                 delay *= 2
             finally:
@@ -1,6 +1,7 @@
 # group_stats_tracker.py
 
 import re
+import time
 import asyncio
 import random
 from collections import defaultdict
@@ -12,8 +13,9 @@ from telethon.tl.functions.messages import ReportRequest
 from telethon.tl.types import ReportResultAddComment, ReportResultChooseOption, ReportResultReported
 
 from pg_stats_db import PGStatsDB
-import redis.asyncio as redis_async
 from lz_config import VALKEY_URL
+from lz_valkey import ValkeyPool
+from lz_gate_cache import GateCache
 
 class GroupStatsTracker:
 
@@ -39,6 +41,7 @@ class GroupStatsTracker:
 
     _raw_buffer = []
     _raw_max_len = 5000  # 单条截断，避免极端长文本
+    _raw_buffer_limit = 50000  # 写库持续失败时 raw 缓冲的上限（超出丢最旧的）
 
     _valkey = None
 
@@ -52,7 +55,7 @@ class GroupStatsTracker:
         cls.flush_batch_size = flush_batch_size
 
 
-        cls._valkey = redis_async.from_url(VALKEY_URL, decode_responses=True)
+        cls._valkey = ValkeyPool.get_client(VALKEY_URL)
 
        
 
@@ -220,6 +223,9 @@ class GroupStatsTracker:
             async with cls._lock:
                 cls._raw_buffer.append(raw_row)
 
+            # 有效发言 → 推给 bot 进程的准入缓存（每人每天只推一次）
+            await GateCache.push_spoken(user_id, stat_date.isoformat())
+
 
         if need_flush:
             await cls.flush()
@@ -229,6 +235,10 @@ class GroupStatsTracker:
     # ------------------------------
     @classmethod
     async def flush(cls):
+        """
+        取走缓冲区后批量写 PG（COPY + 一次 merge）。
+        任一部分写失败时，把那部分放回缓冲区，下次 flush 重试，不丢数据。
+        """
         async with cls._lock:
             if not cls._buffer and not cls._raw_buffer:
                 return
@@ -238,11 +248,43 @@ class GroupStatsTracker:
             raw_rows = list(cls._raw_buffer)
             cls._raw_buffer.clear()
 
+        t0 = time.perf_counter()
+        failed_items, failed_rows = [], []
+
         if items:
-            await PGStatsDB.upsert_daily_counts(items)
+            try:
+                await PGStatsDB.upsert_daily_counts(items)
+            except Exception as e:
+                print(f"[stats flush error] daily_counts {len(items)} keys: {e}", flush=True)
+                failed_items = items
 
         if raw_rows:
-            await PGStatsDB.upsert_raw_messages(raw_rows)
+            try:
+                await PGStatsDB.upsert_raw_messages(raw_rows)
+            except Exception as e:
+                print(f"[stats flush error] raw_messages {len(raw_rows)} rows: {e}", flush=True)
+                failed_rows = raw_rows
+
+        if failed_items or failed_rows:
+            async with cls._lock:
+                # 计数是累加的：与期间新进来的同 key 合并
+                for key, c in failed_items:
+                    cls._buffer[key] += c
+                if failed_rows:
+                    cls._raw_buffer[:0] = failed_rows
+                    overflow = len(cls._raw_buffer) - cls._raw_buffer_limit
+                    if overflow > 0:
+                        del cls._raw_buffer[:overflow]
+                        print(f"⚠️ [stats] raw 缓冲超过上限，丢弃最旧的 {overflow} 条", flush=True)
+            return
+
+        elapsed = time.perf_counter() - t0
+        total = len(items) + len(raw_rows)
+        print(
+            f"[stats flush] {len(items)} keys + {len(raw_rows)} raw in {elapsed * 1000:.0f} ms"
+            f" ({total / elapsed if elapsed else 0:.0f} rows/s)",
+            flush=True,
+        )
 
 
     @classmethod
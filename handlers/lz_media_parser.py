@@ -49,7 +49,7 @@ router = Router()
 )
 async def handle_x_media_when_waiting(message: Message, state: FSMContext, reply_to: Message):
     """
-    仅在等待态才处理；把 file_unique_id 写到 FSM。
+    仓库人回覆的媒体：唤醒等待中的请求，并把 file_id 写进 file_extension（超时后才到的也照写）。
     """
     # if await state.get_state() != ProductPreviewFSM.waiting_for_x_media.state:
         # return  # 非等待态，跳过
@@ -76,6 +76,11 @@ async def handle_x_media_when_waiting(message: Message, state: FSMContext, reply
     print(f"✅ [01 X-MEDIA] 收到 {file_type}，file_unique_id={file_unique_id} {file_id}，"
           f"from={message.from_user.id}，reply_to_msg_id={reply_to.message_id}", flush=True)
 
+    # 先唤醒在等这个文件的 fetch_file_by_file_uid_from_x（后面的按钮 / 缩略图编辑较慢）
+    # 被回覆的 ask 消息文字就是当初请求的 uid（回来的文件 uid 可能不同）
+    asked_file_unique_id = (reply_to.text or "").strip() or None
+    Media.resolve_x_file(file_unique_id, file_id, asked_file_unique_id)
+
 
 
     # store_data = await state.get_data()
@@ -180,14 +185,6 @@ async def handle_x_media_when_waiting(message: Message, state: FSMContext, reply
     )
 
     print(f"✅ [13 X-MEDIA] 数据库写入完成，result={result}")
-
-
-    # 把结果写回 FSM
-    await MenuBase.set_menu_status(state, {
-        "x_file_unique_id": file_unique_id,
-        "x_file_id": file_id
-    })
-    # await state.update_data({"x_file_unique_id": file_unique_id, "x_file_id": file_id})
     
 
 @router.message(F.photo | F.video | F.document)
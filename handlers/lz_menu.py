@@ -45,8 +45,9 @@ from datetime import datetime, timezone, timedelta
 
 import asyncio
 import os
-from lz_db import db
-from lz_config import AES_KEY, RESULTS_PER_PAGE, KEY_USER_ID, ADMIN_IDS, UPLOADER_BOT_NAME
+from lz_db import db, SEARCH_RANK_VERSION
+from lz_prefetch import PrefetchQueue
+from lz_config import AES_KEY, RESULTS_PER_PAGE, KEY_USER_ID, ADMIN_IDS, UPLOADER_BOT_NAME, CACHE_TTL
 import lz_var
 import random
 
@@ -56,6 +57,7 @@ import random
 
 from lz_mysql import MySQLPool
 from lz_pgsql import PGPool
+from lz_sync_engine import SyncEngine
 # from ananbot_utils import AnanBOTPool 
 
 from utils.unit_converter import UnitConverter
@@ -999,202 +1001,62 @@ async def _build_pagination_action(callback_function:str, search_key_index:str,
 
 
     
-async def _prefetch_sora_media_for_results(state: FSMContext, result: list[dict]):
+def _prefetch_sora_media_for_results(user_id: int | None, result: list) -> int:
     """
-    基于整批 result 做 sora_media 预加载：
-      - 使用 PGPool.cache 记录：
-          1) 每个 content_id 的 sora_media 状态
-          2) 每个 file_unique_id 是否已经发起过 fetch
-      - 整个函数会被 spawn_once 包装在后台执行，不阻塞主流程。
+    把当前页附近的 content_id 交给 PrefetchQueue 在后台预热（商品详情缓存 / 列表行 / 可选的仓库取文件）。
+      - result 可以是 id 列表，也可以是带 "id" / "content_id" 的行 dict
+      - 不阻塞：队列满、用户预算用完都直接丢弃，返回实际排进队列的 id 数
     """
-    # TODO
-    return True
-
-    if state is None or not result:
-        return
-
-    id_to_fuid: dict[int, str] = {}
-    id_to_tfuid: dict[int, str] = {}
-
-
+    ids: list[int] = []
+    for sc in result or []:
+        cid = (sc.get("id") or sc.get("content_id")) if isinstance(sc, dict) else sc
+        try:
+            ids.append(int(cid))
+        except (TypeError, ValueError):
+            continue
+    if not ids:
+        return 0
     try:
-        # 1) 从 result 收集 content_id → file_unique_id 映射
-        id_to_fuid: dict[int, str] = {}
-        for sc in result:
-            cid = sc.get("id") or sc.get("content_id")
-            fuid = sc.get("source_id") or sc.get("file_unique_id")
-            tfuid = sc.get("thumb_file_unique_id")
-
-            if not cid or not fuid:
-                continue
-
-            try:
-                cid_int = int(cid)
-            except (TypeError, ValueError):
-                continue
-
-            if cid_int not in id_to_fuid:
-                id_to_fuid[cid_int] = fuid
-                if tfuid:
-                    id_to_tfuid[cid_int] = tfuid
-
-        if not id_to_fuid:
-            return
-
-        bot_name = getattr(lz_var, "bot_username", "unknown_bot")
-
-        # 2) 找出哪些 content_id 缓存里还没有，需要打 PG
-        to_query: list[int] = []
-        if PGPool.cache:
-            for cid_int in id_to_fuid.keys():
-                cache_key = f"pg:sora_media:{bot_name}:{cid_int}"
-                entry = await PGPool.cache.get(cache_key)
-                if entry is None:
-                    to_query.append(cid_int)
-        else:
-            # 没有 cache 可用，就全部查一次
-            to_query = list(id_to_fuid.keys())
-
-        # 3) 对 to_query 打一次 PG，查询 sora_media
-        if to_query:
-            await PGPool.init_pool()
-            await PGPool.ensure_pool()
-
-            rows = await PGPool.fetch(
-                """
-                SELECT content_id, file_id, thumb_file_id
-                FROM sora_media
-                WHERE source_bot_name = $1
-                  AND content_id = ANY($2::bigint[])
-                """,
-                bot_name,
-                to_query,
-            )
-
-            # 先把查到的写入 cache
-            seen: set[int] = set()
-            for r in rows or []:
-                try:
-                    cid_int = int(r["content_id"])
-                except (TypeError, ValueError):
-                    continue
-
-                fuid = id_to_fuid.get(cid_int)
-                cache_key = f"pg:sora_media:{bot_name}:{cid_int}"
-
-                # 已经有没有关系，后面 set 会覆盖
-                entry = {
-                    "file_id": r.get("file_id"),
-                    "thumb_file_id": r.get("thumb_file_id"),
-                    "file_unique_id": fuid,
-                    "thumb_file_unique_id": id_to_tfuid.get(cid_int),
-                    "requested": False,
-                }
-
-                # 如果这个 fuid 已经被标记发起过 fetch，则同步 requested 状态
-                if fuid and PGPool.cache:
-                    prefetch_key = f"pg:sora_prefetch_fuid:{fuid}"
-                    if await PGPool.cache.get(prefetch_key):
-                        entry["requested"] = True
-
-                if PGPool.cache:
-                    PGPool.cache.set(cache_key, entry, ttl=1800)
-
-                seen.add(cid_int)
-
-            # 对于没任何 sora_media 记录的 content_id，也建一个空 entry，避免下次再查 PG
-            for cid_int in to_query:
-                if cid_int in seen:
-                    continue
-                fuid = id_to_fuid.get(cid_int)
-                cache_key = f"pg:sora_media:{bot_name}:{cid_int}"
-                entry = {
-                    "file_id": None,
-                    "thumb_file_id": None,
-                    "file_unique_id": fuid,
-                    "thumb_file_unique_id": id_to_tfuid.get(cid_int),
-                    "requested": False,
-                }
-                if fuid and PGPool.cache:
-                    prefetch_key = f"pg:sora_prefetch_fuid:{fuid}"
-                    if await PGPool.cache.get(prefetch_key):
-                        entry["requested"] = True
-                if PGPool.cache:
-                    PGPool.cache.set(cache_key, entry, ttl=3600)
-
-        # 4) 从 cache 里找出需要 fetch 的 candidates（最多 RESULTS_PER_PAGE 个）
-        tasks: list[asyncio.Task] = []
-        started = 0
-
-        for cid_int, fuid in id_to_fuid.items():
-            if not fuid:
-                continue
-
-
-
-            cache_key = f"pg:sora_media:{bot_name}:{cid_int}"
-            entry = await PGPool.cache.get(cache_key) if PGPool.cache else None
-
-            if entry is None:
-                # 理论上不会发生（前面已经写入），但保险处理
-                entry = {
-                    "file_id": None,
-                    "thumb_file_id": None,
-                    "file_unique_id": fuid,
-                    "requested": False,
-                }
-
-            # 已经有完整的 file_id + thumb_file_id → 不需要 fetch
-            if entry.get("file_id") and entry.get("thumb_file_id"):
-                # 重新写回，刷新 TTL 即可
-                if PGPool.cache:
-                    PGPool.cache.set(cache_key, entry, ttl=1800)
-                continue
-
-            # 已经发起过 fetch（不论成功与否），避免重复请求
-            prefetch_key = f"pg:sora_prefetch_fuid:{fuid}"
-            already_prefetched = await PGPool.cache.get(prefetch_key) if PGPool.cache else None
-            if already_prefetched or entry.get("requested"):
-                # 刷新一下缓存 TTL
-                if PGPool.cache:
-                    PGPool.cache.set(cache_key, entry, ttl=1800)
-                continue
-
-            # 还没请求过 → 标记并发起 fetch
-            entry["file_unique_id"] = fuid
-            entry["requested"] = True
-            if PGPool.cache:
-                PGPool.cache.set(cache_key, entry, ttl=1800)
-                PGPool.cache.set(prefetch_key, True, ttl=3600)
-
-            async def _one_fetch(fuid: str = fuid):
-                try:
-                    # _thumb_file_unique_id = already_prefetched['thumb_file_unique_id'] 
-                    thumb_fuid = (entry or {}).get("thumb_file_unique_id")
-                    # 暂停 1 秒
-                    await asyncio.sleep(1.0)
-                   
-                    await Media.fetch_file_by_file_uid_from_x(state=None, ask_file_unique_id=fuid, timeout_sec=10.0)
-                    if thumb_fuid:
-                        await Media.fetch_file_by_file_uid_from_x(state=None, ask_file_unique_id=thumb_fuid, timeout_sec=10.0)
-                    # 成功后，真正的 file_id / thumb_file_id 会被写回 sora_media。
-                    # 以后再触发预加载时，PG 查询 + cache 会拿到最新状态。
-                except Exception as e:
-                    print(f"[prefetch] fetch_file_by_file_uid_from_x failed for {fuid}: {e}", flush=True)
-
-            tasks.append(asyncio.create_task(_one_fetch()))
-            started += 1
-
-            if started >= (int(RESULTS_PER_PAGE/2)-1):
-                break
-
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
-
+        return PrefetchQueue.submit_page(user_id or 0, ids)
     except Exception as e:
         print(f"[prefetch] _prefetch_sora_media_for_results error: {e}", flush=True)
+        return 0
+
 
 
+async def _get_search_session_ids(search_from: str, key_id: int, keyword: str | None = None) -> list[int]:
+    """
+    取回搜索会话的有序 content id 列表（db.search_sessions）：
+      - pageid / f / search：关键词搜索（key_id = keyword_id）
+      - fd_pid / fd：我的兑换（key_id = user_id）
+      - ul_pid / ul：我的上传（key_id = user_id）
+    完整查询只在会话建立时跑一次，之后翻页 / 上下一项都按 id 区间切片。
+    """
+    key_id = int(key_id)
+    if search_from in {"pageid", "f", "search"}:
+        if keyword is None:
+            keyword = await db.get_keyword_by_id(key_id)
+        if not keyword:
+            return []
+        return await db.search_sessions.get_ids(
+            "kw", key_id,
+            lambda: db.search_keyword_ids(keyword),
+            version=SEARCH_RANK_VERSION,
+        )
+    if search_from in {"fd_pid", "fd"}:
+        return await db.search_sessions.get_ids(
+            "fd", key_id,
+            lambda: PGPool.search_history_redeem_ids(key_id),
+            ttl=CACHE_TTL,
+        )
+    if search_from in {"ul_pid", "ul"}:
+        return await db.search_sessions.get_ids(
+            "ul", key_id,
+            lambda: PGPool.search_history_upload_ids(key_id),
+            ttl=CACHE_TTL,
+        )
+    return []
+
 
 async def _build_pagination(
     callback_function,
@@ -1204,6 +1066,7 @@ async def _build_pagination(
     search_type: str = "normal"
 ):
     keyword = ""
+    ids: list[int] = []
     if callback_function in {"pageid"}:
         # 用 keyword_id 查回 keyword 文本
         
@@ -1213,68 +1076,51 @@ async def _build_pagination(
         if not keyword:
             return {"ok": False, "message": "⚠️ 无法找到对应关键词"}
             
-        result = await db.search_keyword_page_plain(keyword)
-        if not result:
+        ids = await _get_search_session_ids(callback_function, keyword_id, keyword)
+        if not ids:
             return {"ok": False, "message": "⚠️ 没有找到任何结果"}
     elif callback_function in {"fd_pid"}:
-       
-        spawn_once(
-            f"sync_transactions:{keyword_id}",
-            lambda: sync_transactions(keyword_id)
-        )
-        result = await PGPool.search_history_redeem(keyword_id)
-        if not result:
+        # 常驻同步已覆盖 transaction 时不再逐次追赶
+        if not SyncEngine.covers("transaction"):
+            spawn_once(
+                f"sync_transactions:{keyword_id}",
+                lambda: sync_transactions(keyword_id)
+            )
+        ids = await _get_search_session_ids(callback_function, keyword_id)
+        if not ids:
             return {"ok": False, "message": "⚠️ 同步正在进行中，或是您目前还没有任何兑换纪录"}
     elif callback_function in {"ul_pid"}:
-        
+        # product 不在常驻同步范围内（MySQL 端没有可靠的更新时间列），仍逐次追赶
         spawn_once(
             f"sync_product_by_user:{keyword_id}",
             lambda: sync_product_by_user(keyword_id)
         )
         print(f"Started background sync for user {keyword_id} upload history", flush=True)
-        result = await PGPool.search_history_upload(keyword_id)
-        if not result:
+        ids = await _get_search_session_ids(callback_function, keyword_id)
+        if not ids:
             return {"ok": False, "message": "⚠️ 同步正在进行中，或是您目前还没有任何上传纪录"}            
 
+    # 只 hydrate 当前页的几个 id（前台查询，进行中时后台预加载让路）
+    page_ids = db.search_sessions.slice_page(ids, page, RESULTS_PER_PAGE)
+    async with PrefetchQueue.foreground():
+        sliced = await db.fetch_sora_rows_by_ids(page_ids)
 
-    # === 正常分页 ===# === 背景进行文件的同步 (预加载) ===
-    # 使用「整批 result」而不只是当前页：
-    # 1) 从 result 提取 (content_id, source_id=file_unique_id)
-    # 2) 用 content_id 列表去查 sora_media 里现状
-    #    - 条件：source_bot_name = 当前 bot
-    # 3) 找出下列这些 content_id：
-    #    - 没有 sora_media 记录，或
-    #    - 有记录但 file_id 为空，或
-    #    - 有记录但 thumb_file_id 为空
-    # 4) 从这些候选中，最多挑 RESULTS_PER_PAGE 个，
-    #    用 spawn_once + Media.fetch_file_by_file_uid_from_x(state, file_unique_id, 10)
-    #    并用 file_unique_id 做 key 标记，避免重复请求
-        # === 背景进行文件的同步（预加载） ===
-    # 把整块预加载逻辑丢到 spawn_once，让主线程只负责分页与渲染，不被 PG / X 仓库拖慢。
-    print(f"Prefetch sora_media for pagination: {callback_function}, {keyword_id}", flush=True)
-    
-    pre_load = False # 是否开启预加载
-    if state is not None and result and pre_load:
-        print(f"Starting prefetch task...", flush=True)
-        # 用 callback_function + keyword_id 当 key，避免同一批结果被重复开启预加载任务
-        key = f"prefetch_sora_media:{callback_function}:{keyword_id}"
-        # 注意要把 result 拷贝成 list，避免外面后续修改它
-        snapshot = list(result)
-        spawn_once(
-            key,
-            lambda state=state, snapshot=snapshot: _prefetch_sora_media_for_results(state, snapshot),
-        )
+    # === 背景预加载 ===
+    # 当前页（用户接下来多半会点开其中一项）+ 下一页，交给有界队列慢慢热缓存；
+    # 队列满 / 用户预算用完就直接丢弃，不影响本次分页
+    # 没有 state 就不知道是谁在翻页，没法算用户预算，直接不预加载
+    if sliced and state is not None:
+        next_ids = db.search_sessions.slice_page(ids, page + 1, RESULTS_PER_PAGE)
+        _prefetch_sora_media_for_results(state.key.user_id, list(page_ids) + list(next_ids))
 
     # === 正常分页 ===
 
 
-    start = page * RESULTS_PER_PAGE
-    end = start + RESULTS_PER_PAGE
-    sliced = result[start:end]
-    has_next = end < len(result)
+    end = (page + 1) * RESULTS_PER_PAGE
+    has_next = end < len(ids)
     has_prev = page > 0
     
-    text = await render_results(sliced, keyword_id, page, total=len(result), per_page=RESULTS_PER_PAGE, callback_function=callback_function)
+    text = await render_results(sliced, keyword_id, page, total=len(ids), per_page=RESULTS_PER_PAGE, callback_function=callback_function)
 
     reply_markup=build_pagination_keyboard(keyword_id, page, has_next, has_prev, callback_function, search_type)
 
@@ -1874,23 +1720,13 @@ async def _build_product_info(content_id :int , search_key_index: str, state: FS
     # print(f"current_pos1={current_pos}")
     if int(search_key_index)>0:
         
-        if stag == "f":
-        # 尝试从搜索结果中定位当前位置
-            
-            keyword = await db.get_keyword_by_id(int(search_key_index))
-            if keyword:
-                print(f"🔍 取得搜索结果以定位当前位置: {keyword}", flush=True)
-                search_result = await db.search_keyword_page_plain(keyword)
+        if stag in ("f", "fd", "ul"):
+            # 关键词搜索 / 我的兑换 / 我的上传：用搜索会话的有序 id 列表定位当前位置
+            search_result = await _get_search_session_ids(stag, int(search_key_index))
         elif stag == "cm" or stag == 'cf':  
             search_result = await PGPool.get_clt_files_by_clt_id(search_key_index)
-        elif stag == 'fd':
-            # 我的兑换   
-            search_result = await PGPool.search_history_redeem(search_key_index)
         elif stag == 'pr':
             search_result = await PGPool.get_product_list()
-        elif stag == 'ul':   
-            search_result = await PGPool.search_history_upload(search_key_index)
-            
         else:
             stag = "f"
     
@@ -1898,7 +1734,11 @@ async def _build_product_info(content_id :int , search_key_index: str, state: FS
             
         if search_result and current_pos<=0:
             try:
-                current_pos = get_index_by_source_id(search_result, source_id) 
+                if stag in ("f", "fd", "ul"):
+                    cid = int(content_id)
+                    current_pos = search_result.index(cid) if cid in search_result else -1
+                else:
+                    current_pos = get_index_by_source_id(search_result, source_id) 
                 # print(f"搜索结果总数: {len(search_result)}", flush=True)
             except Exception as e:
                 print(f"❌ 取得索引失败：{e}", flush=True)
@@ -4412,8 +4252,8 @@ async def handle_sora_page(callback: CallbackQuery, state: FSMContext):
                 await callback.answer("⚠️ 无法找到对应关键词", show_alert=True)
                 return
 
-            # 拉取搜索结果 (用 MemoryCache 非常快)
-            result = await db.search_keyword_page_plain(keyword)
+            # 搜索会话的有序 id 列表（不再整批拉取结果行）
+            result = await _get_search_session_ids(search_from, search_key_index, keyword)
             if not result:
                 await callback.answer("⚠️ 搜索结果为空", show_alert=True)
                 return
@@ -4426,14 +4266,12 @@ async def handle_sora_page(callback: CallbackQuery, state: FSMContext):
                 await callback.answer("⚠️ 资源橱窗为空", show_alert=True)
                 return
         elif search_from == "fd":
-            # print(f"🔍 搜索资源橱窗 ID {search_key_index} 的内容")
-            result = await PGPool.search_history_redeem(search_key_index)
+            result = await _get_search_session_ids(search_from, search_key_index)
             if not result:
                 await callback.answer("⚠️ 兑换纪录为空", show_alert=True)
                 return    
         elif search_from == "ul":
-            # print(f"🔍 搜索资源橱窗 ID {search_key_index} 的内容")
-            result = await PGPool.search_history_upload(search_key_index)
+            result = await _get_search_session_ids(search_from, search_key_index)
             if not result:
                 await callback.answer("⚠️ 上传纪录为空", show_alert=True)
                 return   
@@ -4444,30 +4282,21 @@ async def handle_sora_page(callback: CallbackQuery, state: FSMContext):
                 return
 
 
-        print(f"Prefetch sora_media for pagination: {search_from}", flush=True)
-        
-        preload = False #是否预加载
-        if state is not None and result and preload:
-            print(f"Starting prefetch task...", flush=True)
-            # 用 callback_function + keyword_id 当 key，避免同一批结果被重复开启预加载任务
-            key = f"prefetch_sora_media:{search_from}"
-            # 注意要把 result 拷贝成 list，避免外面后续修改它
-            snapshot = list(result)
-            spawn_once(
-                key,
-                lambda state=state, snapshot=snapshot: _prefetch_sora_media_for_results(state, snapshot),
-            )
-
         # 计算新的 pos
         new_pos = current_pos + offset
         if new_pos < 0 or new_pos >= len(result):
             await callback.answer("⚠️ 没有上一项 / 下一项", show_alert=True)
             return
 
-        # 取对应 content_id
+        # 取对应 content_id（搜索会话是 id 列表，其余来源是行 dict）
         next_record = result[new_pos]
         # print(f"next_record={next_record}")
-        next_content_id = next_record["id"]
+        next_content_id = next_record["id"] if isinstance(next_record, dict) else int(next_record)
+
+        # 顺着翻页方向预热后面几项的商品详情
+        step = 1 if offset >= 0 else -1
+        ahead = [result[i] for i in range(new_pos + step, new_pos + step * RESULTS_PER_PAGE, step) if 0 <= i < len(result)]
+        _prefetch_sora_media_for_results(callback.from_user.id, ahead)
         # print(f"➡️ 翻页请求: current_pos={current_pos}, offset={offset}, new_pos={new_pos}, next_content_id={next_content_id}")
 
     
@@ -5460,7 +5289,7 @@ async def load_sora_content_by_id(content_id: int, state: FSMContext, search_key
             try:
                 
                 album_list_results = await db.get_album_list(content_id, lz_var.bot_username)
-                if(album_list_results == []):
+                if(album_list_results == [] and not SyncEngine.covers("album_items")):
                     await sync_album_items(content_id)
                     album_list_results = await db.get_album_list(content_id, lz_var.bot_username)
                 
@@ -5671,19 +5500,30 @@ async def handle_copy_pg(message: Message, state: FSMContext):
             if stage == "init":
                 text = "🚀 /copy_pg 已启动，正在准备同步..."
             elif stage == "fetched":
-                total = int(progress.get("total") or 0)
-                text = f"📦 已从 PostgreSQL 读取 {total} 笔，开始写入 MySQL..."
+                total = progress.get("total")
+                if total is None:
+                    text = "📦 开始从 PostgreSQL 边读边写入 MySQL..."
+                else:
+                    text = f"📦 PostgreSQL 共 {int(total)} 笔待同步，开始分批写入 MySQL..."
             elif stage == "running":
                 processed = int(progress.get("processed") or 0)
-                total = int(progress.get("total") or 0)
                 batch_no = int(progress.get("batch_no") or 0)
-                total_batches = int(progress.get("total_batches") or 0)
-                percent = float(progress.get("percent") or 0.0)
-                text = (
-                    f"⏳ /copy_pg 进行中\n"
-                    f"进度: {processed}/{total} ({percent:.2f}%)\n"
-                    f"批次: {batch_no}/{total_batches}"
-                )
+                if progress.get("total") is None:
+                    # 未先 COUNT：只报已写入的行数
+                    text = (
+                        f"⏳ /copy_pg 进行中\n"
+                        f"已写入: {processed} 笔\n"
+                        f"批次: {batch_no}"
+                    )
+                else:
+                    total = int(progress.get("total") or 0)
+                    total_batches = int(progress.get("total_batches") or 0)
+                    percent = float(progress.get("percent") or 0.0)
+                    text = (
+                        f"⏳ /copy_pg 进行中\n"
+                        f"进度: {processed}/{total} ({percent:.2f}%)\n"
+                        f"批次: {batch_no}/{total_batches}"
+                    )
             elif stage == "done":
                 summary_data = progress.get("summary") or {}
                 text = f"✅ /copy_pg 完成\n{json.dumps(summary_data, ensure_ascii=False)}"
@@ -52,6 +52,9 @@ from ly_config import (
     KEY_USER_PHONE,
     SWITCHBOT_USERNAME,
     THUMB_DISPATCH_INTERVAL,
+    THUMB_BOT_CONCURRENCY,
+    THUMB_SWEEP_INTERVAL,
+    THUMB_TASK_TIMEOUT,
     THUMB_BOTS,
     THUMB_PREFIX,
     DEBUG_HB_GROUP_ID,
@@ -486,6 +489,8 @@ async def handle_private_json(event):
                     photo_obj=msg.photo,
                     recv_message_id=int(msg.id),
                 )
+                if ok:
+                    wake_thumbnail_dispatcher()  # 窗口空出来了，立即补派
 
                 # ===== [NEW] 解析 reply 的那条“派工视频消息”的 file_unique_id =====
                 fu = None
@@ -873,20 +878,6 @@ async def insert_thumbnail_task_if_absent(file_unique_id: str, msg) -> bool:
     )
 
 
-async def pick_available_bot_from_tasks() -> str | None:
-    """
-    不建 thumbnail_bot_status：只靠 thumbnail_task 推断 bot 是否 working
-    """
-    if not THUMB_BOTS:
-        return None
-
-    working = await PGStatsDB.get_working_counts(THUMB_BOTS)
-    for b in THUMB_BOTS:
-        if working.get(b, 0) == 0:
-            return b
-    return None
-
-
 async def lock_one_pending_task_for_bot(bot_name: str) -> dict | None:
     return await PGStatsDB.lock_one_pending_task_for_bot(bot_name)
 
@@ -916,91 +907,140 @@ async def complete_task_by_reply(bot_name: str, chat_id: int, reply_to_msg_id: i
     )
 
 
-async def thumbnail_dispatch_loop():
-    if not THUMB_BOTS:
-        print("ℹ️ THUMB_BOTS 未配置，thumbnail_dispatch_loop 不启动。", flush=True)
-        return
+# 派工唤醒：新任务 NOTIFY / bot 回传完成 / 超时清扫释放了窗口
+_thumb_wakeup = asyncio.Event()
+# bot_name -> InputPeer，避免每次派工都 get_entity
+_thumb_entities: dict[str, Any] = {}
 
-    while True:
-        try:
 
-            # ly.py 的 thumbnail_dispatch_loop() while True: try: 里面，最前面加
-            timeout_n = await PGStatsDB.mark_working_tasks_failed(older_than_seconds=3600)
-            if timeout_n:
-                print(f"⏱️ thumbnail_task timeout sweep: {timeout_n} rows -> failed", flush=True)
-
-            bot_name = await pick_available_bot_from_tasks()
-            if not bot_name:
-                await asyncio.sleep(THUMB_DISPATCH_INTERVAL)
-                continue
-
-            task = await lock_one_pending_task_for_bot(bot_name)
-            if not task:
-                await asyncio.sleep(THUMB_DISPATCH_INTERVAL)
-                continue
+def wake_thumbnail_dispatcher(*_args) -> None:
+    _thumb_wakeup.set()
 
-            fu = task["file_unique_id"]
 
-            # ===== 从 PostgreSQL 取出原视频的引用三件套 =====
-            doc_id = int(task["doc_id"])
-            access_hash = int(task["access_hash"])
-
-            file_ref = task.get("file_reference")
-            if file_ref is None:
-                raise RuntimeError(f"thumbnail_task.file_reference is NULL, file_unique_id={fu}")
-
-            # asyncpg 可能返回 memoryview，必须转 bytes
-            if isinstance(file_ref, memoryview):
-                file_ref = file_ref.tobytes()
-            elif not isinstance(file_ref, (bytes, bytearray)):
-                file_ref = bytes(file_ref)
-
-            input_doc = InputDocument(id=doc_id, access_hash=access_hash, file_reference=file_ref)
-
-            # 建议 caption 带上 file_unique_id，便于 bot 端识别
-            # 也能让你肉眼排查更方便
-            caption = f"{THUMB_PREFIX}{fu}"
-
-            entity = await client.get_entity(bot_name)
+async def _get_thumb_bot_entity(bot_name: str):
+    entity = _thumb_entities.get(bot_name)
+    if entity is None:
+        entity = await client.get_input_entity(bot_name)
+        _thumb_entities[bot_name] = entity
+    return entity
 
 
+async def _send_thumbnail_task(bot_name: str, task: dict) -> bool:
+    """把已锁定（working）的任务原视频发给 bot；失败则标记 failed。"""
+    task_id = int(task["id"])
+    fu = task["file_unique_id"]
 
+    try:
+        # ===== 从 PostgreSQL 取出原视频的引用三件套 =====
+        doc_id = int(task["doc_id"])
+        access_hash = int(task["access_hash"])
+
+        file_ref = task.get("file_reference")
+        if file_ref is None:
+            raise RuntimeError(f"thumbnail_task.file_reference is NULL, file_unique_id={fu}")
+
+        # asyncpg 可能返回 memoryview，必须转 bytes
+        if isinstance(file_ref, memoryview):
+            file_ref = file_ref.tobytes()
+        elif not isinstance(file_ref, (bytes, bytearray)):
+            file_ref = bytes(file_ref)
+
+        input_doc = InputDocument(id=doc_id, access_hash=access_hash, file_reference=file_ref)
+
+        # caption 带上 file_unique_id，便于 bot 端识别，也方便肉眼排查
+        caption = f"{THUMB_PREFIX}{fu}"
+
+        entity = await _get_thumb_bot_entity(bot_name)
+        sent = await client.send_file(
+            entity,
+            file=input_doc,
+            caption=caption
+        )
+    except Exception as send_err:
+        _thumb_entities.pop(bot_name, None)
+        await PGStatsDB.mark_task_failed_by_id(task_id)
+        print(f"❌ thumbnail send_file failed -> mark failed: task_id={task_id} fu={fu} err={send_err}", flush=True)
+        return False
 
+    # send 成功才记录派发消息
+    await update_task_sent_info(fu, int(sent.chat_id), int(sent.id))
+    print(f"📤 thumbnail 派发媒体: fu={fu} -> bot={bot_name} msg_id={sent.id}", flush=True)
+    return True
 
-            # ===== 关键：把“原媒体”直接发给 bot =====
 
-            # ly.py 的 thumbnail_dispatch_loop() 里，拿到 task 后（fu/task_id 等），send_file 改为：
+async def thumbnail_sweep_loop():
+    """working 超时 → failed；独立周期运行，释放出窗口时唤醒派工。"""
+    while True:
+        try:
+            timeout_n = await PGStatsDB.mark_working_tasks_failed(older_than_seconds=THUMB_TASK_TIMEOUT)
+            if timeout_n:
+                print(f"⏱️ thumbnail_task timeout sweep: {timeout_n} rows -> failed", flush=True)
+                wake_thumbnail_dispatcher()
+        except Exception as e:
+            print(f"❌ thumbnail_sweep_loop error: {e}", flush=True)
+        await asyncio.sleep(THUMB_SWEEP_INTERVAL)
 
-            task_id = int(task["id"])
-            fu = task["file_unique_id"]
 
-            try:
-                sent = await client.send_file(
-                    entity,
-                    file=input_doc,
-                    caption=caption
-                )
-            except Exception as send_err:
-                # 1) 标记 failed
-                await PGStatsDB.mark_task_failed_by_id(task_id)
-                print(f"❌ thumbnail send_file failed -> mark failed: task_id={task_id} fu={fu} err={send_err}", flush=True)
-                await asyncio.sleep(THUMB_DISPATCH_INTERVAL)
+async def thumbnail_dispatch_once() -> int:
+    """
+    按 bot 轮流补满窗口（每个 bot 最多 THUMB_BOT_CONCURRENCY 笔 working），
+    直到窗口全满或没有 pending。回传本轮派发数。
+    """
+    working = await PGStatsDB.get_working_counts(THUMB_BOTS)
+    free = {b: THUMB_BOT_CONCURRENCY - working.get(b, 0) for b in THUMB_BOTS}
+    dispatched = 0
+    while any(n > 0 for n in free.values()):
+        for bot_name in THUMB_BOTS:
+            if free[bot_name] <= 0:
                 continue
+            task = await lock_one_pending_task_for_bot(bot_name)
+            if not task:
+                return dispatched
+            free[bot_name] -= 1
+            if await _send_thumbnail_task(bot_name, task):
+                dispatched += 1
+    return dispatched
 
-            # send 成功才记录派发消息
-            await update_task_sent_info(fu, int(sent.chat_id), int(sent.id))
-            print(f"📤 thumbnail 派发媒体: fu={fu} -> bot={bot_name} msg_id={sent.id}", flush=True)
-
-
-        except Exception as e:
-            print(f"❌ thumbnail_dispatch_loop error: {e}", flush=True)
-
-        await asyncio.sleep(THUMB_DISPATCH_INTERVAL)
 
+async def thumbnail_dispatch_loop():
+    """
+    推送式派工：
+    - LISTEN thumbnail_task（ensure_table 建的触发器），新任务入库立即派发
+    - bot 回传完成 / 超时清扫后也会被唤醒补位
+    - 没有任何事件时每 THUMB_DISPATCH_INTERVAL 秒兜底检查一次（NOTIFY 丢失、监听断线）
+    """
+    if not THUMB_BOTS:
+        print("ℹ️ THUMB_BOTS 未配置，thumbnail_dispatch_loop 不启动。", flush=True)
+        return
 
+    asyncio.create_task(thumbnail_sweep_loop())
 
+    listen_conn = None
+    try:
+        while True:
+            _thumb_wakeup.clear()
+            if listen_conn is None or listen_conn.is_closed():
+                try:
+                    if listen_conn is not None:
+                        await PGStatsDB.unlisten_thumbnail_tasks(listen_conn)
+                        listen_conn = None
+                    listen_conn = await PGStatsDB.listen_thumbnail_tasks(wake_thumbnail_dispatcher)
+                except Exception as e:
+                    # 监听建不起来就先靠兜底轮询，下轮再试
+                    print(f"⚠️ thumbnail_task LISTEN 失败: {e}", flush=True)
 
+            try:
+                await thumbnail_dispatch_once()
+            except Exception as e:
+                print(f"❌ thumbnail_dispatch_loop error: {e}", flush=True)
 
+            try:
+                await asyncio.wait_for(_thumb_wakeup.wait(), timeout=THUMB_DISPATCH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        if listen_conn is not None:
+            await PGStatsDB.unlisten_thumbnail_tasks(listen_conn)
 
 
 
@@ -81,7 +81,10 @@ SWITCHBOT_USERNAME = os.getenv("SWITCHBOT_USERNAME", "")
 raw = os.getenv("BOT_INIT", "")
 BOT_INIT = [x.strip() for x in raw.split(",") if x.strip()]
 
-THUMB_DISPATCH_INTERVAL = int(os.getenv("THUMB_DISPATCH_INTERVAL", "90"))  # 秒
+THUMB_DISPATCH_INTERVAL = int(os.getenv("THUMB_DISPATCH_INTERVAL", "90"))  # 秒；有 NOTIFY 后只作兜底轮询
+THUMB_BOT_CONCURRENCY = int(os.getenv("THUMB_BOT_CONCURRENCY", "1"))  # 每个 bot 同时 working 的任务数
+THUMB_SWEEP_INTERVAL = int(os.getenv("THUMB_SWEEP_INTERVAL", "300"))  # 秒；超时任务清扫周期
+THUMB_TASK_TIMEOUT = int(os.getenv("THUMB_TASK_TIMEOUT", "3600"))  # 秒；working 超过即判 failed
 THUMB_BOTS = [x.strip() for x in os.getenv("THUMB_BOTS", "").split(",") if x.strip()]
 THUMB_PREFIX = "|_thumbnail_|"
 DEBUG_HB_GROUP_ID = -1001943193056  # 换成实际群 ID
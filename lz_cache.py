@@ -1,10 +1,35 @@
 # lz_two_level_cache.py
 import asyncio
 import json
-from typing import Any, Optional
+import os
+import time
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
 
-import redis.asyncio as redis_async
+import lz_cache_codec
 from lz_memory_cache import MemoryCache
+from lz_valkey import ValkeyPool
+
+# 负缓存：「确认不存在」的标记（L1 存哨兵对象，L2 存固定字节串，不走 codec）
+_ABSENT = object()
+_ABSENT_RAW = lz_cache_codec.ABSENT_RAW
+NEGATIVE_TTL = 60
+
+# 跨进程锁的释放：只删自己持有的锁（compare-and-delete）
+_UNLOCK_LUA = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# 前缀失效：这些 key 家族写入时登记到 tag 集合，delete_prefix 只删集合成员，不再 SCAN 全库
+TAG_PREFIXES: Tuple[str, ...] = ("user:clt:", "fav:clt:")
+TAG_TTL = int(os.getenv("CACHE_TAG_TTL", "86400"))
+# 跨进程 L1 失效广播（pub/sub），设为 0 关闭
+CACHE_PUBSUB = os.getenv("CACHE_PUBSUB", "1") == "1"
+# get() 从 L2 回填 L1 的 TTL：其他进程写入后，本进程最多读到这么久的旧值
+L1_FILL_TTL = 60
 
 class TwoLevelCache:
     """
@@ -12,16 +37,42 @@ class TwoLevelCache:
     L2: Valkey（异步，但对外不暴露 await；用后台 task 执行）
     """
 
-    def __init__(self, valkey_client, l1: Optional[MemoryCache] = None, namespace: str = "lz"):
+    def __init__(
+        self,
+        valkey_client,
+        l1: Optional[MemoryCache] = None,
+        namespace: str = "lz",
+        tag_prefixes: Iterable[str] = TAG_PREFIXES,
+        pubsub: bool = CACHE_PUBSUB,
+        codec=lz_cache_codec,
+    ):
       
         self.l1 = l1 or MemoryCache(max_items=200)
         self.ns = namespace
+        # single-flight：同一个 key 的回源只跑一个，其余协程等同一个 future
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.tag_prefixes = tuple(tag_prefixes)
 
-        # 关键修正：允许传入 URL(str) 或 redis client
+        # 失效广播：同一 namespace 的所有进程订阅同一个频道；自己发的消息靠 _origin 跳过
+        self._pubsub_enabled = pubsub
+        self._channel = f"{self.ns}:inval"
+        self._origin = uuid.uuid4().hex
+        self._listener: Optional[asyncio.Task] = None
+
+        # 关键修正：允许传入 URL(str) 或 redis client；URL 走进程级共享连接池
         if isinstance(valkey_client, str):
-            self.r = redis_async.from_url(valkey_client, decode_responses=True)
+            self.r = ValkeyPool.get_client(valkey_client)
+            # 值走二进制 client（codec 输出是压缩字节）；锁 / tag / pub/sub 仍用文本 client
+            self.rv = ValkeyPool.get_client(valkey_client, decode_responses=False)
         else:
             self.r = valkey_client
+            kwargs = getattr(getattr(valkey_client, "connection_pool", None), "connection_kwargs", {}) or {}
+            self.rv = valkey_client if not kwargs.get("decode_responses") else None
+
+        # 文本 client 存不了二进制：退回旧的 JSON 文本格式
+        self.codec = codec if self.rv is not None else None
+        if self.rv is None:
+            self.rv = self.r
 
         # 额外：启动时快速验一下
         if not hasattr(self.r, "setex") or not hasattr(self.r, "get"):
@@ -31,21 +82,135 @@ class TwoLevelCache:
     def _k(self, key: str) -> str:
         return f"{self.ns}:{key}"
 
-    async def get(self, key: str):
+    def _enc(self, value: Any):
+        if self.codec is not None:
+            return self.codec.encode(value)
+        return json.dumps(value, ensure_ascii=False, default=str)
+
+    def _dec(self, raw: Any) -> Any:
+        if self.codec is not None:
+            return self.codec.decode(raw)
+        return json.loads(raw) if isinstance(raw, (bytes, str)) else raw
+
+    # ========= tag 集合（前缀失效）=========
+    def _tags_for(self, key: str) -> List[str]:
+        """
+        key 属于 tag_prefixes 中的某个家族时，返回它在家族根之下、按 ':' 切分的各级前缀。
+        例：家族 "user:clt:"，key "user:clt:42:11:0" → ["user:clt:42:", "user:clt:42:11:"]
+        （家族根本身不登记，避免一个集合装下全部用户的 key）
+        """
+        for fam in self.tag_prefixes:
+            if key.startswith(fam):
+                tags = []
+                pos = key.find(":", len(fam))
+                while pos != -1:
+                    tags.append(key[: pos + 1])
+                    pos = key.find(":", pos + 1)
+                return tags
+        return []
+
+    def _tag_covers(self, prefix: str) -> bool:
+        """prefix 是否是会被登记的 tag（家族根之下、以 ':' 结尾）。"""
+        return prefix.endswith(":") and any(
+            prefix.startswith(fam) and len(prefix) > len(fam) for fam in self.tag_prefixes
+        )
+
+    def _tk(self, prefix: str) -> str:
+        return self._k(f"tag:{prefix}")
+
+    def _pipe_setex(self, pipe, key: str, ttl: int, raw: Any, *, fresh_ttl: int = 0):
+        """往 pipeline 里排一个 SET EX（可带新鲜标记），并把 key 登记到所属 tag 集合。"""
+        pipe.set(self._k(key), raw, ex=int(ttl))
+        if fresh_ttl:
+            pipe.set(self._k(f"{key}:fresh"), "1", ex=int(fresh_ttl))
+        for tag in self._tags_for(key):
+            tk = self._tk(tag)
+            pipe.sadd(tk, self._k(key))
+            pipe.expire(tk, max(TAG_TTL, int(ttl)))
+
+    # ========= 失效广播（pub/sub → 各进程 L1）=========
+    def _ensure_listener(self):
+        if not self._pubsub_enabled or self._listener is not None:
+            return
+        if not hasattr(self.r, "pubsub"):
+            self._pubsub_enabled = False
+            return
+        try:
+            self._listener = asyncio.get_running_loop().create_task(self._listen())
+        except RuntimeError:
+            return
+
+    async def _listen(self):
+        delay = 0.5
+        while True:
+            pubsub = self.r.pubsub()
+            try:
+                await pubsub.subscribe(self._channel)
+                delay = 0.5
+                while True:
+                    # 带超时轮询，不依赖连接池的 socket_timeout
+                    msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if msg and msg.get("type") == "message":
+                        self._on_invalidation(msg.get("data"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"TwoLevelCache: invalidation listener error ns={self.ns}, error={e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+            finally:
+                try:
+                    await pubsub.aclose() if hasattr(pubsub, "aclose") else await pubsub.reset()
+                except Exception:
+                    pass
+
+    def _on_invalidation(self, data):
+        try:
+            msg = json.loads(data)
+        except Exception:
+            return
+        if msg.get("o") == self._origin:
+            return
+        if "k" in msg:
+            self.l1.delete(msg["k"])
+        elif "p" in msg:
+            self._evict_l1_prefix(msg["p"])
+
+    def _publish(self, pipe, **payload):
+        if self._pubsub_enabled:
+            pipe.publish(self._channel, json.dumps({"o": self._origin, **payload}, ensure_ascii=False))
+
+    def _evict_l1_prefix(self, prefix: str):
+        try:
+            if hasattr(self.l1, "evict_prefix"):
+                self.l1.evict_prefix(prefix)
+                return
+            store = getattr(self.l1, "_store", None)
+            if store:
+                keys_to_delete = [k for k in list(store.keys()) if str(k).startswith(prefix)]
+                for key in keys_to_delete:
+                    self.l1.delete(key)
+        except Exception as e:
+            print(f"TwoLevelCache: delete_prefix L1 failed for prefix={prefix}, error={e}")
+
+    async def get(self, key: str, fill_l1: bool = True):
+        self._ensure_listener()
         # 1) L1
         v = self.l1.get(key)
+        if v is _ABSENT:
+            return None
         if v is not None:
             return v
 
         # 2) L2：等待结果
         try:
-            raw = await self.r.get(self._k(key))
-            if not raw:
+            raw = await self.rv.get(self._k(key))
+            if not raw or lz_cache_codec.is_absent(raw):
                 return None
-            # 你如果存的是 json，就 decode；若直接存 bytes/str，也可按需调整
-            val = json.loads(raw) if isinstance(raw, (bytes, str)) else raw
-            # 回填到 L1
-            self.l1.set(key, val)
+            val = self._dec(raw)
+            # 回填到 L1（自带独立 L1 的调用方可关闭）
+            if fill_l1:
+                self.l1.set(key, val, ttl=L1_FILL_TTL)
             return val
         except Exception as e:
             print(f"TwoLevelCache: get from L2 failed for key={key}, error={e}")
@@ -65,12 +230,243 @@ class TwoLevelCache:
 
     async def _set_l2(self, key: str, value: Any, ttl: int):
         try:
-            raw = json.dumps(value, ensure_ascii=False, default=str)
-            await self.r.setex(self._k(key), ttl, raw)
+            raw = self._enc(value)
+            if self._tags_for(key):
+                async with self.rv.pipeline(transaction=False) as pipe:
+                    self._pipe_setex(pipe, key, ttl, raw)
+                    await pipe.execute()
+            else:
+                await self.rv.setex(self._k(key), ttl, raw)
         except Exception as e:
             print(f"TwoLevelCache: set L2 failed for key={key}, error={e}")
             return
 
+    async def get_many(self, keys: Iterable[str], fill_l1: bool = True, l1_ttl: int = 60) -> Dict[str, Any]:
+        """
+        批量读取：先查 L1，剩下的 key 用一次 MGET 打 L2。
+        返回 {key: value}，只包含「有答案」的 key：
+          - 命中 → 对应的值
+          - 负缓存命中（set_absent 标记过）→ None
+        不在返回 dict 里的 key 才需要回源查询。
+        """
+        self._ensure_listener()
+        result: Dict[str, Any] = {}
+        pending: List[str] = []
+        for key in dict.fromkeys(keys):  # 去重保序
+            v = self.l1.get(key)
+            if v is _ABSENT:
+                result[key] = None
+            elif v is not None:
+                result[key] = v
+            else:
+                pending.append(key)
+
+        if not pending:
+            return result
+
+        try:
+            raws = await self.rv.mget([self._k(k) for k in pending])
+        except Exception as e:
+            print(f"TwoLevelCache: get_many from L2 failed for {len(pending)} keys, error={e}")
+            return result
+
+        for key, raw in zip(pending, raws):
+            if not raw:
+                continue
+            if lz_cache_codec.is_absent(raw):
+                result[key] = None
+                if fill_l1:
+                    self.l1.set(key, _ABSENT, ttl=min(l1_ttl, NEGATIVE_TTL))
+                continue
+            try:
+                val = self._dec(raw)
+            except Exception as e:
+                print(f"TwoLevelCache: get_many decode failed for key={key}, error={e}")
+                continue
+            result[key] = val
+            if fill_l1:
+                self.l1.set(key, val, ttl=l1_ttl)
+        return result
+
+    def set_many(self, items: Dict[str, Any], ttl: int = 86400, only_l2: bool = True):
+        """批量写入：L2 用一个 pipeline（后台执行，不阻塞）。"""
+        if not items:
+            return
+        if not only_l2:
+            for key, value in items.items():
+                self.l1.set(key, value, ttl=ttl)
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        try:
+            raw_items = {k: self._enc(v) for k, v in items.items()}
+        except Exception as e:
+            print(f"TwoLevelCache: set_many encode failed, error={e}")
+            return
+        loop.create_task(self._set_many_l2(raw_items, ttl))
+
+    def set_absent(self, keys: Iterable[str], ttl: int = NEGATIVE_TTL):
+        """负缓存：标记这些 key「确认不存在」，短 TTL 内重复查询不再回源。"""
+        keys = list(keys)
+        if not keys:
+            return
+        for key in keys:
+            self.l1.set(key, _ABSENT, ttl=ttl)
+
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        loop.create_task(self._set_many_l2({k: _ABSENT_RAW for k in keys}, ttl))
+
+    async def _set_many_l2(self, raw_items: Dict[str, Any], ttl: int):
+        try:
+            async with self.rv.pipeline(transaction=False) as pipe:
+                for key, raw in raw_items.items():
+                    self._pipe_setex(pipe, key, ttl, raw)
+                await pipe.execute()
+        except Exception as e:
+            print(f"TwoLevelCache: set_many L2 failed for {len(raw_items)} keys, error={e}")
+            return
+
+    async def get_or_load(
+        self,
+        key: str,
+        loader: Callable[[], Awaitable[Any]],
+        ttl: int = 86400,
+        *,
+        stale_ttl: int = 0,
+        lock_ttl: float = 10.0,
+        l1_ttl: Optional[int] = None,
+        cache_if: Optional[Callable[[Any], bool]] = None,
+        fill_l1: bool = True,
+    ):
+        """
+        读缓存，未命中时回源（防击穿）：
+        - 进程内 single-flight：同一 key 并发未命中只调用一次 loader，其余等待同一结果
+        - 跨进程：Valkey SET NX 锁，拿不到锁的进程轮询等待持锁方写回，超时才自己回源
+        - stale_ttl > 0 时启用 stale-while-revalidate：
+            值在 L2 保留 ttl + stale_ttl，另存一个 TTL = ttl 的「新鲜」标记；
+            标记过期后先返回旧值，后台单飞刷新，过期不会把并发压到 Postgres
+        - cache_if(value) 为 False 的结果不写缓存（默认只跳过 None）
+        - fill_l1=False：不读写本实例的 L1（调用方自己有独立 L1，例如 SearchSessionStore）
+        """
+        self._ensure_listener()
+        cache_if = cache_if or (lambda v: v is not None)
+        l1_ttl = l1_ttl or ttl
+
+        # 1) L1
+        if fill_l1:
+            v = self.l1.get(key)
+            if v is not None and v is not _ABSENT:
+                return v
+
+        # 2) L2（连同新鲜标记一次 MGET）
+        try:
+            if stale_ttl:
+                raw, fresh = await self.rv.mget([self._k(key), self._k(f"{key}:fresh")])
+            else:
+                raw, fresh = await self.rv.get(self._k(key)), True
+        except Exception as e:
+            print(f"TwoLevelCache: get_or_load L2 failed for key={key}, error={e}")
+            raw, fresh = None, None
+
+        if raw and not lz_cache_codec.is_absent(raw):
+            try:
+                val = self._dec(raw)
+            except Exception as e:
+                print(f"TwoLevelCache: get_or_load decode failed for key={key}, error={e}")
+                val = None
+            if val is not None:
+                if fresh:
+                    if fill_l1:
+                        self.l1.set(key, val, ttl=l1_ttl)
+                elif key not in self._inflight:
+                    # 旧值先顶着，后台刷新（同样走 single-flight）
+                    self._start_load(key, loader, ttl, stale_ttl, lock_ttl, l1_ttl, cache_if, fill_l1)
+                return val
+
+        # 3) 未命中：single-flight 回源
+        fut = self._inflight.get(key)
+        if fut is None:
+            fut = self._start_load(key, loader, ttl, stale_ttl, lock_ttl, l1_ttl, cache_if, fill_l1)
+        return await asyncio.shield(fut)
+
+    def _start_load(self, key, loader, ttl, stale_ttl, lock_ttl, l1_ttl, cache_if, fill_l1=True) -> asyncio.Future:
+        task = asyncio.ensure_future(self._load(key, loader, ttl, stale_ttl, lock_ttl, l1_ttl, cache_if, fill_l1))
+        self._inflight[key] = task
+        task.add_done_callback(lambda t: self._finish_load(key, t))
+        return task
+
+    def _finish_load(self, key: str, task: asyncio.Future):
+        self._inflight.pop(key, None)
+        # 后台刷新（stale-while-revalidate）没人 await，这里取走异常避免 "never retrieved"
+        if not task.cancelled() and task.exception() is not None:
+            print(f"TwoLevelCache: load failed for key={key}, error={task.exception()}")
+
+    async def _load(self, key, loader, ttl, stale_ttl, lock_ttl, l1_ttl, cache_if, fill_l1=True):
+        lock_key = self._k(f"{key}:lock")
+        token = uuid.uuid4().hex
+        try:
+            locked = await self.r.set(lock_key, token, nx=True, px=int(lock_ttl * 1000))
+        except Exception as e:
+            print(f"TwoLevelCache: lock failed for key={key}, error={e}")
+            locked = True  # Valkey 不可用时退化为仅进程内 single-flight
+
+        if not locked:
+            # 其他进程正在回源：等它写回 L2
+            deadline = time.monotonic() + lock_ttl
+            delay = 0.05
+            while time.monotonic() < deadline:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 0.5)
+                try:
+                    if stale_ttl:
+                        raw, fresh = await self.rv.mget([self._k(key), self._k(f"{key}:fresh")])
+                    else:
+                        raw, fresh = await self.rv.get(self._k(key)), True
+                except Exception:
+                    break
+                if raw and not lz_cache_codec.is_absent(raw) and fresh:
+                    try:
+                        val = self._dec(raw)
+                    except Exception:
+                        break
+                    if fill_l1:
+                        self.l1.set(key, val, ttl=l1_ttl)
+                    return val
+
+        try:
+            val = await loader()
+            if cache_if(val):
+                if fill_l1:
+                    self.l1.set(key, val, ttl=l1_ttl)
+                try:
+                    raw = self._enc(val)
+                    async with self.rv.pipeline(transaction=False) as pipe:
+                        self._pipe_setex(pipe, key, ttl + stale_ttl, raw, fresh_ttl=ttl if stale_ttl else 0)
+                        await pipe.execute()
+                except Exception as e:
+                    print(f"TwoLevelCache: get_or_load set L2 failed for key={key}, error={e}")
+            return val
+        finally:
+            if locked:
+                await self._unlock(lock_key, token)
+
+    async def _unlock(self, lock_key: str, token: str):
+        try:
+            await self.r.eval(_UNLOCK_LUA, 1, lock_key, token)
+        except Exception:
+            # 不支持 EVAL 的环境：退化为 GET 比对后 DEL
+            try:
+                # 非 decode_responses 的 client 回的是 bytes
+                if await self.r.get(lock_key) in (token, token.encode()):
+                    await self.r.delete(lock_key)
+            except Exception:
+                pass
+
     def delete(self, key: str):
         # 1) 先删 L1（立即生效）
         try:
@@ -87,32 +483,44 @@ class TwoLevelCache:
 
     async def _del_l2(self, key: str):
         try:
-            # redis/valkey async client: await r.delete(...)
-            await self.r.delete(self._k(key))
+            # 连同新鲜标记一起 UNLINK，并广播给其他进程清 L1
+            async with self.r.pipeline(transaction=False) as pipe:
+                pipe.unlink(self._k(key), self._k(f"{key}:fresh"))
+                self._publish(pipe, k=key)
+                await pipe.execute()
         except Exception as e:
             print(f"TwoLevelCache: delete L2 failed for key={key}, error={e}")
             return
 
     async def delete_prefix(self, prefix: str):
+        """
+        删除以 prefix 开头的所有 key：
+        - L1：本进程直接扫；其他进程经 pub/sub 广播各自清
+        - L2：prefix 是登记过的 tag（tag_prefixes 家族之下、以 ':' 结尾）时，
+          SMEMBERS 取出成员后 UNLINK，耗时只与成员数有关，不扫全库；
+          其他 prefix 没有 tag 可查，只按精确 key 删除
+        """
+        self._ensure_listener()
         # 1) 清 L1 中匹配前缀的 key
-        try:
-            store = getattr(self.l1, "_store", None)
-            if store:
-                keys_to_delete = [k for k in list(store.keys()) if str(k).startswith(prefix)]
-                for key in keys_to_delete:
-                    self.l1.delete(key)
-        except Exception as e:
-            print(f"TwoLevelCache: delete_prefix L1 failed for prefix={prefix}, error={e}")
+        self._evict_l1_prefix(prefix)
 
-        # 2) 清 L2 中匹配前缀的 key
+        # 2) 清 L2：按 tag 集合删除
         try:
-            pattern = self._k(f"{prefix}*")
-            keys_to_delete = []
-            async for key in self.r.scan_iter(match=pattern):
-                keys_to_delete.append(key)
+            members = []
+            if self._tag_covers(prefix):
+                members = list(await self.r.smembers(self._tk(prefix)) or [])
+            else:
+                print(f"TwoLevelCache: prefix={prefix} 未登记 tag，L2 仅精确删除")
 
-            if keys_to_delete:
-                await self.r.delete(*keys_to_delete)
+            keys = {self._k(prefix), self._tk(prefix)}
+            ns_len = len(self._k(""))
+            for m in members:
+                keys.update((m, f"{m}:fresh"))
+                # 成员所在的更深层 tag 一并删除
+                keys.update(self._tk(t) for t in self._tags_for(m[ns_len:]) if t.startswith(prefix))
+            async with self.r.pipeline(transaction=False) as pipe:
+                pipe.unlink(*keys)
+                self._publish(pipe, p=prefix)
+                await pipe.execute()
         except Exception as e:
             print(f"TwoLevelCache: delete_prefix L2 failed for prefix={prefix}, error={e}")
-
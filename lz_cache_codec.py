@@ -0,0 +1,172 @@
+# lz_cache_codec.py
+"""
+TwoLevelCache 的 L2 序列化层。
+
+格式：MAGIC(2) + VERSION(1) + FLAGS(1) + payload
+- FLAGS & ZLIB     : payload 经 zlib 压缩（超过 COMPRESS_MIN 字节才压）
+- FLAGS & COLUMNAR : 同构的 list[dict]（搜索结果 / 相簿 / 商品列表）按列存：
+                     {"c": 列名, "t": 列类型, "v": 每列的值}，列名不再每行重复
+- FLAGS & TAGGED   : 行格式里出现了 datetime / Decimal 等，用 {"$dt": ...} 标记，解码时还原
+MAGIC 首字节 0xA7 不是合法的 UTF-8 起始字节，旧的纯 JSON 值（无头）照常按 json.loads 读取。
+"""
+import base64
+import datetime as _dt
+import json
+import zlib
+from decimal import Decimal
+from typing import Any, Dict, List, Optional, Tuple
+
+MAGIC = b"\xa7Z"
+VERSION = 1
+
+ZLIB = 0x01
+COLUMNAR = 0x02
+TAGGED = 0x04
+
+COMPRESS_MIN = 512
+COMPRESS_LEVEL = 1  # 热路径优先解码速度，压缩率够用
+
+ABSENT_RAW = b"\x00absent"
+
+
+# ========= 单值类型标记 =========
+def _tag_value(v: Any) -> Tuple[str, Any]:
+    """返回 (类型标记, 可 JSON 化的值)；原生 JSON 类型标记为 ""。"""
+    if v is None or isinstance(v, (bool, int, float, str)):
+        return "", v
+    if isinstance(v, _dt.datetime):
+        return "dt", v.isoformat()
+    if isinstance(v, _dt.date):
+        return "d", v.isoformat()
+    if isinstance(v, _dt.time):
+        return "tm", v.isoformat()
+    if isinstance(v, Decimal):
+        return "dec", str(v)
+    if isinstance(v, (bytes, bytearray, memoryview)):
+        return "b", base64.b64encode(bytes(v)).decode("ascii")
+    return "s", str(v)  # 其余类型与旧版 default=str 一致
+
+
+_UNTAG = {
+    "dt": _dt.datetime.fromisoformat,
+    "d": _dt.date.fromisoformat,
+    "tm": _dt.time.fromisoformat,
+    "dec": Decimal,
+    "b": base64.b64decode,
+    "s": str,
+}
+
+
+class _Tagger:
+    """json.dumps 的 default：把特殊类型包成 {"$<tag>": value}，并记录是否用过。"""
+
+    def __init__(self):
+        self.used = False
+
+    def __call__(self, v: Any):
+        tag, out = _tag_value(v)
+        if not tag:
+            return out
+        self.used = True
+        return {"$" + tag: out}
+
+
+def _untag_hook(obj: Dict[str, Any]):
+    if len(obj) == 1:
+        (k, v), = obj.items()
+        if k[:1] == "$":
+            fn = _UNTAG.get(k[1:])
+            if fn is not None:
+                return fn(v)
+    return obj
+
+
+# ========= 列存 =========
+def _to_columnar(rows: List[dict]) -> Optional[dict]:
+    """同构 list[dict] → 列存；每列非空值必须是同一种标记类型，否则返回 None 走行格式。"""
+    first = rows[0]
+    cols = list(first.keys())
+    ncol = len(cols)
+    columns: List[List[Any]] = [[] for _ in cols]
+    types: List[Optional[str]] = [None] * ncol
+    for row in rows:
+        if not isinstance(row, dict) or len(row) != ncol:
+            return None
+        for i, c in enumerate(cols):
+            try:
+                v = row[c]
+            except KeyError:
+                return None
+            if v is None:
+                columns[i].append(None)
+                continue
+            if isinstance(v, (list, dict)):
+                tag, out = "j", v  # 嵌套结构原样交给 json（特殊类型由 _Tagger 处理）
+            else:
+                tag, out = _tag_value(v)
+            if types[i] is None:
+                types[i] = tag
+            elif types[i] != tag:
+                return None
+            columns[i].append(out)
+    return {"c": cols, "t": [t or "" for t in types], "v": columns}
+
+
+def _from_columnar(obj: dict) -> List[dict]:
+    cols, types, columns = obj["c"], obj["t"], obj["v"]
+    for i, t in enumerate(types):
+        fn = _UNTAG.get(t)
+        if fn is not None:
+            columns[i] = [None if v is None else fn(v) for v in columns[i]]
+    return [dict(zip(cols, vals)) for vals in zip(*columns)]
+
+
+# ========= 对外接口 =========
+def encode(value: Any) -> bytes:
+    flags = 0
+    if (
+        isinstance(value, list)
+        and len(value) > 1
+        and isinstance(value[0], dict)
+        and value[0]
+    ):
+        colobj = _to_columnar(value)
+        if colobj is not None:
+            flags |= COLUMNAR
+            value = colobj
+
+    tagger = _Tagger()
+    payload = json.dumps(value, ensure_ascii=False, separators=(",", ":"), default=tagger).encode("utf-8")
+    if tagger.used:
+        flags |= TAGGED
+    if len(payload) >= COMPRESS_MIN:
+        packed = zlib.compress(payload, COMPRESS_LEVEL)
+        if len(packed) < len(payload):
+            payload = packed
+            flags |= ZLIB
+    return MAGIC + bytes((VERSION, flags)) + payload
+
+
+def decode(raw: Any) -> Any:
+    """raw 可以是 bytes（新格式或旧 JSON）或 str（旧 JSON / 文本 client）。"""
+    if isinstance(raw, str):
+        return json.loads(raw)
+    if not raw[:2] == MAGIC:
+        return json.loads(raw)
+    version, flags = raw[2], raw[3]
+    if version != VERSION:
+        raise ValueError(f"unsupported cache codec version {version}")
+    payload = raw[4:]
+    if flags & ZLIB:
+        payload = zlib.decompress(payload)
+    if flags & TAGGED:
+        value = json.loads(payload, object_hook=_untag_hook)
+    else:
+        value = json.loads(payload)
+    if flags & COLUMNAR:
+        value = _from_columnar(value)
+    return value
+
+
+def is_absent(raw: Any) -> bool:
+    return raw == ABSENT_RAW or raw == "\x00absent"
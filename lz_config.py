@@ -31,6 +31,11 @@ if ADMIN_IDS_RAW:
 
 RESULTS_PER_PAGE = 6
 CACHE_TTL = 300  # 緩存時間，單位秒
+SEARCH_SESSION_TTL = int(os.getenv("SEARCH_SESSION_TTL", 600))  # 搜索會話（有序 id 列表）緩存時間，單位秒
+SEARCH_SESSION_MAX_ITEMS = int(os.getenv("SEARCH_SESSION_MAX_ITEMS", 500))  # 進程內最多保留的搜索會話數
+BLACKLIST_REFRESH_INTERVAL = int(os.getenv("BLACKLIST_REFRESH_INTERVAL", 60))  # 黑名單索引增量同步間隔，單位秒
+BLACKLIST_FULL_REFRESH_INTERVAL = int(os.getenv("BLACKLIST_FULL_REFRESH_INTERVAL", 3600))  # 全量校正間隔（解除黑名單只能靠全量發現，與舊的每小時重載一致）
+BLACKLIST_SNAPSHOT_PATH = os.getenv("BLACKLIST_SNAPSHOT_PATH", "blacklist_snapshot.json")  # 黑名單索引快照，重啟時先用它暖機
 
 config = {}
 
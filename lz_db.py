@@ -2,15 +2,16 @@
 import asyncpg
 import asyncio
 import os
-from lz_config import POSTGRES_DSN,CACHE_TTL,VALKEY_URL
+from lz_config import POSTGRES_DSN,CACHE_TTL,VALKEY_URL,SEARCH_SESSION_TTL,SEARCH_SESSION_MAX_ITEMS
 from lz_memory_cache import MemoryCache
 from lz_cache import TwoLevelCache
+from lz_search_session import SearchSessionStore
+from lz_pgsql import ALBUM_CACHE_TTL, album_cache_key, album_list_complete, pool_statement_kwargs, PGStatementStats
 from datetime import datetime
 import lz_var
 import jieba
 from lexicon_manager import LexiconManager
 from handlers.handle_jieba_export import ensure_and_load_lexicon_runtime
-import redis.asyncio as redis_async
 
 # ===================================
 # jieba 字典只加载一次（全局控制）
@@ -49,6 +50,9 @@ ACQUIRE_TIMEOUT = float(os.getenv("POSTGRES_ACQUIRE_TIMEOUT", "10"))
 COMMAND_TIMEOUT = float(os.getenv("POSTGRES_COMMAND_TIMEOUT", "60"))
 CONNECT_TIMEOUT = float(os.getenv("POSTGRES_CONNECT_TIMEOUT", "10"))  # 新增
 
+# 搜索排序版本：调整 _build_keyword_search_sql 的排序逻辑时 +1，旧的搜索会话自然失效
+SEARCH_RANK_VERSION = 1
+
 
 
 
@@ -59,13 +63,19 @@ class DB:
         # self.cache = MemoryCache()
 
         
-        valkey_client = redis_async.from_url(VALKEY_URL, decode_responses=True)
-
+        # 与 PGPool / MySQLPool 共用 ValkeyPool 的连接池
         self.cache = TwoLevelCache(
-            valkey_client=valkey_client,
+            valkey_client=VALKEY_URL,
             namespace="lz"
         )
 
+        # 搜索会话：有序 id 列表，独立 TTL / 容量，L2 与 self.cache 共用 Valkey
+        self.search_sessions = SearchSessionStore(
+            l2=self.cache,
+            ttl=SEARCH_SESSION_TTL,
+            max_sessions=SEARCH_SESSION_MAX_ITEMS,
+        )
+
 
     async def connect(self):
         if self.pool is not None:
@@ -82,7 +92,7 @@ class DB:
                     max_inactive_connection_lifetime=300,
                     command_timeout=COMMAND_TIMEOUT,
                     timeout=CONNECT_TIMEOUT,            # 新增：连接级超时
-                    statement_cache_size=0,          # 稳态优化
+                    **pool_statement_kwargs(self.dsn),  # POSTGRES_STATEMENT_MODE 决定是否缓存预编译语句
                 )
                 # 预热：设置时区/应用名
                 async with self.pool.acquire(timeout=ACQUIRE_TIMEOUT) as conn:
@@ -124,6 +134,9 @@ class DB:
             await conn.execute("SET application_name = 'lz_app'")
         print("✅ PostgreSQL 连接池初始化完成")
 
+    def statement_stats(self, top: int = 20, order_by: str = "total_ms") -> dict:
+        return PGStatementStats.snapshot(top=top, order_by=order_by)
+
     async def disconnect(self):
         """优雅断线，给主程序 shutdown/finally 调用。"""
         pool, self.pool = self.pool, None
@@ -203,19 +216,11 @@ class DB:
 
 
 
-    async def search_keyword_page_plain(self, keyword_str: str, last_id: int = 0, limit: int = 10000):
-        # 1) 归一化 + cache
-        await self._ensure_pool()
-        query = self._normalize_query(keyword_str)
-        cache_key = f"searchkey:{query}"
-        cached = await self.cache.get(cache_key)
-        print(f"Cache key: {cache_key}")
-        if cached:
-            print("Cache hit")
-            return cached
-
-        
-
+    def _build_keyword_search_sql(self, keyword_str: str, last_id: int, limit: int, columns: str) -> tuple[str, list]:
+        """
+        分词 → 停用词 → 同义词 → tsquery，拼出排序后的全文检索 SQL。
+        columns 为 SELECT 的列（rank 会自动附加）；无有效关键词时返回 ("", [])。
+        """
         # 2) 分词
         tokens = list(jieba.cut(keyword_str))
         print("Tokens after jieba cut:", tokens)
@@ -231,7 +236,7 @@ class DB:
         # 5) 生成 tsquery：用 OR 组构成 phrase_q / and_q
         phrase_q, and_q = self._build_tsqueries_from_token_groups(token_groups)
         if not and_q:
-            return []
+            return "", []
 
         # 下面的 limit / where_parts / params / SQL 构造都维持原样，不动
         # 4) 保护 limit
@@ -282,26 +287,92 @@ class DB:
 
         sql = f"""
             SELECT
-                id,
-                source_id,
-                file_type,
-                content,
+                {columns},
                 {rank_expr} AS rank
             FROM sora_content
             WHERE {' AND '.join(where_parts)} AND valid_state != 4
             ORDER BY rank DESC, id DESC
             LIMIT ${limit_idx}
         """
+        return sql, params
 
-        # print("SQL:", sql, "PARAMS:", params, flush=True)
+    async def search_keyword_page_plain(self, keyword_str: str, last_id: int = 0, limit: int = 10000):
+        # 1) 归一化 + cache
+        await self._ensure_pool()
+        query = self._normalize_query(keyword_str)
+        cache_key = f"searchkey:{query}"
+        print(f"Cache key: {cache_key}")
+
+        async def _load():
+            sql, params = self._build_keyword_search_sql(
+                keyword_str, last_id, limit,
+                columns="id, source_id, file_type, content",
+            )
+            if not sql:
+                return []
+
+            # print("SQL:", sql, "PARAMS:", params, flush=True)
+
+            async with self.pool.acquire(timeout=ACQUIRE_TIMEOUT) as conn:
+                rows = await conn.fetch(sql, *params)
+            return [dict(r) for r in rows]
+
+        # 热门关键词过期时：并发未命中只跑一次 ts_rank_cd 查询，过期后先回旧值再后台刷新
+        return await self.cache.get_or_load(cache_key, _load, ttl=CACHE_TTL, stale_ttl=CACHE_TTL)
+
+    async def search_keyword_ids(self, keyword_str: str, limit: int = 3000) -> list[int]:
+        """
+        与 search_keyword_page_plain 同样的排序，但只取 id；
+        供 search_sessions 建立有序 id 列表，翻页时再按需 hydrate。
+        """
+        await self._ensure_pool()
+        sql, params = self._build_keyword_search_sql(keyword_str, 0, limit, columns="id")
+        if not sql:
+            return []
 
         async with self.pool.acquire(timeout=ACQUIRE_TIMEOUT) as conn:
             rows = await conn.fetch(sql, *params)
+        return [int(r["id"]) for r in rows]
 
-        result = [dict(r) for r in rows]
-        # print(f"{result}")
-        self.cache.set(cache_key, result, ttl=CACHE_TTL, only_l2=True)
-        return result
+    async def fetch_sora_rows_by_ids(self, ids: list[int]) -> list[dict]:
+        """
+        按 id 批量取列表渲染所需的字段（id, source_id, file_type, content），
+        返回顺序与传入 ids 一致；查不到的 id 直接略过。
+        先用 cache.get_many 一次往返取缓存，只有未命中的 id 才打 PG；
+        PG 也查不到的 id 记负缓存，避免反复回源。
+        """
+        if not ids:
+            return []
+        ids = [int(i) for i in ids]
+        keys = {i: f"sora_row:{i}" for i in ids}
+        cached = await self.cache.get_many(keys.values())
+
+        by_id: dict[int, dict] = {}
+        missing: list[int] = []
+        for i in ids:
+            key = keys[i]
+            if key not in cached:
+                missing.append(i)
+            elif cached[key] is not None:
+                by_id[i] = cached[key]
+
+        if missing:
+            await self._ensure_pool()
+            async with self.pool.acquire(timeout=ACQUIRE_TIMEOUT) as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT id, source_id, file_type, content
+                    FROM sora_content
+                    WHERE id = ANY($1::bigint[])
+                    """,
+                    missing,
+                )
+            fetched = {int(r["id"]): dict(r) for r in rows}
+            by_id.update(fetched)
+            self.cache.set_many({keys[i]: row for i, row in fetched.items()}, ttl=CACHE_TTL)
+            self.cache.set_absent([keys[i] for i in missing if i not in fetched])
+
+        return [by_id[i] for i in ids if i in by_id]
 
 
     async def upsert_file_extension(self,
@@ -350,48 +421,84 @@ class DB:
 
     #要和 ananbot_utils.py 作整合
     async def search_sora_content_by_id(self, content_id: int):
-        cache_key = f"sora_content_id:{content_id}"
-        # print(f"Searching sora_content by id {content_id} with cache key {cache_key}")
-        cached = await self.cache.get(cache_key)
-        if cached:
-            print(f"\r\n\r\n173:Cache hit for {cache_key}")
-            self.cache.set(cache_key, cached, ttl=CACHE_TTL)
-            return cached
-        
-        # print(f"\r\n\r\nCache miss for {cache_key}, querying database...")
-        await self._ensure_pool()
+        rows = await self.hydrate_contents([int(content_id)])
+        return rows[0] if rows else None
+
+    def _content_cache_key(self, content_id: int, bot: str) -> str:
+        # 本 bot 沿用旧 key（不含 bot 名），其它 bot 的 file_id 不能混进来
+        if bot == lz_var.bot_username:
+            return f"sora_content_id:{content_id}"
+        return f"sora_content_id:{bot}:{content_id}"
+
+    async def hydrate_contents(self, ids: list[int], bot: str | None = None) -> list[dict]:
+        """
+        一次取多笔商品（搜索结果页 / 资源橱窗 / 上传兑换记录）：
+          1) cache.get_many 一次往返；未命中的 id 用一条 JOIN 查完
+          2) 缺 file_id / thumb_file_id 的，用一条 file_extension 查询集中补齐，
+             补齐的再一条语句批量 upsert 回 sora_media
+          3) 完整的结果（连同命中的，刷新 TTL）一次 pipeline 写缓存
+        返回顺序与 ids 一致；查不到的 id 略过。
+        """
+        if not ids:
+            return []
+        bot = bot or lz_var.bot_username
+        ids = [int(i) for i in ids]
+        keys = {i: self._content_cache_key(i, bot) for i in ids}
+        cached = await self.cache.get_many(keys.values())
+
+        by_id: dict[int, dict] = {}
+        missing: list[int] = []
+        for i in dict.fromkeys(ids):
+            hit = cached.get(keys[i])
+            if hit:
+                by_id[i] = hit
+            else:
+                missing.append(i)
+
+        # 命中的也一起重写：与旧 search_sora_content_by_id 一样，热门商品的 TTL 是滑动的
+        to_cache = dict(by_id)
+        if missing:
+            loaded = await self._load_contents(missing, bot)
+            by_id.update(loaded)
+            to_cache.update(
+                (i, row) for i, row in loaded.items() if row["file_id"] and row["thumb_file_id"]
+            )
+        self.cache.set_many({keys[i]: row for i, row in to_cache.items()}, ttl=CACHE_TTL, only_l2=False)
 
+        return [by_id[i] for i in ids if i in by_id]
+
+    async def _load_contents(self, ids: list[int], bot: str) -> dict[int, dict]:
+        await self._ensure_pool()
         async with self.pool.acquire(timeout=ACQUIRE_TIMEOUT) as conn:
-            row = await conn.fetchrow(
+            rows = await conn.fetch(
                 '''
-                SELECT s.id, s.source_id, s.file_type, s.content, s.file_size, s.duration, s.tag,
+                SELECT DISTINCT ON (s.id)
+                    s.id, s.source_id, s.file_type, s.content, s.file_size, s.duration, s.tag,
                     s.thumb_file_unique_id, s.valid_state, s.file_password,
                     m.file_id AS m_file_id, m.thumb_file_id AS m_thumb_file_id,
-                    p.price as fee, p.file_type as product_type, p.owner_user_id, p.purchase_condition, p.review_status, p.content as product_content  
+                    p.price as fee, p.file_type as product_type, p.owner_user_id, p.purchase_condition, p.review_status, p.content as product_content
                 FROM sora_content s
                 LEFT JOIN sora_media m ON s.id = m.content_id AND m.source_bot_name = $2
                 LEFT JOIN product p ON s.id = p.content_id
-                WHERE s.id = $1
+                WHERE s.id = ANY($1::bigint[])
+                ORDER BY s.id
                 ''',
-                content_id, lz_var.bot_username
+                ids, bot
             )
-            
-            if not row:
-                # print(f"\r\n\r\nNo sora_content found for id {content_id}"  )
-                return None  # 未找到内容
-            # print(f"\r\n\r\nDatabase returned row for content_id {content_id}: {row}")
-
-            row = dict(row)
-
-            # 先用 m 表资料
-            file_id = row.get("m_file_id")
-            thumb_file_id = row.get("m_thumb_file_id")
-
-            # 若缺其中任一，则尝试用 file_extension 查补
-            if not file_id or not thumb_file_id:
-
-                # print(f"\r\n\r\n>>> Fetching file extensions for {row.get('source_id')} and {row.get('thumb_file_unique_id')}")
-
+            if not rows:
+                return {}
+            rows = [dict(r) for r in rows]
+
+            # 缺 file_id / thumb_file_id 的，一次把所有 file_unique_id 拿去 file_extension 查
+            need: set[str] = set()
+            for row in rows:
+                if not row.get("m_file_id") and row.get("source_id"):
+                    need.add(row["source_id"])
+                if not row.get("m_thumb_file_id") and row.get("thumb_file_unique_id"):
+                    need.add(row["thumb_file_unique_id"])
+
+            ext_map: dict[str, str] = {}
+            if need:
                 extension_rows = await conn.fetch(
                     '''
                     SELECT file_unique_id, file_id
@@ -399,68 +506,57 @@ class DB:
                     WHERE file_unique_id = ANY($1::text[])
                     AND bot = $2
                     ''',
-                    [row.get("source_id"), row.get("thumb_file_unique_id")],
-                    lz_var.bot_username
+                    list(need), bot
                 )
                 ext_map = {r["file_unique_id"]: r["file_id"] for r in extension_rows}
 
-                # print(f"Fetched {len(extension_rows)} file extensions for content_id {content_id}")
-                # 如果 file_id 还没值，尝试用 source_id 和 thumb_file_unique_id 查找
-                # print(f"{ext_map}")
-                # print(f"{row}")
-               
-
-                if not file_id and row.get("source_id") in ext_map:
-                    file_id = ext_map[row["source_id"]]
-
-                if not thumb_file_id and row.get("thumb_file_unique_id") in ext_map:
-                    thumb_file_id = ext_map[row["thumb_file_unique_id"]]
-
-            # 如果两个都有值，就 upsert 写入 sora_media
-            if file_id and thumb_file_id:
-                # print(f"\r\n\r\n>>>Upserting sora_media for content_id {content_id} with file_id {file_id} and thumb_file_id {thumb_file_id}")
+            out: dict[int, dict] = {}
+            media_ids, media_fids, media_thumbs = [], [], []
+            for row in rows:
+                file_id = row.get("m_file_id") or ext_map.get(row.get("source_id"))
+                thumb_file_id = row.get("m_thumb_file_id") or ext_map.get(row.get("thumb_file_unique_id"))
+
+                # 本次才补齐的，写回 sora_media
+                if file_id and thumb_file_id and not (row.get("m_file_id") and row.get("m_thumb_file_id")):
+                    media_ids.append(int(row["id"]))
+                    media_fids.append(file_id)
+                    media_thumbs.append(thumb_file_id)
+
+                out[int(row["id"])] = {
+                    "id": row["id"],
+                    "source_id": row["source_id"],
+                    "file_type": row["file_type"],
+                    "content": row["content"],
+                    "product_content": row.get("product_content"),
+                    "file_size": row["file_size"],
+                    "duration": row["duration"],
+                    "tag": row["tag"],
+                    "file_id": file_id,
+                    "thumb_file_id": thumb_file_id,
+                    "thumb_file_unique_id": row.get("thumb_file_unique_id"),
+                    "fee": row.get("fee"),
+                    "product_type": row.get("product_type"),
+                    "owner_user_id": row.get("owner_user_id"),
+                    "purchase_condition": row.get("purchase_condition"),
+                    "valid_state": row.get("valid_state"),
+                    "review_status": row.get("review_status"),
+                    "file_password": row.get("file_password")
+                }
+
+            if media_ids:
                 await conn.execute(
                     '''
                     INSERT INTO sora_media (content_id, file_id, thumb_file_id, source_bot_name)
-                    VALUES ($1, $2, $3, $4)
+                    SELECT u.content_id, u.file_id, u.thumb_file_id, $4
+                    FROM unnest($1::bigint[], $2::text[], $3::text[]) AS u(content_id, file_id, thumb_file_id)
                     ON CONFLICT (content_id, source_bot_name)
                     DO UPDATE SET
                         file_id = EXCLUDED.file_id,
                         thumb_file_id = EXCLUDED.thumb_file_id
                     ''',
-                    content_id, file_id, thumb_file_id, lz_var.bot_username
+                    media_ids, media_fids, media_thumbs, bot
                 )
-
-            result = {
-                "id": row["id"],
-                "source_id": row["source_id"],
-                "file_type": row["file_type"],
-                "content": row["content"],
-                "product_content": row.get("product_content"),
-                "file_size": row["file_size"],
-                "duration": row["duration"],
-                "tag": row["tag"],
-                "file_id": file_id,
-                "thumb_file_id": thumb_file_id,
-                "thumb_file_unique_id": row.get("thumb_file_unique_id"),
-                "fee": row.get("fee"),
-                "product_type": row.get("product_type"),
-                "owner_user_id": row.get("owner_user_id"),
-                "purchase_condition": row.get("purchase_condition"),
-                "valid_state": row.get("valid_state"),
-                "review_status": row.get("review_status"),
-                "file_password": row.get("file_password")
-            }
-
-            # print(f"\r\n\r\nFinal result for content_id {content_id}: {result}")
-
-            # self.cache.set(cache_key, result, ttl=3600)
-            if(thumb_file_id and file_id):
-                self.cache.set(cache_key, result, ttl=CACHE_TTL)
-            # print(f"Cache set for {cache_key}")
-            return result
-
-            # 返回 asyncpg Record 或 None
+            return out
 
     # async def get_next_content_id(self, current_id: int, offset: int) -> int | None:
     #     await self._ensure_pool()
@@ -696,7 +792,7 @@ class DB:
             DO UPDATE SET file_id = EXCLUDED.file_id
         """
 
-        try:
+        async def _load():
             async with self.pool.acquire(timeout=ACQUIRE_TIMEOUT) as conn:
                 rows = await conn.fetch(sql, bot_name, content_id)
 
@@ -727,6 +823,16 @@ class DB:
                             await conn.execute(upsert_sql, cid, bn, fid)
 
                 return dict_rows
+
+        try:
+            # 只缓存每个成员都已有 file_id 的结果；缺 file_id / 空列表下次照常回源
+            return await self.cache.get_or_load(
+                album_cache_key(bot_name, content_id),
+                _load,
+                ttl=ALBUM_CACHE_TTL,
+                stale_ttl=ALBUM_CACHE_TTL,
+                cache_if=album_list_complete,
+            )
         except Exception as e:
             print(f"⚠️ 802 get_album_list 出错: {e}", flush=True)
             return []
@@ -0,0 +1,152 @@
+# lz_gate_cache.py  —— @classmethod 风格，与 PGPool / MySQLPool 一致
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional, Set, Tuple
+
+from lz_config import OP_VALKEY_URL, VALKEY_URL
+from lz_valkey import ValkeyPool
+
+# 判定结果：0 = 放行；> 0 = 黑名单原因码（同 MySQLPool.is_user_blacklisted）；-1 = 今日未发言
+GATE_PASS = 0
+GATE_NOT_SPOKEN = -1
+
+# 「未发言」只短暂缓存：用户随时可能去群里说话（正常会被推送提前覆盖）
+NOT_SPOKEN_TTL = 30
+# 与 MySQLPool.has_spoken_today 共用的 op_cache 键（TwoLevelCache namespace 'op:' → "op::t:{uid}"）
+SPOKEN_TTL = 108000
+SPOKEN_CHANNEL = "gate:spoken"
+
+
+def local_stat_date() -> str:
+    """UTC+8 的自然日，与 GroupStatsTracker / contribute_today 对齐。"""
+    return (datetime.now(timezone.utc) + timedelta(hours=8)).strftime("%Y-%m-%d")
+
+
+class GateCache:
+    """
+    私聊准入判定缓存（BlacklistGuardMiddleware 用）：
+    - 以 (user_id, 当日) 为键，缓存合并后的判定码（黑名单 + 今日发言）
+    - 黑名单索引整包替换时（generation 变化）条目自动失效
+    - GroupStatsTracker 看到群内有效发言时 push_spoken()：
+        写 op_cache 的 t:{uid}（has_spoken_today 也认）并 PUBLISH，
+        各 bot 进程的 listener 收到后直接把该用户标成已发言
+    命中时只是一次 dict 查找，不碰 MySQL / Valkey。
+    """
+
+    _date: str = ""
+    _verdicts: Dict[int, Tuple[int, int, float]] = {}  # uid -> (code, blacklist_generation, expire_at)
+    _spoken: Set[int] = set()   # 今日已知发言的用户（推送 / 查询结果）
+    _pushed: Set[int] = set()   # 本进程今日已推送过的用户（tracker 侧去重）
+    _listener: Optional[asyncio.Task] = None
+
+    @classmethod
+    def _roll(cls, stat_date: str):
+        # 跨日整包丢弃
+        if stat_date != cls._date:
+            cls._date = stat_date
+            cls._verdicts = {}
+            cls._spoken = set()
+            cls._pushed = set()
+
+    @classmethod
+    async def check(cls, user_id: int, stat_date: Optional[str] = None) -> int:
+        from lz_mysql import MySQLPool  # 延迟引入，避免循环依赖
+
+        uid = int(user_id)
+        stat_date = stat_date or local_stat_date()
+        cls._roll(stat_date)
+
+        gen = MySQLPool._blacklist_generation
+        now = time.monotonic()
+        hit = cls._verdicts.get(uid)
+        if hit is not None and hit[1] == gen and hit[2] > now:
+            return hit[0]
+
+        code = await MySQLPool.is_user_blacklisted(uid) or 0
+        if code > 0:
+            expire_at = float("inf")  # 直到黑名单索引下次变化
+        elif uid in cls._spoken:
+            code, expire_at = GATE_PASS, float("inf")
+        elif await MySQLPool.has_spoken_today(uid, stat_date):
+            cls._spoken.add(uid)
+            code, expire_at = GATE_PASS, float("inf")
+        else:
+            code, expire_at = GATE_NOT_SPOKEN, now + NOT_SPOKEN_TTL
+
+        cls._verdicts[uid] = (code, gen, expire_at)
+        return code
+
+    @classmethod
+    def mark_spoken(cls, user_id: int, stat_date: Optional[str] = None):
+        uid = int(user_id)
+        stat_date = stat_date or local_stat_date()
+        if stat_date < cls._date:
+            return  # 迟到的旧消息
+        cls._roll(stat_date)
+        cls._spoken.add(uid)
+        hit = cls._verdicts.get(uid)
+        if hit is not None and hit[0] == GATE_NOT_SPOKEN:
+            cls._verdicts.pop(uid, None)
+
+    # ========= 跨进程推送 =========
+    @classmethod
+    async def push_spoken(cls, user_id: int, stat_date: str):
+        """tracker 侧：每个用户每天只推一次（SET + PUBLISH 一次往返）。"""
+        uid = int(user_id)
+        cls._roll(max(stat_date, cls._date))
+        if stat_date != cls._date or uid in cls._pushed:
+            return
+        cls._pushed.add(uid)
+        cls.mark_spoken(uid, stat_date)
+        try:
+            client = ValkeyPool.get_client(OP_VALKEY_URL or VALKEY_URL)
+            async with client.pipeline(transaction=False) as pipe:
+                pipe.set(f"op::t:{uid}", str(int(time.time()) + SPOKEN_TTL), ex=SPOKEN_TTL)
+                pipe.publish(SPOKEN_CHANNEL, json.dumps({"u": uid, "d": stat_date}))
+                await pipe.execute()
+        except Exception as e:
+            cls._pushed.discard(uid)
+            print(f"⚠️ GateCache push_spoken 失败 uid={uid}: {e}", flush=True)
+
+    @classmethod
+    def start_listener(cls):
+        """bot 侧：订阅发言推送（幂等，需在事件循环内调用）。"""
+        if cls._listener is not None and not cls._listener.done():
+            return
+        cls._listener = asyncio.get_running_loop().create_task(cls._listen())
+
+    @classmethod
+    async def _listen(cls):
+        delay = 0.5
+        while True:
+            pubsub = ValkeyPool.get_client(OP_VALKEY_URL or VALKEY_URL).pubsub()
+            try:
+                await pubsub.subscribe(SPOKEN_CHANNEL)
+                delay = 0.5
+                while True:
+                    msg = await pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                    if msg and msg.get("type") == "message":
+                        data = json.loads(msg["data"])
+                        cls.mark_spoken(data["u"], data.get("d"))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ GateCache listener 出错: {e}", flush=True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+            finally:
+                try:
+                    await pubsub.aclose() if hasattr(pubsub, "aclose") else await pubsub.reset()
+                except Exception:
+                    pass
+
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            "date": cls._date,
+            "verdicts": len(cls._verdicts),
+            "spoken": len(cls._spoken),
+            "pushed": len(cls._pushed),
+        }
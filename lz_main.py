@@ -20,6 +20,11 @@ from lz_config import ADMIN_IDS, BOT_TOKEN,SWITCHBOT_TOKEN, SWITCHBOT_CHAT_ID, S
 # from lz_db import db
 from lz_pgsql import PGPool
 from lz_mysql import MySQLPool
+from lz_valkey import ValkeyPool
+from watermark.watermark_pool import WatermarkPool
+from lz_gate_cache import GateCache, GATE_NOT_SPOKEN, local_stat_date
+from lz_sync_engine import SyncEngine, SYNC_ENGINE_ENABLED
+from lz_prefetch import PrefetchQueue
 from utils.tpl import Tplate
 
 from handlers import lz_media_parser
@@ -201,6 +206,26 @@ class WhitelistModeMiddleware(BaseMiddleware):
         return await handler(event, data)
 
 
+# 未发言提示里随机附带的一句话（模块级常量，不必每个事件重建）
+GATE_SLOGANS = (
+    "学院不是一个群名，是大家愿意回来待着的地方。",
+    "在学院待久了，多少都会有点感情。",
+    "学院的热闹，也有我参与的一份。",
+    "学院里有同学说话，气氛就会更踏实。",
+    "能一直留在学院的，多少都算自己人。",
+    "我也是学院的一份子。",
+    "学院多一点互动，气氛就会更像自己人。",
+    "在学院多聊两句，小圈圈就会多一点温度。",
+    "学院这个小圈圈能走下去，靠的是大家多少都有参与。",
+    "学院不是靠一句口号撑起来的，是靠同学们真的愿意参与。",
+    "留在学院久了，就会慢慢知道这里为什么值得留下。",
+    "龙阳能留下来的，都是愿意一起撑这个小圈圈的师兄弟。",
+    "在龙阳混久了，多少都会有一点师兄弟的感觉。",
+    "龙阳不是路过的地方，愿意留下来才会有感情。",
+    "龙阳的熟悉感，是师兄弟们一次次冒泡慢慢养出来的。",
+)
+
+
 class BlacklistGuardMiddleware(BaseMiddleware):
     def __init__(self, whitelist_matrix: dict[str, set[int]] | None = None):
         super().__init__()
@@ -230,8 +255,10 @@ class BlacklistGuardMiddleware(BaseMiddleware):
 
         if chat and getattr(chat, "type", None) == "private":
 
-            block_code =  await MySQLPool.is_user_blacklisted(user.id)
-            if block_code is not None and block_code > 0:
+            # 黑名单 + 今日发言合并判定（GateCache 命中时只是一次 dict 查找）
+            stat_date = local_stat_date()
+            block_code = await GateCache.check(user.id, stat_date)
+            if block_code > 0:
                 if block_code == 4:
                     reason = "基于社群安全考量，服务暂时暂停。"
                 elif block_code == 5:
@@ -252,22 +279,17 @@ class BlacklistGuardMiddleware(BaseMiddleware):
                 return
 
 
-           
-            chat_cfg = SharedConfig.get("chat") or {}
-            public_school = chat_cfg.get("public") or {}
+            if block_code == GATE_NOT_SPOKEN:
+                chat_cfg = SharedConfig.get("chat") or {}
+                public_school = chat_cfg.get("public") or {}
 
-            # 直接重新賦值，後續整個檔案用的 TARGET_CHAT_ID 都會是新值
-            main_group_url = str(public_school.get("invite_link") or "")
-            guider_bot_name = str(SharedConfig.get("guider_bot_name") or "")
-        
-            faq_url = f"https://t.me/{guider_bot_name}?start=faq" if guider_bot_name else ""
-            rule_url = f"https://t.me/{guider_bot_name}?start=show_inst_points" if guider_bot_name else ""
-           
+                # 直接重新賦值，後續整個檔案用的 TARGET_CHAT_ID 都會是新值
+                main_group_url = str(public_school.get("invite_link") or "")
+                guider_bot_name = str(SharedConfig.get("guider_bot_name") or "")
+            
+                faq_url = f"https://t.me/{guider_bot_name}?start=faq" if guider_bot_name else ""
+                rule_url = f"https://t.me/{guider_bot_name}?start=show_inst_points" if guider_bot_name else ""
 
-            sgt_now = datetime.now(timezone.utc) + timedelta(hours=8)
-            stat_date = sgt_now.strftime("%Y-%m-%d")
-            if not await MySQLPool.has_spoken_today(user.id, stat_date,redis_url=SharedConfig.get("valkey_url")):
-               
                 helper_bot_url = f"https://t.me/{getattr(lz_var, 'helper_bot_name', '')}"
                 keyboard = types.InlineKeyboardMarkup(
                     inline_keyboard=[
@@ -283,25 +305,7 @@ class BlacklistGuardMiddleware(BaseMiddleware):
 
                 
 
-                slogans = [
-                    "学院不是一个群名，是大家愿意回来待着的地方。",
-                    "在学院待久了，多少都会有点感情。",
-                    "学院的热闹，也有我参与的一份。",
-                    "学院里有同学说话，气氛就会更踏实。",
-                    "能一直留在学院的，多少都算自己人。",
-                    "我也是学院的一份子。",
-                    "学院多一点互动，气氛就会更像自己人。",
-                    "在学院多聊两句，小圈圈就会多一点温度。",
-                    "学院这个小圈圈能走下去，靠的是大家多少都有参与。",
-                    "学院不是靠一句口号撑起来的，是靠同学们真的愿意参与。",
-                    "留在学院久了，就会慢慢知道这里为什么值得留下。",
-                    "龙阳能留下来的，都是愿意一起撑这个小圈圈的师兄弟。",
-                    "在龙阳混久了，多少都会有一点师兄弟的感觉。",
-                    "龙阳不是路过的地方，愿意留下来才会有感情。",
-                    "龙阳的熟悉感，是师兄弟们一次次冒泡慢慢养出来的。",
-                ]
-
-                random_slogan = random.choice(slogans)
+                random_slogan = random.choice(GATE_SLOGANS)
 
                
                 notice_text = textwrap.dedent(f"""
@@ -594,6 +598,10 @@ async def main():
 
     # 1) 先连 MySQL
     await MySQLPool.init_pool()
+    # 黑名单索引：快照暖机 + 后台增量刷新（中间件只读内存，不再在请求里扫表）
+    MySQLPool.start_blacklist_index()
+    # 接收 GroupStatsTracker 推送的「今日已发言」
+    GateCache.start_listener()
 
     # 2) 确保本地词库文件存在（不存在就从 MySQL 导出生成）
     await ensure_lexicon_files(output_dir=".", force=False)
@@ -602,6 +610,10 @@ async def main():
     await PGPool.init_pool()
     # await db.connect()
 
+    # MySQL → PG 常驻增量同步（多进程各自启用时由 Valkey 租约选出一个在跑）
+    if SYNC_ENGINE_ENABLED:
+        await SyncEngine.start()
+
     await sync()
     config_reload_task = asyncio.create_task(
         periodic_shared_config_reload(on_reload=reload_access_config)
@@ -610,6 +622,15 @@ async def main():
     # ✅ 注册 shutdown 钩子：无论 webhook/polling，退出时都能清理
     @dp.shutdown()
     async def _on_shutdown():
+        try:
+            await SyncEngine.stop()
+        except Exception as e:
+            print(f"[shutdown] SyncEngine stop error: {e}")
+        try:
+            # 预加载 worker 还会用到 PG，须在关闭连接池之前收尾
+            await PrefetchQueue.stop()
+        except Exception as e:
+            print(f"[shutdown] PrefetchQueue stop error: {e}")
         try:
             # await db.disconnect()    
             await PGPool.close()        
@@ -620,6 +641,14 @@ async def main():
             await MySQLPool.close()
         except Exception as e:
             print(f"[shutdown] MySQL close error: {e}")
+        try:
+            await ValkeyPool.close()
+        except Exception as e:
+            print(f"[shutdown] Valkey close error: {e}")
+        try:
+            await asyncio.to_thread(WatermarkPool.shutdown)
+        except Exception as e:
+            print(f"[shutdown] WatermarkPool shutdown error: {e}")
         await close_bot_session(switchbot, "SwitchBot")
         await close_bot_session(bot, "Bot")
         if config_reload_task and not config_reload_task.done():
@@ -710,6 +739,10 @@ async def main():
         
     finally:
          # 双保险：若没走到 @dp.shutdown（例如异常中断），也清理资源
+        try:
+            await PrefetchQueue.stop()
+        except Exception:
+            pass
         try:
             # await db.disconnect()
             await PGPool.close()
@@ -720,6 +753,14 @@ async def main():
             await MySQLPool.close()
         except Exception:
             pass
+        try:
+            await ValkeyPool.close()
+        except Exception:
+            pass
+        try:
+            await asyncio.to_thread(WatermarkPool.shutdown)
+        except Exception:
+            pass
         await close_bot_session(switchbot, "SwitchBot")
         await close_bot_session(bot, "Bot")
         if config_reload_task and not config_reload_task.done():
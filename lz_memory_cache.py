@@ -1,74 +1,244 @@
+import asyncio
+import os
+import sys
 import time
+import weakref
 from collections import OrderedDict
 from typing import Any, Optional
 
 
+# 单个实例的字节上限；所有实例合计的进程级上限（Render 小机型需要硬上限）
+MEMORY_CACHE_MAX_BYTES = int(os.getenv("MEMORY_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+MEMORY_CACHE_TOTAL_BYTES = int(os.getenv("MEMORY_CACHE_TOTAL_BYTES", str(64 * 1024 * 1024)))
+MEMORY_CACHE_PURGE_INTERVAL = float(os.getenv("MEMORY_CACHE_PURGE_INTERVAL", "30"))
+
+# 估算容器大小时最多抽样的元素数 / 递归深度
+_SAMPLE = 8
+_MAX_DEPTH = 3
+# 容器里的这些标量只算指针（已含在容器的 getsizeof 里）：小整数是共享对象，
+# 大整数 / float 也远小于一条记录的其它开销；否则 3000 个 id 的列表会被估成 ~108KB
+_ATOMS = (int, float, bool, type(None))
+
+
+def estimate_size(value: Any, depth: int = 0) -> int:
+    """
+    近似字节数：sys.getsizeof + 抽样元素 × 长度。
+    开销与容器长度无关（3000 行的结果集也只看 8 个元素），不做 str()/pickle。
+    """
+    try:
+        size = sys.getsizeof(value)
+        if depth >= _MAX_DEPTH:
+            return size
+        if isinstance(value, (list, tuple, set, frozenset)):
+            n = len(value)
+            if n:
+                sample = value[:_SAMPLE] if isinstance(value, (list, tuple)) else list(value)[:_SAMPLE]
+                size += sum(_element_size(v, depth + 1) for v in sample) * n // len(sample)
+        elif isinstance(value, dict):
+            n = len(value)
+            if n:
+                sample = list(value.items())[:_SAMPLE]
+                per = sum(_element_size(k, depth + 1) + _element_size(v, depth + 1) for k, v in sample)
+                size += per * n // len(sample)
+        return size
+    except Exception:
+        return 128  # 保守兜底
+
+
+def _element_size(value: Any, depth: int) -> int:
+    if isinstance(value, _ATOMS):
+        return 0
+    return estimate_size(value, depth)
+
+
 class MemoryCache:
     """
-    L1 内存缓存（TTL + LRU + size limit）
+    L1 内存缓存（TTL + LRU + 字节预算）
+    - 每条记录保存估算字节数，按总字节 / 条数两个上限做 LRU 淘汰
+    - 所有实例共享一个进程级字节上限，超出时从占用最多的实例淘汰最旧数据（不淘汰刚写入的 key）
+    - 过期条目由后台 task 定期清理（无事件循环时在 set 里顺带清理）；
+      task 只持有实例的弱引用，不用的实例调用 close()（或被回收时）会退出合计字节
+    - stats() 提供 hits / misses / evictions / expirations / bytes
     """
 
+    _total_bytes = 0  # 进程内所有 MemoryCache 实例的合计
+    _instances: "weakref.WeakSet[MemoryCache]" = weakref.WeakSet()
+
     def __init__(
         self,
         max_items: int = 2000,
         max_value_bytes: int = 256 * 1024,
+        max_bytes: int = MEMORY_CACHE_MAX_BYTES,
+        purge_interval: float = MEMORY_CACHE_PURGE_INTERVAL,
     ):
         self.max_items = max_items
         self.max_value_bytes = max_value_bytes
-        self._store = OrderedDict()
+        self.max_bytes = max_bytes
+        self.purge_interval = purge_interval
+        self._store = OrderedDict()  # key -> (value, expire_at, size)
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+        self._rejected = 0
+        self._purger: Optional[asyncio.Task] = None
+        self._next_purge = self._now() + purge_interval
+        MemoryCache._instances.add(self)
 
     def _now(self) -> float:
         return time.time()
 
     def _estimate_size(self, value: Any) -> int:
-        # 轻量估算，避免 deepcopy / pickle
-        try:
-            if isinstance(value, str):
-                return len(value.encode("utf-8"))
-            if isinstance(value, (bytes, bytearray)):
-                return len(value)
-            if isinstance(value, (list, tuple, set, dict)):
-                return len(str(value).encode("utf-8"))
-        except Exception:
-            pass
-        return 128  # 保守兜底
+        return estimate_size(value)
+
+    def _pop(self, key: str):
+        item = self._store.pop(key, None)
+        if item is not None:
+            self._bytes -= item[2]
+            MemoryCache._total_bytes -= item[2]
+        return item
 
     def get(self, key: str):
         item = self._store.get(key)
         if not item:
+            self._misses += 1
             return None
 
-        value, expire_at = item
+        value, expire_at, _ = item
         if expire_at and expire_at < self._now():
-            self._store.pop(key, None)
+            self._pop(key)
+            self._expirations += 1
+            self._misses += 1
             return None
 
         # LRU 命中 → 移到末尾
         self._store.move_to_end(key)
+        self._hits += 1
         return value
 
     def set(self, key: str, value: Any, ttl: Optional[int] = None):
         # 大对象不进 L1
-        if self._estimate_size(value) > self.max_value_bytes:
+        size = self._estimate_size(value)
+        if size > self.max_value_bytes or size > self.max_bytes:
+            self._rejected += 1
+            self._pop(key)  # 旧值也不能留着
             return
 
+        self._pop(key)
         expire_at = self._now() + ttl if ttl else None
-        self._store[key] = (value, expire_at)
-        self._store.move_to_end(key)
+        self._store[key] = (value, expire_at, size)
+        self._bytes += size
+        MemoryCache._total_bytes += size
+
+        # 超量 → LRU 淘汰（条数 / 本实例字节）；刚写入的 key 在末尾，至少保留它
+        while len(self._store) > 1 and (
+            len(self._store) > self.max_items
+            or self._bytes > self.max_bytes
+        ):
+            self._evict_oldest()
+
+        # 进程合计超量 → 从占用最多的实例淘汰
+        while MemoryCache._total_bytes > MEMORY_CACHE_TOTAL_BYTES:
+            victim = max(
+                (c for c in MemoryCache._instances if len(c._store) > (1 if c is self else 0)),
+                key=lambda c: c._bytes,
+                default=None,
+            )
+            if victim is None:
+                break
+            victim._evict_oldest()
+
+        self._schedule_purge()
 
-        # 超量 → LRU 淘汰
-        while len(self._store) > self.max_items:
-            self._store.popitem(last=False)
+    def _evict_oldest(self):
+        oldest = next(iter(self._store))
+        self._pop(oldest)
+        self._evictions += 1
 
     def delete(self, key: str):
-        self._store.pop(key, None)
+        self._pop(key)
+
+    def evict_prefix(self, prefix: str) -> int:
+        keys = [k for k in self._store if str(k).startswith(prefix)]
+        for k in keys:
+            self._pop(k)
+        return len(keys)
 
     def clear(self):
+        MemoryCache._total_bytes -= self._bytes
         self._store.clear()
+        self._bytes = 0
+
+    def close(self):
+        """停掉后台清理并清空，占用的字节从进程合计里扣除；可重复调用。"""
+        if self._purger is not None:
+            self._purger.cancel()
+            self._purger = None
+        self.clear()
+        MemoryCache._instances.discard(self)
+
+    def __del__(self):
+        # 没调用 close() 就被回收：字节也要从进程合计里扣掉，否则全局预算会越用越小
+        try:
+            if self._purger is not None and not self._purger.done():
+                self._purger.cancel()
+            MemoryCache._total_bytes -= self._bytes
+            self._bytes = 0
+        except Exception:
+            pass
+
+    # ========= 过期清理 =========
+    def purge_expired(self) -> int:
+        now = self._now()
+        expired = [k for k, (_, exp, _) in self._store.items() if exp and exp < now]
+        for k in expired:
+            self._pop(k)
+        self._expirations += len(expired)
+        self._next_purge = now + self.purge_interval
+        return len(expired)
+
+    def _schedule_purge(self):
+        if self._purger is not None and not self._purger.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 同步场景：到点了就顺带清一次
+            if self._now() >= self._next_purge:
+                self.purge_expired()
+            return
+        self._purger = loop.create_task(MemoryCache._purge_loop(weakref.ref(self), self.purge_interval))
+
+    @staticmethod
+    async def _purge_loop(ref: "weakref.ref[MemoryCache]", interval: float):
+        # 只持有弱引用：实例不再被使用时可以被回收，task 下一轮自行结束
+        while True:
+            await asyncio.sleep(interval)
+            cache = ref()
+            if cache is None:
+                return
+            try:
+                cache.purge_expired()
+            except Exception as e:
+                print(f"MemoryCache: purge failed, error={e}")
+            finally:
+                cache = None
 
     def stats(self) -> dict:
+        lookups = self._hits + self._misses
         return {
             "items": len(self._store),
             "max_items": self.max_items,
             "max_value_bytes": self.max_value_bytes,
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "total_bytes": MemoryCache._total_bytes,
+            "max_total_bytes": MEMORY_CACHE_TOTAL_BYTES,
+            "hits": self._hits,
+            "misses": self._misses,
+            "hit_rate": round(self._hits / lookups, 4) if lookups else 0.0,
+            "evictions": self._evictions,
+            "expirations": self._expirations,
+            "rejected": self._rejected,
         }
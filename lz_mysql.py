@@ -1,13 +1,15 @@
 
 import aiomysql
+import os
 import time
 from datetime import datetime, timedelta, timezone
 import json
-import redis.asyncio as redis_async
 from lz_config import MYSQL_HOST, MYSQL_USER, MYSQL_PASSWORD, MYSQL_DB, MYSQL_DB_PORT, VALKEY_URL, OP_VALKEY_URL
+from lz_config import BLACKLIST_REFRESH_INTERVAL, BLACKLIST_FULL_REFRESH_INTERVAL, BLACKLIST_SNAPSHOT_PATH
 from typing import Optional, Dict, Any, List, Tuple
 from lz_memory_cache import MemoryCache
 from lz_cache import TwoLevelCache
+from lz_mysql_pool import MySQLPoolManager
 import lz_var
 import asyncio
 from utils.lybase_utils import LYBase
@@ -52,12 +54,19 @@ from collections import defaultdict
 class MySQLPool(LYBase):
 # class MySQLPool:
     _pool = None
+    _managed = None  # lz_mysql_pool.ManagedPool：按闲置时间校验连接，不再每次 ping
     _lock = asyncio.Lock()
     _cache_ready = False
     cache = None
     op_cache = None
     _blacklist_local_cache: dict[int, int] = {}
     _blacklist_cache_update_time = None
+    # 黑名单索引的增量水位：(user.update_time, user_id) / blacklist_id
+    _blacklist_user_mark: Optional[Tuple[Any, int]] = None
+    _blacklist_id_mark: int = 0
+    _blacklist_full_at: float = 0.0
+    _blacklist_task: Optional[asyncio.Task] = None
+    _blacklist_generation: int = 0  # 每次整包替换 +1，GateCache 据此失效
     _spoken_today_local_cache: dict[int, int] = {}
 
     @classmethod
@@ -74,7 +83,8 @@ class MySQLPool(LYBase):
             if cls._pool is None:
                 if not MYSQL_DB:
                     raise RuntimeError("MYSQL_DB is empty; set db_name, MYSQL_DB_NAME, or MYSQL_DB before initializing MySQLPool")
-                cls._pool = await aiomysql.create_pool(
+                cls._managed = MySQLPoolManager.register(
+                    "lz",
                     host=MYSQL_HOST,
                     user=MYSQL_USER,
                     password=MYSQL_PASSWORD,
@@ -87,6 +97,7 @@ class MySQLPool(LYBase):
                     pool_recycle=1800,
                     connect_timeout=10,
                 )
+                cls._pool = await cls._managed.open()
                 print("✅ MySQL 连接池初始化完成")
             if not cls._cache_ready:
                 cls.cache = TwoLevelCache(valkey_client=VALKEY_URL, namespace='lz:')
@@ -106,37 +117,35 @@ class MySQLPool(LYBase):
         # ✅ 不再抛“未初始化”，而是自愈
         await cls.ensure_pool()
         try:
-            conn = await cls._pool.acquire()
-            try:
-                await conn.ping()
-            except Exception:
-                cls._pool.release(conn)
-                await cls._rebuild_pool()
-                conn = await cls._pool.acquire()
-                await conn.ping()
+            # 只有闲置过久 / 刚出过错时才 ping，热路径不多一次往返
+            conn = await cls._managed.acquire()
             cursor = await conn.cursor(aiomysql.DictCursor)
             return conn, cursor
         except Exception:
+            cls._managed.mark_suspect()
             await cls._rebuild_pool()
-            conn = await cls._pool.acquire()
+            conn = await cls._managed.acquire()
             cursor = await conn.cursor(aiomysql.DictCursor)
             return conn, cursor
 
     @classmethod
-    async def release(cls, conn, cursor):
+    async def release(cls, conn, cursor, error: bool = False):
         try:
             if cursor:
                 await cursor.close()
         finally:
-            if conn and cls._pool:
-                cls._pool.release(conn)
+            if conn and cls._managed:
+                cls._managed.release(conn, error=error)
+
+    @classmethod
+    def pool_stats(cls) -> dict:
+        return cls._managed.stats() if cls._managed else {}
 
     @classmethod
     async def close(cls):
         async with cls._lock:
             if cls._pool:
-                cls._pool.close()
-                await cls._pool.wait_closed()
+                await cls._managed.close()
                 cls._pool = None
                 print("🛑 MySQL 连接池已关闭")
 
@@ -144,100 +153,193 @@ class MySQLPool(LYBase):
     @classmethod
     async def is_user_blacklisted(cls, user_id: int) -> int:
         """
-        黑名单检查（来源: MySQL `blacklist` 表）
+        黑名单检查（来源: MySQL `user` + `blacklist` 表，经进程内索引）
 
-        本地缓存格式：
+        本地缓存格式（只存被挡的用户）：
         cls._blacklist_local_cache = {
             123456: 4,
             789012: 5
         }
 
         返回值：
-        - 0 = 正常
+        - None / 0 = 正常
         - 4 = blacklist 表存在记录
         - 5 = credit <= 5
         - 其他 = plan 的值
+
+        只读本地索引，不查库；索引由 _blacklist_refresh_loop 在后台维护（整包替换）。
         """
+        cls.start_blacklist_index()
+        # 注意：不能用 if cached_value:
+        # 因为 0 也是有效缓存值
+        return cls._blacklist_local_cache.get(int(user_id), None)
 
-        uid = int(user_id)
+    @staticmethod
+    def _blacklist_reason(row: dict) -> int:
+        if int(row.get("blacklist_id") or 0) > 0:
+            # 存在黑名单记录
+            return 4
+        if int(row.get("credit") or 0) <= 5:
+            # 积分低于等于 5
+            return 5
+        if int(row.get("plan") or 0) != 1:
+            # plan != 1，返回 plan 的值，默认 9
+            return int(row.get("plan") or 9)
+        return 0
+
+    @classmethod
+    def start_blacklist_index(cls):
+        """幂等：先用快照暖机，再启动后台刷新 task（需在事件循环内调用）。"""
+        if cls._blacklist_task is not None and not cls._blacklist_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        if not cls._blacklist_local_cache:
+            cls.load_blacklist_snapshot()
+        cls._blacklist_task = loop.create_task(cls._blacklist_refresh_loop())
 
-        now = datetime.now(timezone.utc)
+    @classmethod
+    async def _blacklist_refresh_loop(cls):
+        while True:
+            try:
+                due_full = (
+                    cls._blacklist_user_mark is None
+                    or time.time() - cls._blacklist_full_at >= BLACKLIST_FULL_REFRESH_INTERVAL
+                )
+                if due_full:
+                    await cls._blacklist_full_refresh()
+                else:
+                    await cls._blacklist_delta_refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"⚠️ 黑名单索引刷新失败: {e}", flush=True)
+            await asyncio.sleep(BLACKLIST_REFRESH_INTERVAL)
 
-        # 第一次使用 cache，初始化更新时间
-        if cls._blacklist_cache_update_time is None:
-            cls._blacklist_cache_update_time = now
+    @classmethod
+    async def _blacklist_full_refresh(cls):
+        """全量重建（解除黑名单只能靠全量发现），建好后一次替换。"""
+        t0 = time.perf_counter()
+        conn, cur = await cls.get_conn_cursor()
+        try:
+            # 先取水位再读数据：读取期间的变更会在下一轮增量里重放
+            await cur.execute(
+                "SELECT update_time, user_id FROM user ORDER BY update_time DESC, user_id DESC LIMIT 1"
+            )
+            top = await cur.fetchone()
+            await cur.execute("SELECT COALESCE(MAX(blacklist_id), 0) AS mx FROM blacklist")
+            bl = await cur.fetchone()
 
-        # cache 超过 1 小时，整包清除
-        if now - cls._blacklist_cache_update_time >= timedelta(hours=1):
-            cls._blacklist_local_cache.clear()
-            cls._blacklist_cache_update_time = now
-            conn, cur = await cls.get_conn_cursor()
+            await cur.execute(
+                """
+                SELECT 
+                    b.blacklist_id,
+                    u.credit,
+                    u.plan,
+                    u.user_id as user_id
+                FROM user u
+                LEFT JOIN blacklist b ON u.user_id = b.user_id
+                WHERE (
+                    u.credit <= 5
+                    OR b.blacklist_id > 0
+                    OR u.plan != 1
+                )
+                """
+            )
+            rows = await cur.fetchall()
+        finally:
+            await cls.release(conn, cur)
 
-            try:
+        index: dict[int, int] = {}
+        for row in rows:
+            reason = cls._blacklist_reason(row)
+            if reason:
+                # 同一用户多条 blacklist 记录时取第一条即可（都是 4）
+                index.setdefault(int(row.get("user_id") or 0), reason)
+
+        cls._blacklist_local_cache = index
+        cls._blacklist_generation += 1
+        cls._blacklist_user_mark = (top["update_time"], int(top["user_id"])) if top else (None, 0)
+        cls._blacklist_id_mark = int((bl or {}).get("mx") or 0)
+        cls._blacklist_full_at = time.time()
+        cls._blacklist_cache_update_time = datetime.now(timezone.utc)
+        print(f"✅ 黑名单索引全量载入: {len(index)} 笔, {time.perf_counter() - t0:.2f}s", flush=True)
+        cls.save_blacklist_snapshot()
+
+    @classmethod
+    async def _blacklist_delta_refresh(cls, batch: int = 5000):
+        """增量：只读 update_time 之后变更的用户、以及新增的 blacklist 记录。"""
+        changes: dict[int, int] = {}
+        user_mark = cls._blacklist_user_mark
+        id_mark = cls._blacklist_id_mark
+
+        conn, cur = await cls.get_conn_cursor()
+        try:
+            ts, last_uid = user_mark
+            while ts is not None:
+                # (update_time, user_id) keyset 翻页，同一秒大量更新也不会漏 / 死循环
                 await cur.execute(
                     """
-                    SELECT 
-                        b.blacklist_id,
-                        u.credit,
-                        u.plan,
-                        u.user_id as user_id
+                    SELECT u.user_id, u.credit, u.plan, u.update_time, b.blacklist_id
                     FROM user u
                     LEFT JOIN blacklist b ON u.user_id = b.user_id
-                    WHERE (
-                        (
-                            u.credit <= 5
-                            OR b.blacklist_id > 0
-                            OR u.plan != 1
-                        )
-                        
-                    )
-                    
-                    """
+                    WHERE u.update_time > %s OR (u.update_time = %s AND u.user_id > %s)
+                    ORDER BY u.update_time, u.user_id
+                    LIMIT %s
+                    """,
+                    (ts, ts, last_uid, batch),
                 )
-
-                rows = await cur.fetch()
-
-                is_blocked = 0
+                rows = await cur.fetchall()
                 for row in rows:
-                    uid = int(row.get("user_id") or 0)
-                    if int(row.get("blacklist_id") or 0) > 0:
-                        # 存在黑名单记录
-                        is_blocked = 4
-
-                    elif int(row.get("credit") or 0) <= 5:
-                        # 积分低于等于 5
-                        is_blocked = 5
-
-                    elif int(row.get("plan") or 0) != 1:
-                        # plan != 1，返回 plan 的值，默认 9
-                        is_blocked = int(row.get("plan") or 9)
-
-                    # 写入本地缓存：只存 blocked reason 数字
-                    cls._blacklist_local_cache[uid] = int(is_blocked)
-
-                
-
-            except Exception as e:
-                print(f"⚠️ is_user_blacklisted2 出错: {e}", flush=True)
-                return 0
-
-            finally:
-                await cls.release(conn, cur)
-
+                    uid = int(row["user_id"])
+                    changes[uid] = cls._blacklist_reason(row)
+                    ts, last_uid = row["update_time"], uid
+                if len(rows) < batch:
+                    break
+            user_mark = (ts, last_uid)
+
+            while True:
+                await cur.execute(
+                    "SELECT blacklist_id, user_id FROM blacklist WHERE blacklist_id > %s ORDER BY blacklist_id LIMIT %s",
+                    (id_mark, batch),
+                )
+                rows = await cur.fetchall()
+                for row in rows:
+                    changes[int(row["user_id"])] = 4
+                    id_mark = int(row["blacklist_id"])
+                if len(rows) < batch:
+                    break
+        finally:
+            await cls.release(conn, cur)
 
+        cls._blacklist_user_mark = user_mark
+        cls._blacklist_id_mark = id_mark
+        if not changes:
+            return
 
-        # 先检查本地缓存
-        # 注意：不能用 if cached_value:
-        # 因为 0 也是有效缓存值
-        cached_value = cls._blacklist_local_cache.get(int(uid), None)
-        return cached_value
+        # copy-on-write：在副本上改完再整包替换，读取方永远看到完整的索引
+        index = dict(cls._blacklist_local_cache)
+        for uid, reason in changes.items():
+            if reason:
+                index[uid] = reason
+            else:
+                index.pop(uid, None)
+        cls._blacklist_local_cache = index
+        cls._blacklist_generation += 1
+        cls._blacklist_cache_update_time = datetime.now(timezone.utc)
+        print(f"🔄 黑名单索引增量更新: {len(changes)} 笔", flush=True)
+        cls.save_blacklist_snapshot()
 
-        
-            
+    @classmethod
     def export_blacklist_string(cls) -> str:
+        mark_ts, mark_uid = cls._blacklist_user_mark or (None, 0)
         payload = {
             "version": 1,
             "updated_at": datetime.now(timezone.utc).isoformat(),
+            "user_mark": [mark_ts.isoformat() if mark_ts else None, mark_uid],
+            "blacklist_id_mark": cls._blacklist_id_mark,
             "data": {
                 str(uid): int(reason)
                 for uid, reason in cls._blacklist_local_cache.items()
@@ -245,7 +347,39 @@ class MySQLPool(LYBase):
         }
 
         return json.dumps(payload, ensure_ascii=False, separators=(",", ":"))
-        
+
+    @classmethod
+    def save_blacklist_snapshot(cls, path: str = BLACKLIST_SNAPSHOT_PATH):
+        if not path:
+            return
+        try:
+            tmp = f"{path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(cls.export_blacklist_string())
+            os.replace(tmp, path)
+        except Exception as e:
+            print(f"⚠️ 黑名单快照写入失败: {e}", flush=True)
+
+    @classmethod
+    def load_blacklist_snapshot(cls, path: str = BLACKLIST_SNAPSHOT_PATH) -> bool:
+        """
+        用快照暖机：重启后立刻有可用索引，不必等第一次全量。
+        水位不沿用（快照可能落后），后台仍会先跑一次全量校正。
+        """
+        if not path or not os.path.exists(path):
+            return False
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                payload = json.load(f)
+            if payload.get("version") != 1:
+                return False
+            cls._blacklist_local_cache = {int(k): int(v) for k, v in (payload.get("data") or {}).items()}
+            cls._blacklist_generation += 1
+            print(f"✅ 黑名单索引快照暖机: {len(cls._blacklist_local_cache)} 笔", flush=True)
+            return True
+        except Exception as e:
+            print(f"⚠️ 黑名单快照读取失败: {e}", flush=True)
+            return False
 
     @classmethod
     async def is_user_blacklisted2(cls, user_id: int) -> int:
@@ -357,21 +491,11 @@ class MySQLPool(LYBase):
 
     @classmethod
     async def _rebuild_pool(cls):
+        if cls._managed is None:
+            return await cls.init_pool()
         async with cls._lock:
-            if cls._pool:
-                try:
-                    cls._pool.close()
-                    await cls._pool.wait_closed()
-                except Exception as e:
-                    print(
-                        f"⚠️ [MySQLPool] 关闭旧连接池出错: {e}",
-                        flush=True,
-                    )
-
             cls._pool = None
-            print("🔄 [MySQLPool] 重建 MySQL 连接池中…", flush=True)
-
-        # 必须放到 async with cls._lock 外面
+        cls._pool = await cls._managed.rebuild()
         return await cls.init_pool()
 
     # 预计 08/12 删除 
@@ -410,7 +534,8 @@ class MySQLPool(LYBase):
         - use_prefix=False: 仅精确删除 key 本身
 
         - MemoryCache: 无 keys() 接口，因此从内部 _store 取 key
-        - TwoLevelCache: 仅清 L1（L2 依业务需要可扩展批量删；目前保持轻量，不阻塞）
+        - TwoLevelCache: L1 + L2 都清；前缀删除走 tag 集合（不 SCAN），
+          并经 pub/sub 通知其他进程清各自的 L1
         """
         if not cls.cache:
             return
@@ -2545,6 +2670,57 @@ class MySQLPool(LYBase):
  
 
 
+
+    @classmethod
+    async def fetch_records_after_cursor(
+        cls,
+        table: str,
+        ts_field: Optional[str],
+        pk_field: str,
+        ts: Any,
+        pk: Any,
+        limit: int = 5000,
+    ) -> list[dict]:
+        """
+        复合游标增量查询：按 (ts_field, pk_field) 排序，取游标 (ts, pk) 之后的 limit 笔。
+
+        - 同一时间戳的多笔记录用 pk 续页，不会因为 LIMIT 截在同一秒而漏掉
+        - ts_field 为空：只按 pk 递增（append-only 表，如 transaction）
+        - ts / pk 为 None：从头开始
+        - ts_field 为 NULL 的记录：MySQL 的 ASC 排序把 NULL 排在最前，所以首轮先按 pk
+          把它们同步完（游标为 (None, pk)），之后才进入有时间戳的部分。
+          游标越过 NULL 区段后，新写入且 ts 仍为 NULL 的记录不会再被拉到，
+          要等它有了时间戳，或 reset_watermark 重新全量同步。
+        出错时抛出（由调用方决定重试），不吞异常。
+        """
+        await cls.ensure_pool()
+
+        t_sql = cls._safe_ident_mysql(table)
+        p_sql = cls._safe_ident_mysql(pk_field)
+        if ts_field:
+            u_sql = cls._safe_ident_mysql(ts_field)
+            if ts is None and pk is None:
+                where, args = "1=1", ()
+            elif ts is None:
+                # 仍在 NULL 区段：NULL 的按 pk 续页，有时间戳的全部排在其后
+                where, args = f"(({u_sql} IS NULL AND {p_sql} > %s) OR {u_sql} IS NOT NULL)", (pk,)
+            else:
+                where = f"({u_sql} > %s OR ({u_sql} = %s AND {p_sql} > %s))"
+                args = (ts, ts, pk if pk is not None else "")
+            order = f"{u_sql} ASC, {p_sql} ASC"
+        else:
+            where, args = (f"{p_sql} > %s", (pk,)) if pk is not None else ("1=1", ())
+            order = f"{p_sql} ASC"
+
+        sql = f"SELECT * FROM {t_sql} WHERE {where} ORDER BY {order} LIMIT %s"
+        conn, cur = await cls.get_conn_cursor()
+        try:
+            await cur.execute(sql, (*args, int(limit)))
+            rows = await cur.fetchall()
+            return [dict(r) for r in rows] if rows else []
+        finally:
+            await cls.release(conn, cur)
+
         
     @classmethod
     async def fetch_records_by_pks(
@@ -0,0 +1,178 @@
+# lz_mysql_pool.py  —— MySQLPool / AnanBOTPool 共用的 aiomysql 连接池管理
+"""
+取连接时不再每次 ping：
+- 连接闲置超过 MYSQL_IDLE_PING_SEC 才 ping 一次（aiomysql 自己会丢弃已 EOF / 超过 pool_recycle 的空闲连接）
+- 出过错之后的 MYSQL_SUSPECT_WINDOW 秒内，每次取连接都校验（网络抖动时尽快把坏连接筛掉）；
+  归还时连接已被 aiomysql 关掉（2006 / 2013 断线时它会自己 close）也算出错
+- 连接存活超过 MYSQL_MAX_CONN_AGE 秒直接关掉换新的
+  （建池时的 minsize 连接在 open 时记出生时间；之后新建的连接都是被取走时才建，
+   第一次取出时记即可，误差只有建连本身的时间）
+- stats() 提供使用中 / 排队 / 取连接耗时 / ping 次数等计量
+"""
+import asyncio
+import os
+import time
+from typing import Any, Dict, Optional
+
+import aiomysql
+
+
+MYSQL_IDLE_PING_SEC = float(os.getenv("MYSQL_IDLE_PING_SEC", "30"))
+MYSQL_MAX_CONN_AGE = float(os.getenv("MYSQL_MAX_CONN_AGE", "3600"))
+MYSQL_SUSPECT_WINDOW = float(os.getenv("MYSQL_SUSPECT_WINDOW", "10"))
+MYSQL_ACQUIRE_TIMEOUT = float(os.getenv("MYSQL_ACQUIRE_TIMEOUT", "20"))
+
+
+class ManagedPool:
+    """一个具名 aiomysql 池 + 按需校验。由 MySQLPoolManager.register 创建。"""
+
+    def __init__(self, name: str, **kwargs):
+        self.name = name
+        self.kwargs = kwargs
+        self.pool: Optional[aiomysql.Pool] = None
+        self._lock = asyncio.Lock()
+        self._suspect_until = 0.0
+        self._waiting = 0
+        # acquires, total_wait_sec, max_wait_sec, pings, ping_failures, recycled, errors, rebuilds
+        self._stats = [0, 0.0, 0.0, 0, 0, 0, 0, 0]
+
+    async def open(self) -> aiomysql.Pool:
+        if self.pool is not None:
+            return self.pool
+        async with self._lock:
+            if self.pool is None:
+                pool = await aiomysql.create_pool(**self.kwargs)
+                now = time.monotonic()
+                for conn in pool._free:
+                    conn._lz_born = now
+                self.pool = pool
+        return self.pool
+
+    async def close(self):
+        async with self._lock:
+            pool, self.pool = self.pool, None
+            if pool is not None:
+                pool.close()
+                await pool.wait_closed()
+
+    async def rebuild(self) -> aiomysql.Pool:
+        self._stats[7] += 1
+        async with self._lock:
+            pool, self.pool = self.pool, None
+            if pool is not None:
+                try:
+                    pool.close()
+                    await asyncio.wait_for(asyncio.shield(pool.wait_closed()), timeout=20)
+                except Exception as e:
+                    print(f"⚠️ [{self.name}] 关闭旧连接池出错(忽略): {e}", flush=True)
+        print(f"🔄 [{self.name}] 重建 MySQL 连接池中…", flush=True)
+        return await self.open()
+
+    def mark_suspect(self):
+        """调用方遇到连接类错误时调用：接下来一小段时间内取连接都先校验。"""
+        self._stats[6] += 1
+        self._suspect_until = time.monotonic() + MYSQL_SUSPECT_WINDOW
+
+    async def acquire(self, timeout: Optional[float] = None) -> aiomysql.Connection:
+        pool = await self.open()
+        timeout = MYSQL_ACQUIRE_TIMEOUT if timeout is None else timeout
+        t0 = time.perf_counter()
+        self._waiting += 1
+        try:
+            # 校验失败的连接直接关掉换下一条；池里全坏时最多换 maxsize 次
+            for _ in range(max(1, pool.maxsize) + 1):
+                conn = await asyncio.wait_for(pool.acquire(), timeout=timeout)
+                if await self._check(pool, conn):
+                    return conn
+            raise aiomysql.OperationalError(2013, f"[{self.name}] 取不到可用的 MySQL 连接")
+        finally:
+            self._waiting -= 1
+            waited = time.perf_counter() - t0
+            self._stats[0] += 1
+            self._stats[1] += waited
+            if waited > self._stats[2]:
+                self._stats[2] = waited
+
+    async def _check(self, pool: aiomysql.Pool, conn: aiomysql.Connection) -> bool:
+        now = time.monotonic()
+        born = getattr(conn, "_lz_born", None)
+        if born is None:
+            conn._lz_born = born = now
+
+        if MYSQL_MAX_CONN_AGE > 0 and now - born > MYSQL_MAX_CONN_AGE:
+            self._stats[5] += 1
+            conn.close()
+            pool.release(conn)
+            return False
+
+        idle = asyncio.get_running_loop().time() - conn.last_usage
+        if idle < MYSQL_IDLE_PING_SEC and now >= self._suspect_until:
+            return True
+
+        self._stats[3] += 1
+        try:
+            await conn.ping(reconnect=False)
+            return True
+        except Exception:
+            self._stats[4] += 1
+            self._suspect_until = now + MYSQL_SUSPECT_WINDOW
+            conn.close()
+            pool.release(conn)
+            return False
+
+    def release(self, conn: Optional[aiomysql.Connection], error: bool = False):
+        if conn is None:
+            return
+        if error or conn.closed:
+            self.mark_suspect()
+        pool = self.pool
+        # 防呆：重复释放 / 池已重建时的旧连接
+        if pool is not None and conn in pool._used:
+            pool.release(conn)
+        elif not conn.closed:
+            conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        acquires, wait_sec, max_wait, pings, ping_fail, recycled, errors, rebuilds = self._stats
+        pool = self.pool
+        return {
+            "size": pool.size if pool else 0,
+            "in_use": (pool.size - pool.freesize) if pool else 0,
+            "free": pool.freesize if pool else 0,
+            "maxsize": pool.maxsize if pool else self.kwargs.get("maxsize"),
+            "waiting": self._waiting,
+            "acquires": acquires,
+            "avg_acquire_ms": round(wait_sec / acquires * 1000, 2) if acquires else 0.0,
+            "max_acquire_ms": round(max_wait * 1000, 1),
+            "pings": pings,
+            "ping_failures": ping_fail,
+            "recycled_by_age": recycled,
+            "errors": errors,
+            "rebuilds": rebuilds,
+        }
+
+
+class MySQLPoolManager:
+    """进程内所有 aiomysql 池的登记处（@classmethod 单例）。"""
+
+    _pools: Dict[str, ManagedPool] = {}
+
+    @classmethod
+    def register(cls, name: str, **kwargs) -> ManagedPool:
+        """幂等：同名只建一个 ManagedPool（连接池本身在第一次 open / acquire 时才建）。"""
+        managed = cls._pools.get(name)
+        if managed is None:
+            managed = cls._pools[name] = ManagedPool(name, **kwargs)
+        return managed
+
+    @classmethod
+    def get(cls, name: str) -> Optional[ManagedPool]:
+        return cls._pools.get(name)
+
+    @classmethod
+    def stats(cls) -> Dict[str, Dict[str, Any]]:
+        return {name: managed.stats() for name, managed in cls._pools.items()}
+
+    @classmethod
+    async def close_all(cls):
+        await asyncio.gather(*(m.close() for m in cls._pools.values()), return_exceptions=True)
@@ -1,8 +1,12 @@
 # lz_pgsql.py  —— @classmethod 风格，接口与 lz_mysql.py 一致
 import os
 import asyncio
+import json
+import time
+from decimal import Decimal
 import asyncpg
 from typing import Optional, Dict, Any, List, Tuple
+from urllib.parse import urlparse
 import jieba
 
 from lz_config import POSTGRES_DSN,VALKEY_URL
@@ -21,6 +25,21 @@ COMMAND_TIMEOUT = float(os.getenv("POSTGRES_COMMAND_TIMEOUT", "60"))
 CONNECT_TIMEOUT = float(os.getenv("POSTGRES_CONNECT_TIMEOUT", "10"))
 CONNECT_RETRIES = int(os.getenv("POSTGRES_CONNECT_RETRIES", "2"))
 
+# upsert_records_generic：行数达到该值时改走 COPY → 临时表 → 一次合并
+UPSERT_COPY_MIN_ROWS = int(os.getenv("POSTGRES_UPSERT_COPY_MIN_ROWS", "5000"))
+
+# 预编译语句模式（按部署设定）：
+#   off    : statement_cache_size=0，每次都走未命名语句（旧行为）
+#   direct : 直连 Postgres，asyncpg 按 SQL 文本缓存命名预编译语句，重复查询免 parse / plan
+#   pooler : 前面有 PgBouncer 等事务级连接池，命名语句会跨后端失效，退回未命名语句
+#   auto   : 按 DSN 猜（端口 6432 或主机名含 pooler / pgbouncer → pooler，否则 direct）
+STATEMENT_MODE = os.getenv("POSTGRES_STATEMENT_MODE", "off").strip().lower()
+STATEMENT_CACHE_SIZE = int(os.getenv("POSTGRES_STATEMENT_CACHE_SIZE", "256"))
+# 按语句统计执行次数 / 耗时（asyncpg query logger，每次查询一次 dict 更新）；
+# 默认关闭，评估要不要开 direct 模式时再设 POSTGRES_STATEMENT_STATS=1
+STATEMENT_STATS_ENABLED = os.getenv("POSTGRES_STATEMENT_STATS", "0") == "1"
+STATEMENT_STATS_MAX = 500
+
 # （保留：若你后续在 PG 里要做中文分词/同义词替换，这里仍可复用）
 SYNONYM = {
     "滑鼠": "鼠标",
@@ -30,6 +49,145 @@ SYNONYM = {
 
 
 
+# album 成员列表缓存（get_album_list）：只缓存完整结果，sync_album_items 后主动失效
+ALBUM_CACHE_TTL = 60
+
+
+def album_cache_key(bot_name: str, content_id: int) -> str:
+    return f"album:{bot_name}:{int(content_id)}"
+
+
+def album_list_complete(rows) -> bool:
+    return bool(rows) and all(r.get("file_id") for r in rows)
+
+
+def _to_pg_text(v):
+    if isinstance(v, str):
+        return v
+    if isinstance(v, (bytes, bytearray, memoryview)):
+        # MySQL VARBINARY / BLOB 映射到 text 列：按 UTF-8 解码，解不了就报错，不写 "b'...'"
+        return bytes(v).decode("utf-8")
+    return str(v)
+
+
+def _to_pg_int(v):
+    if type(v) is int:
+        return v
+    if isinstance(v, (Decimal, float)):
+        # 只接受整数值；1.5 之类直接报错，不悄悄截断
+        if v != int(v):
+            raise ValueError(f"non-integral value {v!r} for integer column")
+        return int(v)
+    return int(v)
+
+
+def _pg_value_converter(udt_name: str):
+    """
+    MySQL 取出的值在 asyncpg 二进制编码下会被拒的几种情况（None 表示原样写入）：
+    tinyint(1) → bool、数字 / UTF-8 bytes → text/varchar、dict/list → json/jsonb、
+    整数值的 Decimal / str → 整数（有小数部分的照样报错）。
+    """
+    if udt_name == "bool":
+        return lambda v: v if isinstance(v, bool) else bool(int(v))
+    if udt_name in ("text", "varchar", "bpchar"):
+        return _to_pg_text
+    if udt_name in ("json", "jsonb"):
+        return lambda v: v if isinstance(v, str) else json.dumps(v, ensure_ascii=False, default=str)
+    if udt_name in ("int2", "int4", "int8"):
+        return _to_pg_int
+    return None
+
+
+def resolve_statement_mode(dsn: Optional[str]) -> str:
+    mode = STATEMENT_MODE
+    if mode not in ("auto", "direct", "pooler"):
+        return "off"
+    if mode != "auto":
+        return mode
+    try:
+        u = urlparse(dsn or "")
+        host = (u.hostname or "").lower()
+        port = u.port
+    except ValueError:
+        return "pooler"  # 解析不了就按最保守的来
+    if port == 6432 or "pooler" in host or "pgbouncer" in host:
+        return "pooler"
+    return "direct"
+
+
+def pool_statement_kwargs(dsn: Optional[str]) -> Dict[str, Any]:
+    """给 asyncpg.create_pool 的语句相关参数（PGPool / lz_db.DB 共用）。"""
+    mode = resolve_statement_mode(dsn)
+    PGStatementStats.mode = mode
+    kwargs: Dict[str, Any] = {
+        "statement_cache_size": STATEMENT_CACHE_SIZE if mode == "direct" else 0,
+    }
+    if STATEMENT_STATS_ENABLED:
+        kwargs["init"] = PGStatementStats.attach
+    return kwargs
+
+
+class PGStatementStats:
+    """
+    按语句（空白归一后的 SQL 文本）统计执行次数与耗时，用来判断哪些语句值得预编译。
+    进程内共享：PGPool 与 lz_db.DB 的连接都记到这里。
+    """
+
+    mode: str = "off"
+    # sql -> [calls, errors, total_sec, max_sec]
+    _stats: Dict[str, list] = {}
+    _dropped = 0
+
+    @classmethod
+    async def attach(cls, conn: asyncpg.Connection):
+        conn.add_query_logger(cls._record)
+
+    @classmethod
+    def _record(cls, record):
+        key = " ".join(record.query.split())
+        if key.startswith("SELECT pg_advisory_unlock_all()"):
+            return  # asyncpg 归还连接时的 reset，不算业务语句
+        st = cls._stats.get(key)
+        if st is None:
+            if len(cls._stats) >= STATEMENT_STATS_MAX:
+                cls._dropped += 1
+                return
+            st = cls._stats[key] = [0, 0, 0.0, 0.0]
+        st[0] += 1
+        if record.exception is not None:
+            st[1] += 1
+        st[2] += record.elapsed
+        if record.elapsed > st[3]:
+            st[3] = record.elapsed
+
+    @classmethod
+    def snapshot(cls, top: int = 20, order_by: str = "total_ms") -> dict:
+        rows = []
+        for sql, (calls, errors, total, mx) in cls._stats.items():
+            rows.append({
+                "sql": sql[:200],
+                "calls": calls,
+                "errors": errors,
+                "total_ms": round(total * 1000, 1),
+                "avg_ms": round(total * 1000 / calls, 2) if calls else 0.0,
+                "max_ms": round(mx * 1000, 1),
+            })
+        rows.sort(key=lambda r: r.get(order_by, 0), reverse=True)
+        return {
+            "mode": cls.mode,
+            "enabled": STATEMENT_STATS_ENABLED,
+            "cache_size": STATEMENT_CACHE_SIZE if cls.mode == "direct" else 0,
+            "statements": len(cls._stats),
+            "untracked": cls._dropped,
+            "top": rows[:top],
+        }
+
+    @classmethod
+    def reset(cls):
+        cls._stats = {}
+        cls._dropped = 0
+
+
 class PGPool:
     """
     参考 lz_mysql.py 的 MySQLPool 设计：
@@ -44,6 +202,8 @@ class PGPool:
     _cache_ready = False
     cache: Optional[MemoryCache] = None
     _table_columns_cache: Dict[str, set] = {}
+    _table_column_types_cache: Dict[str, Dict[str, str]] = {}
+    _upsert_stats: Dict[str, list] = {}  # table -> [calls, rows, copy_calls, total_sec, last_rows_per_sec]
 
 
     # ========= 连接池生命周期 =========
@@ -79,7 +239,7 @@ class PGPool:
                             max_inactive_connection_lifetime=300,
                             command_timeout=COMMAND_TIMEOUT,
                             timeout=CONNECT_TIMEOUT,
-                            statement_cache_size=0,
+                            **pool_statement_kwargs(POSTGRES_DSN),
                             # server_settings=None,  # ✅ 先置空
                             # 👉 把这些会话参数放到这里
                             server_settings={
@@ -88,7 +248,7 @@ class PGPool:
                             },
                         )
                        
-                        print("✅ PostgreSQL 连接池初始化完成")
+                        print(f"✅ PostgreSQL 连接池初始化完成（statement mode: {PGStatementStats.mode}）")
                         # ✅ 新增：启动时自动确保/导出/载入词库（全局幂等）
                         await ensure_and_load_lexicon_runtime(output_dir=".", export_if_missing=True)
                         break
@@ -145,7 +305,8 @@ class PGPool:
         - use_prefix=False: 仅精确删除 key 本身
 
         - MemoryCache: 无 keys() 接口，因此从内部 _store 取 key
-        - TwoLevelCache: 仅清 L1（L2 依业务需要可扩展批量删；目前保持轻量，不阻塞）
+        - TwoLevelCache: L1 + L2 都清；前缀删除走 tag 集合（不 SCAN），
+          并经 pub/sub 通知其他进程清各自的 L1
         """
         if not cls.cache:
             return
@@ -573,6 +734,27 @@ class PGPool:
           - file_extension(file_unique_id, bot, file_id)
         """
         await cls.ensure_pool()
+        if cls.cache:
+            try:
+                # 并发未命中只回源一次；只缓存每个成员都已有 file_id 的结果
+                return await cls.cache.get_or_load(
+                    album_cache_key(bot_name, content_id),
+                    lambda: cls._load_album_list(content_id, bot_name),
+                    ttl=ALBUM_CACHE_TTL,
+                    stale_ttl=ALBUM_CACHE_TTL,
+                    cache_if=album_list_complete,
+                )
+            except Exception as e:
+                print(f"⚠️ [PG] get_album_list 出错: {e}", flush=True)
+                return []
+        try:
+            return await cls._load_album_list(content_id, bot_name)
+        except Exception as e:
+            print(f"⚠️ [PG] get_album_list 出错: {e}", flush=True)
+            return []
+
+    @classmethod
+    async def _load_album_list(cls, content_id: int, bot_name: str) -> List[Dict[str, Any]]:
         conn = await cls.acquire()
         try:
             sql = """
@@ -632,9 +814,6 @@ class PGPool:
 
             return dict_rows
 
-        except Exception as e:
-            print(f"⚠️ [PG] get_album_list 出错: {e}", flush=True)
-            return []
         finally:
             await cls.release(conn)
 
@@ -1015,6 +1194,63 @@ class PGPool:
             await cls.release(conn)
 
 
+    @classmethod
+    async def search_history_redeem_ids(cls, user_id: int) -> List[int]:
+        """
+        search_history_redeem 的 id 版：只返回有序的 sora_content.id，
+        供搜索会话（db.search_sessions）使用，翻页时再按需 hydrate。
+        """
+        await cls.ensure_pool()
+        conn = await cls.acquire()
+        try:
+            rows = await conn.fetch(
+                """
+                SELECT sc.id
+                FROM "transaction" t
+                JOIN sora_content sc
+                    ON t.transaction_description = sc.source_id
+                WHERE t.sender_id = $1
+                  AND t.transaction_type = 'confirm_buy'
+                  AND sc.valid_state != 4
+                ORDER BY t.transaction_id DESC
+                """,
+                int(user_id),
+            )
+            return [int(r["id"]) for r in rows] if rows else []
+        except Exception as e:
+            print(f"⚠️ [PG] search_history_redeem_ids 出错: {e}", flush=True)
+            return []
+        finally:
+            await cls.release(conn)
+
+    @classmethod
+    async def search_history_upload_ids(cls, user_id: int) -> List[int]:
+        """
+        search_history_upload 的 id 版：只返回有序的 sora_content.id。
+        """
+        await cls.ensure_pool()
+        conn = await cls.acquire()
+        try:
+            rows = await conn.fetch(
+                """
+                SELECT sc.id
+                FROM product p
+                JOIN sora_content sc
+                    ON p.content_id = sc.id
+                WHERE p.owner_user_id = $1
+                  AND sc.valid_state != 4
+                ORDER BY sc.id DESC
+                """,
+                int(user_id),
+            )
+            return [int(r["id"]) for r in rows] if rows else []
+        except Exception as e:
+            print(f"⚠️ [PG] search_history_upload_ids 出错: {e}", flush=True)
+            return []
+        finally:
+            await cls.release(conn)
+
+
     @classmethod
     async def get_product_list(cls) -> List[Dict[str, Any]]:
         """
@@ -1276,36 +1512,32 @@ class PGPool:
         cls, user_id: int, limit: int = 50, offset: int = 0
     ) -> List[Dict[str, Any]]:
         cache_key = f"user:clt:{user_id}:{limit}:{offset}"
-        
-        if cls.cache:
-            cached = await cls.cache.get(cache_key)
-            if cached:
-                print(f"🔹 PG cache hit for {cache_key}")
-                cls.cache.set(cache_key, cached, ttl=300)
-                return cached
 
-        conn = None
+        async def _load():
+            conn = None
+            try:
+                conn = await cls.acquire()
+                rows = await conn.fetch(
+                    """
+                    SELECT id, title, description, is_public, created_at, updated_at, sort_order, cover_type, cover_file_unique_id
+                    FROM user_collection
+                    WHERE user_id = $1
+                    ORDER BY id DESC
+                    LIMIT $2 OFFSET $3
+                    """,
+                    int(user_id), int(limit), int(offset),
+                )
+                return [dict(r) for r in rows] if rows else []
+            finally:
+                await cls.release(conn)
+
         try:
-            conn = await cls.acquire()
-            rows = await conn.fetch(
-                """
-                SELECT id, title, description, is_public, created_at, updated_at, sort_order, cover_type, cover_file_unique_id
-                FROM user_collection
-                WHERE user_id = $1
-                ORDER BY id DESC
-                LIMIT $2 OFFSET $3
-                """,
-                int(user_id), int(limit), int(offset),
-            )
-            result = [dict(r) for r in rows] if rows else []
             if cls.cache:
-                cls.cache.set(cache_key, result, ttl=300)
-            return result
+                return await cls.cache.get_or_load(cache_key, _load, ttl=300)
+            return await _load()
         except Exception as e:
             print(f"⚠️ [PG] list_user_collections 出错: {e}", flush=True)
             return []
-        finally:
-            await cls.release(conn)
 
     @classmethod
     async def list_user_favorite_collections(
@@ -1316,36 +1548,34 @@ class PGPool:
         按收藏记录 id 倒序（最新收藏在前）。
         """
         cache_key = f"fav:clt:{user_id}:{limit}:{offset}"
-        if cls.cache:
-            cached = await cls.cache.get(cache_key)
-            if cached:
-                # print(f"🔹 PG MemoryCache hit for {cache_key}")
-                return cached
 
-        conn = None
+        async def _load():
+            conn = None
+            try:
+                conn = await cls.acquire()
+                rows = await conn.fetch(
+                    """
+                    SELECT uc.id, uc.title, uc.description, uc.is_public, uc.created_at
+                    FROM user_collection_favorite AS ucf
+                    JOIN user_collection AS uc
+                      ON uc.id = ucf.user_collection_id
+                    WHERE ucf.user_id = $1
+                    ORDER BY ucf.id DESC, uc.id DESC
+                    LIMIT $2 OFFSET $3
+                    """,
+                    int(user_id), int(limit), int(offset),
+                )
+                return [dict(r) for r in rows] if rows else []
+            finally:
+                await cls.release(conn)
+
         try:
-            conn = await cls.acquire()
-            rows = await conn.fetch(
-                """
-                SELECT uc.id, uc.title, uc.description, uc.is_public, uc.created_at
-                FROM user_collection_favorite AS ucf
-                JOIN user_collection AS uc
-                  ON uc.id = ucf.user_collection_id
-                WHERE ucf.user_id = $1
-                ORDER BY ucf.id DESC, uc.id DESC
-                LIMIT $2 OFFSET $3
-                """,
-                int(user_id), int(limit), int(offset),
-            )
-            result = [dict(r) for r in rows] if rows else []
             if cls.cache:
-                cls.cache.set(cache_key, result, ttl=300)
-            return result
+                return await cls.cache.get_or_load(cache_key, _load, ttl=300)
+            return await _load()
         except Exception as e:
             print(f"⚠️ [PG] list_user_favorite_collections 出错: {e}", flush=True)
             return []
-        finally:
-            await cls.release(conn)
 
     @classmethod
     async def get_collection_detail_with_cover(
@@ -1541,6 +1771,7 @@ class PGPool:
         rows: list[dict],
         *,
         chunk_size: int = 1000,
+        mode: str = "auto",
     ) -> int:
         """
         通用 UPSERT：把 MySQL 拉出来的 rows 批量写入 PostgreSQL（新增或取代）。
@@ -1552,6 +1783,10 @@ class PGPool:
             - 复合主键: ["collection_id", "content_id"]（也兼容 "a,b" 传法）
         - rows: list[dict]，每个 dict 的 key 必须是列名
         - chunk_size: executemany 分批大小（避免 payload 太大）
+        - mode:
+            - "auto": 行数 >= UPSERT_COPY_MIN_ROWS 时走 COPY，否则 executemany
+            - "copy": COPY 到临时表后一次 INSERT ... SELECT ... ON CONFLICT 合并（全表回填用）
+            - "executemany": 逐条 INSERT ... ON CONFLICT
 
         返回：写入的行数（近似 = 输入 rows 数量）。
         """
@@ -1620,28 +1855,94 @@ class PGPool:
             update_sql = ", ".join(
                 f"{cls._safe_ident_pg(c)} = EXCLUDED.{cls._safe_ident_pg(c)}" for c in update_cols
             )
-            sql = (
-                f"INSERT INTO {t_sql} ({col_sql}) VALUES ({values_sql}) "
-                f"ON CONFLICT ({conflict_sql}) DO UPDATE SET {update_sql}"
-            )
+            on_conflict = f"ON CONFLICT ({conflict_sql}) DO UPDATE SET {update_sql}"
         else:
             # 只有主键列：冲突就什么都不做
-            sql = (
-                f"INSERT INTO {t_sql} ({col_sql}) VALUES ({values_sql}) "
-                f"ON CONFLICT ({conflict_sql}) DO NOTHING"
-            )
+            on_conflict = f"ON CONFLICT ({conflict_sql}) DO NOTHING"
+        sql = f"INSERT INTO {t_sql} ({col_sql}) VALUES ({values_sql}) {on_conflict}"
+
+        # 按 PG 列类型做少量 MySQL → PG 的值修正（tinyint → bool、数字 / bytes → text、dict → json）
+        col_types = await cls._get_table_column_types(table)
+        converters = [_pg_value_converter(col_types.get(c, "")) for c in columns]
+        if any(converters):
+            def build_payload(batch: list[dict]) -> list[tuple]:
+                return [
+                    tuple(
+                        conv(v) if conv is not None and v is not None else v
+                        for conv, v in zip(converters, (r.get(c) for c in columns))
+                    )
+                    for r in batch
+                ]
+        else:
+            def build_payload(batch: list[dict]) -> list[tuple]:
+                return [tuple(r.get(c) for c in columns) for r in batch]
 
-        def build_payload(batch: list[dict]) -> list[tuple]:
-            return [tuple(r.get(c) for c in columns) for r in batch]
+        use_copy = mode == "copy" or (mode == "auto" and len(rows) >= UPSERT_COPY_MIN_ROWS)
 
+        t0 = time.perf_counter()
         total = 0
         async with cls._pool.acquire() as conn:
             async with conn.transaction():
-                for i in range(0, len(rows), int(chunk_size)):
-                    batch = rows[i : i + int(chunk_size)]
-                    await conn.executemany(sql, build_payload(batch))
-                    total += len(batch)
+                if use_copy:
+                    # COPY 进 ON COMMIT DROP 临时表，再一条 INSERT ... SELECT 合并；
+                    # 同一主键出现多次时保留最后一笔（与 executemany 逐条覆盖的结果一致）
+                    stage = cls._safe_ident_pg(f"_upsert_{table}")
+                    await conn.execute(
+                        f"CREATE TEMP TABLE {stage} (LIKE {t_sql} INCLUDING DEFAULTS) ON COMMIT DROP"
+                    )
+                    for i in range(0, len(rows), int(chunk_size) * 10):
+                        batch = rows[i : i + int(chunk_size) * 10]
+                        await conn.copy_records_to_table(
+                            f"_upsert_{table}", records=build_payload(batch), columns=columns
+                        )
+                        total += len(batch)
+                    await conn.execute(
+                        f"INSERT INTO {t_sql} ({col_sql}) "
+                        f"SELECT DISTINCT ON ({conflict_sql}) {col_sql} FROM {stage} "
+                        f"ORDER BY {conflict_sql}, ctid DESC "
+                        f"{on_conflict}"
+                    )
+                else:
+                    for i in range(0, len(rows), int(chunk_size)):
+                        batch = rows[i : i + int(chunk_size)]
+                        await conn.executemany(sql, build_payload(batch))
+                        total += len(batch)
+
+        elapsed = time.perf_counter() - t0
+        rate = total / elapsed if elapsed > 0 else 0.0
+        stat = cls._upsert_stats.setdefault(table, [0, 0, 0, 0.0, 0.0])
+        stat[0] += 1
+        stat[1] += total
+        stat[2] += 1 if use_copy else 0
+        stat[3] += elapsed
+        stat[4] = rate
+        if use_copy:
+            print(
+                f"[PG upsert_records_generic] table={table} COPY rows={total} "
+                f"{elapsed * 1000:.0f}ms ({rate:.0f} rows/s)",
+                flush=True,
+            )
         return total
+
+    @classmethod
+    def upsert_stats(cls) -> dict:
+        """每张表的 upsert 统计：调用次数、行数、走 COPY 的次数、累计耗时、最近一次 rows/s。"""
+        return {
+            table: {
+                "calls": st[0],
+                "rows": st[1],
+                "copy_calls": st[2],
+                "total_ms": round(st[3] * 1000, 1),
+                "avg_rows_per_sec": round(st[1] / st[3], 1) if st[3] else 0.0,
+                "last_rows_per_sec": round(st[4], 1),
+            }
+            for table, st in cls._upsert_stats.items()
+        }
+
+    @classmethod
+    def statement_stats(cls, top: int = 20, order_by: str = "total_ms") -> dict:
+        """按语句的执行次数 / 耗时（order_by: total_ms / calls / avg_ms / max_ms）。"""
+        return PGStatementStats.snapshot(top=top, order_by=order_by)
         
 
     @classmethod
@@ -1738,7 +2039,7 @@ class PGPool:
         async with cls._pool.acquire() as conn:
             rows = await conn.fetch(
                 """
-                SELECT DISTINCT column_name
+                SELECT DISTINCT column_name, udt_name
                 FROM information_schema.columns
                 WHERE table_name = $1
                   AND table_schema = ANY(current_schemas(false))
@@ -1747,9 +2048,18 @@ class PGPool:
             )
 
         cols = {str(r["column_name"]) for r in rows}
+        cls._table_column_types_cache[table] = {str(r["column_name"]): str(r["udt_name"]) for r in rows}
         cls._table_columns_cache[table] = cols
         return cols
 
+    @classmethod
+    async def _get_table_column_types(cls, table: str) -> Dict[str, str]:
+        """列名 → PG 类型名（udt_name，如 int8 / text / timestamptz / jsonb），与列名缓存一起加载。"""
+        table = (table or "").strip()
+        if table not in cls._table_column_types_cache:
+            await cls._get_table_columns(table)
+        return cls._table_column_types_cache.get(table, {})
+
     
     
 
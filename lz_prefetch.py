@@ -0,0 +1,231 @@
+# lz_prefetch.py  —— @classmethod 风格，与 PGPool / MySQLPool 一致
+"""
+搜索结果 / 兑换 / 上传纪录翻页时的后台预加载。
+
+- 有界队列：满了直接丢弃（不在高峰时堆 task）；排队太久的工作也丢弃
+- 去重：已在队列 / 执行中的 content_id / file_unique_id 不重复排
+- 每个用户有 token 预算（PREFETCH_USER_BUDGET 个 id / 分钟），翻得再快也只预热这么多
+- 前台优先：foreground() 包住的前台查询进行中时，worker 先让路
+- page 任务：db.hydrate_contents 预热「当前页 + 下一页」的商品详情缓存，
+  fetch_sora_rows_by_ids 预热下一页的列表行
+- media 任务（PREFETCH_MEDIA=1 才开）：缺 file_id 的资源向仓库 bot 要文件
+"""
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+
+# 默认关闭：开启后每次翻页都会在后台对 PG 多做一轮 upsert / 查询
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "0") == "1"
+PREFETCH_MEDIA = os.getenv("PREFETCH_MEDIA", "0") == "1"
+PREFETCH_WORKERS = int(os.getenv("PREFETCH_WORKERS", "2"))
+PREFETCH_QUEUE_MAX = int(os.getenv("PREFETCH_QUEUE_MAX", "64"))
+PREFETCH_USER_BUDGET = int(os.getenv("PREFETCH_USER_BUDGET", "30"))
+PREFETCH_MAX_AGE = float(os.getenv("PREFETCH_MAX_AGE", "20"))
+# 关闭时等执行中的工作收尾的秒数，超时才取消
+PREFETCH_STOP_TIMEOUT = float(os.getenv("PREFETCH_STOP_TIMEOUT", "5"))
+# 每页最多向仓库要几份文件（沿用旧逻辑 RESULTS_PER_PAGE/2 - 1 的量级）
+PREFETCH_MEDIA_PER_PAGE = int(os.getenv("PREFETCH_MEDIA_PER_PAGE", "2"))
+
+_BUDGET_WINDOW = 60.0
+
+
+class PrefetchQueue:
+    _queue: Optional[asyncio.Queue] = None
+    _workers: List[asyncio.Task] = []
+    _pending: Set[Tuple[str, object]] = set()  # 已排队 / 执行中的 (kind, id)
+    _budgets: Dict[int, Tuple[float, float]] = {}  # user_id -> (tokens, updated_at)
+    _foreground = 0
+    _idle: Optional[asyncio.Event] = None
+    _stats: Dict[str, int] = {
+        "queued": 0, "done": 0, "failed": 0, "deduped": 0,
+        "dropped_full": 0, "dropped_budget": 0, "dropped_stale": 0, "deferred": 0,
+    }
+
+    # ========= 前台优先 =========
+    @classmethod
+    @asynccontextmanager
+    async def foreground(cls):
+        """包住前台查询：进行中时预加载 worker 暂停取新工作。"""
+        cls._ensure_idle_event()
+        cls._foreground += 1
+        cls._idle.clear()
+        try:
+            yield
+        finally:
+            cls._foreground -= 1
+            if cls._foreground <= 0:
+                cls._foreground = 0
+                cls._idle.set()
+
+    @classmethod
+    def _ensure_idle_event(cls):
+        if cls._idle is None:
+            cls._idle = asyncio.Event()
+            cls._idle.set()
+
+    # ========= 入队 =========
+    @classmethod
+    def submit_page(cls, user_id: int, ids: Iterable[int]) -> int:
+        """预热这些 content_id（当前页 + 下一页）。返回实际排进队列的 id 数。"""
+        if not PREFETCH_ENABLED:
+            return 0
+        fresh = []
+        for cid in ids:
+            key = ("page", int(cid))
+            if key in cls._pending:
+                cls._stats["deduped"] += 1
+                continue
+            fresh.append(int(cid))
+        if not fresh:
+            return 0
+
+        fresh = fresh[:cls._take_budget(int(user_id or 0), len(fresh))]
+        if not fresh:
+            cls._stats["dropped_budget"] += 1
+            return 0
+        if not cls._put(("page", fresh)):
+            return 0
+        cls._pending.update(("page", cid) for cid in fresh)
+        return len(fresh)
+
+    @classmethod
+    def submit_media(cls, file_unique_id: str) -> bool:
+        key = ("media", file_unique_id)
+        if not PREFETCH_MEDIA or not file_unique_id or key in cls._pending:
+            return False
+        if not cls._put(("media", file_unique_id)):
+            return False
+        cls._pending.add(key)
+        return True
+
+    @classmethod
+    def _put(cls, job: tuple) -> bool:
+        cls._ensure_workers()
+        try:
+            cls._queue.put_nowait((time.monotonic(), job))
+        except asyncio.QueueFull:
+            cls._stats["dropped_full"] += 1
+            return False
+        cls._stats["queued"] += 1
+        return True
+
+    @classmethod
+    def _take_budget(cls, user_id: int, want: int) -> int:
+        now = time.monotonic()
+        tokens, at = cls._budgets.get(user_id, (float(PREFETCH_USER_BUDGET), now))
+        tokens = min(float(PREFETCH_USER_BUDGET), tokens + (now - at) * PREFETCH_USER_BUDGET / _BUDGET_WINDOW)
+        got = min(want, int(tokens))
+        cls._budgets[user_id] = (tokens - got, now)
+        if len(cls._budgets) > 10000:
+            # 只留最近活跃的，避免长期增长
+            cutoff = now - _BUDGET_WINDOW
+            cls._budgets = {u: v for u, v in cls._budgets.items() if v[1] >= cutoff}
+        return got
+
+    # ========= worker =========
+    @classmethod
+    def _ensure_workers(cls):
+        if cls._queue is None:
+            cls._queue = asyncio.Queue(maxsize=PREFETCH_QUEUE_MAX)
+        cls._ensure_idle_event()
+        cls._workers = [t for t in cls._workers if not t.done()]
+        while len(cls._workers) < max(1, PREFETCH_WORKERS):
+            cls._workers.append(asyncio.create_task(cls._worker(), name="prefetch"))
+
+    @classmethod
+    async def _worker(cls):
+        while True:
+            enq_at, job = await cls._queue.get()
+            try:
+                if not cls._idle.is_set():
+                    cls._stats["deferred"] += 1
+                    await cls._idle.wait()
+                if time.monotonic() - enq_at > PREFETCH_MAX_AGE:
+                    cls._stats["dropped_stale"] += 1
+                    continue
+                kind, payload = job
+                if kind == "page":
+                    await cls._run_page(payload)
+                else:
+                    await cls._run_media(payload)
+                cls._stats["done"] += 1
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                cls._stats["failed"] += 1
+                print(f"[prefetch] {job[0]} 失败: {e}", flush=True)
+            finally:
+                kind, payload = job
+                if kind == "page":
+                    cls._pending.difference_update(("page", cid) for cid in payload)
+                else:
+                    cls._pending.discard(("media", payload))
+                cls._queue.task_done()
+
+    @classmethod
+    async def _run_page(cls, ids: List[int]):
+        from lz_db import db  # 延迟引入，避免循环依赖
+
+        rows = await db.hydrate_contents(ids)
+        await db.fetch_sora_rows_by_ids(ids)
+        if not PREFETCH_MEDIA:
+            return
+        asked = 0
+        for row in rows:
+            if asked >= PREFETCH_MEDIA_PER_PAGE:
+                break
+            if not row.get("file_id") and cls.submit_media(row.get("source_id")):
+                asked += 1
+            if not row.get("thumb_file_id") and row.get("thumb_file_unique_id"):
+                cls.submit_media(row["thumb_file_unique_id"])
+
+    @classmethod
+    async def _run_media(cls, file_unique_id: str):
+        from utils.media_utils import Media
+
+        await Media.fetch_file_by_file_uid_from_x(state=None, ask_file_unique_id=file_unique_id, timeout_sec=10.0)
+
+    # ========= 观测 / 关闭 =========
+    @classmethod
+    def stats(cls) -> dict:
+        return {
+            **cls._stats,
+            "queue_depth": cls._queue.qsize() if cls._queue else 0,
+            "queue_max": PREFETCH_QUEUE_MAX,
+            "pending_ids": len(cls._pending),
+            "foreground": cls._foreground,
+            "workers": len([t for t in cls._workers if not t.done()]),
+        }
+
+    @classmethod
+    async def stop(cls, timeout: float = PREFETCH_STOP_TIMEOUT):
+        """
+        关闭：还没开始的工作直接丢弃，执行中的（如 hydrate_contents 的 upsert）
+        最多等 timeout 秒做完，之后才取消 worker。须在关闭 PG 连接池之前调用。
+        """
+        queue = cls._queue
+        if queue is not None:
+            while True:
+                try:
+                    _, (kind, payload) = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+                if kind == "page":
+                    cls._pending.difference_update(("page", cid) for cid in payload)
+                else:
+                    cls._pending.discard(("media", payload))
+                queue.task_done()
+            try:
+                await asyncio.wait_for(queue.join(), timeout=timeout)
+            except asyncio.TimeoutError:
+                print(f"[prefetch] stop: 执行中的工作 {timeout:.0f}s 内未完成，直接取消", flush=True)
+
+        workers, cls._workers = cls._workers, []
+        for t in workers:
+            t.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        cls._queue = None
+        cls._pending = set()
@@ -1,20 +1,17 @@
 # lz_redis.py
-import redis.asyncio as aioredis
 import redis.exceptions
 import json
 import os
 
+from lz_valkey import ValkeyPool
+
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379")
 
 class RedisManager:
     async def get_client(self):
-        # 每次 new Redis client，关闭连接池的 idle 保活，兼容 Render Redis KeyValue serverless
-        return aioredis.from_url(
-            REDIS_URL,
-            decode_responses=True,
-            socket_keepalive=False,
-            health_check_interval=0
-        )
+        # 进程级共享连接池（lz_valkey.ValkeyPool），不再每次 new client；
+        # keepalive / 健康检查 / 断线重试的参数在 ValkeyPool 统一设置，兼容 Render Redis KeyValue serverless
+        return ValkeyPool.get_client(REDIS_URL)
 
     async def set_json(self, key, value, ttl=300):
         client = await self.get_client()
@@ -24,8 +21,6 @@ class RedisManager:
             print(f"🔹 Redis cache set for {key}, {len(value)} items")
         except redis.exceptions.ConnectionError as e:
             print(f"⚠️ Redis SET connection error: {e} (可能是 Render Redis KeyValue cold start)")
-        finally:
-            await client.close()
 
     async def get_json(self, key):
         client = await self.get_client()
@@ -44,8 +39,32 @@ class RedisManager:
         except redis.exceptions.ConnectionError as e:
             print(f"⚠️ Redis GET connection error: {e} (可能是 Render Redis KeyValue cold start)")
             return None
-        finally:
-            await client.close()
+
+    async def set_json_many(self, items: dict, ttl=300):
+        """pipeline 批量写入多个 JSON 值（一次往返）。"""
+        try:
+            await ValkeyPool.set_many(
+                {k: json.dumps(v) for k, v in items.items()}, ttl=ttl, url=REDIS_URL
+            )
+            print(f"🔹 Redis cache set for {len(items)} keys")
+        except redis.exceptions.ConnectionError as e:
+            print(f"⚠️ Redis pipeline SET connection error: {e} (可能是 Render Redis KeyValue cold start)")
+
+    async def get_json_many(self, keys: list) -> list:
+        """MGET 批量读取多个 JSON 值，顺序与 keys 对齐，缺失 / 解析失败为 None。"""
+        try:
+            raws = await ValkeyPool.get_many(keys, url=REDIS_URL)
+        except redis.exceptions.ConnectionError as e:
+            print(f"⚠️ Redis MGET connection error: {e} (可能是 Render Redis KeyValue cold start)")
+            return [None] * len(keys)
+        result = []
+        for key, data in zip(keys, raws):
+            try:
+                result.append(json.loads(data) if data else None)
+            except json.JSONDecodeError as e:
+                print(f"⚠️ Redis GET JSON decode error for key={key}: {e}")
+                result.append(None)
+        return result
 
     async def delete(self, key):
         client = await self.get_client()
@@ -54,5 +73,10 @@ class RedisManager:
             print(f"🔹 Redis key deleted: {key}")
         except redis.exceptions.ConnectionError as e:
             print(f"⚠️ Redis DEL connection error: {e} (可能是 Render Redis KeyValue cold start)")
-        finally:
-            await client.close()
+
+    async def delete_many(self, keys: list):
+        try:
+            await ValkeyPool.delete_many(keys, url=REDIS_URL)
+            print(f"🔹 Redis keys deleted: {len(keys)}")
+        except redis.exceptions.ConnectionError as e:
+            print(f"⚠️ Redis DEL connection error: {e} (可能是 Render Redis KeyValue cold start)")
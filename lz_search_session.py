@@ -0,0 +1,93 @@
+# lz_search_session.py
+from typing import Any, Awaitable, Callable, List, Optional
+
+from lz_memory_cache import MemoryCache
+
+
+IdsLoader = Callable[[], Awaitable[List[int]]]
+
+
+class SearchSessionStore:
+    """
+    搜索会话（有序 id 列表）缓存：
+    - 每个 (kind, key_id, version) 只跑一次完整查询，保存排好序的 content id 列表
+    - 翻页时按 id 区间切片，调用方只对当前页的几个 id 做 hydrate
+    - L1: 独立的 MemoryCache（独立 TTL / 容量，不挤占通用缓存）
+    - L2: Valkey（经 TwoLevelCache，只写 L2，多进程共享）
+
+    kind 约定：
+      - "kw": 关键词搜索（key_id = search_keyword_stat.id）
+      - "fd": 我的兑换（key_id = user_id）
+      - "ul": 我的上传（key_id = user_id）
+
+    会话本身不截断：关键词搜索的上限由 search_keyword_ids(limit=3000) 决定，
+    兑换 / 上传纪录必须完整，否则后面的页会丢、总数也不对。
+    """
+
+    def __init__(
+        self,
+        l2: Any = None,
+        ttl: int = 600,
+        max_sessions: int = 500,
+        namespace: str = "ss",
+    ):
+        self.l2 = l2
+        self.ttl = int(ttl)
+        self.ns = namespace
+        # 一个 3000 个 id 的会话大约 24KB；单条上限约 3 万个 id，更长的历史纪录只放 L2
+        self.l1 = MemoryCache(max_items=max_sessions, max_value_bytes=256 * 1024)
+
+    def _key(self, kind: str, key_id: int, version: int) -> str:
+        return f"{self.ns}:{kind}:{key_id}:v{version}"
+
+    async def get_ids(
+        self,
+        kind: str,
+        key_id: int,
+        loader: IdsLoader,
+        *,
+        version: int = 1,
+        ttl: Optional[int] = None,
+    ) -> List[int]:
+        """
+        取回会话的有序 id 列表；L1 → L2 → loader（完整查询，只跑一次）。
+        空结果不缓存（例如历史纪录还在同步中），下次会重新查询。
+        """
+        ttl = int(ttl or self.ttl)
+        key = self._key(kind, key_id, version)
+
+        ids = self.l1.get(key)
+        if ids is not None:
+            return ids
+
+        async def _load() -> List[int]:
+            loaded = await loader() or []
+            return [int(x) for x in loaded if x is not None]
+
+        if self.l2 is not None:
+            # L2 未命中时：进程内 single-flight + Valkey 锁，热门关键词过期不会让
+            # 每个并发请求 / 每个进程都各跑一次 ts_rank_cd 全量查询
+            # （Valkey 不可用时 get_or_load 自行退化为仅进程内 single-flight）
+            ids = await self.l2.get_or_load(key, _load, ttl=ttl, cache_if=bool, fill_l1=False)
+        else:
+            ids = await _load()
+
+        if not isinstance(ids, list) or not ids:
+            return []
+
+        self.l1.set(key, ids, ttl=ttl)
+        return ids
+
+    @staticmethod
+    def slice_page(ids: List[int], page: int, per_page: int) -> List[int]:
+        start = max(0, int(page)) * int(per_page)
+        return ids[start:start + int(per_page)]
+
+    def invalidate(self, kind: str, key_id: int, *, version: int = 1):
+        key = self._key(kind, key_id, version)
+        self.l1.delete(key)
+        if self.l2 is not None:
+            self.l2.delete(key)
+
+    def stats(self) -> dict:
+        return {"ttl": self.ttl, **self.l1.stats()}
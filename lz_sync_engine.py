@@ -0,0 +1,298 @@
+# lz_sync_engine.py  —— @classmethod 风格，与 PGPool / MySQLPool 一致
+"""
+MySQL → PostgreSQL 常驻增量同步。
+
+- 每张表一个后台 task，按复合游标 (ts_field, pk) 翻页拉 MySQL，经 PGPool.upsert_records_generic 写 PG
+- 游标（水位）落在 PG 的 sync_watermark 表，每批写入成功后才推进；重启从上次水位继续
+- ts_field 为 NULL 的记录在首轮按 pk 先同步（见 MySQLPool.fetch_records_after_cursor）
+- 背压：一次只预取下一页，PG 写不动时不会继续往内存里堆 MySQL 结果
+- 多进程同时启用时，每张表用 Valkey 租约保证只有一个进程在跑
+- stats() / lag() 提供每张表的水位、累计行数与落后秒数
+
+独立运行：python lz_sync_engine.py
+"""
+import asyncio
+import json
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from lz_mysql import MySQLPool
+from lz_pgsql import PGPool
+from lz_valkey import ValkeyPool
+
+
+SYNC_ENGINE_ENABLED = os.getenv("SYNC_ENGINE_ENABLED", "0") == "1"
+SYNC_BATCH = int(os.getenv("SYNC_BATCH", "2000"))
+SYNC_IDLE_INTERVAL = float(os.getenv("SYNC_IDLE_INTERVAL", "5"))
+SYNC_LEASE_TTL = int(os.getenv("SYNC_LEASE_TTL", "30"))
+
+
+@dataclass
+class SyncSpec:
+    table: str
+    pk: str                          # 游标用的单列主键（PG 端 ON CONFLICT 也用它）
+    ts_field: Optional[str] = None   # 为空：append-only 表，只按 pk 递增
+    batch: int = SYNC_BATCH
+
+
+# 默认同步的表；可用环境变量 SYNC_TABLES（JSON 数组）覆盖，例如：
+# [{"table": "album_items", "pk": "id", "ts_field": "updated_at", "batch": 500}]
+DEFAULT_SYNC_TABLES: List[SyncSpec] = [
+    SyncSpec("transaction", "transaction_id"),
+    SyncSpec("album_items", "id", "updated_at"),
+    SyncSpec("user_collection", "id", "updated_at"),
+    SyncSpec("user_collection_favorite", "id", "updated_at"),
+]
+
+
+def _load_specs() -> List[SyncSpec]:
+    raw = os.getenv("SYNC_TABLES", "").strip()
+    if not raw:
+        return list(DEFAULT_SYNC_TABLES)
+    try:
+        return [SyncSpec(**item) for item in json.loads(raw)]
+    except Exception as e:
+        print(f"⚠️ SYNC_TABLES 解析失败，使用默认表: {e}", flush=True)
+        return list(DEFAULT_SYNC_TABLES)
+
+
+def _ts_age(ts: Any) -> Optional[float]:
+    """水位时间戳距今秒数（datetime 按 MySQL 服务器本地时间；整数按 epoch 秒 / 毫秒）。"""
+    if ts is None:
+        return None
+    if isinstance(ts, datetime):
+        now = datetime.now(ts.tzinfo) if ts.tzinfo else datetime.now()
+        return max(0.0, (now - ts).total_seconds())
+    try:
+        v = float(ts)
+    except (TypeError, ValueError):
+        return None
+    if v > 1e12:
+        v /= 1000.0
+    return max(0.0, time.time() - v)
+
+
+class SyncEngine:
+    specs: List[SyncSpec] = _load_specs()
+    _tasks: Dict[str, asyncio.Task] = {}
+    _state: Dict[str, Dict[str, Any]] = {}
+    _token = uuid.uuid4().hex
+    _table_ready = False
+
+    # ========= 生命周期 =========
+    @classmethod
+    def covers(cls, table: str) -> bool:
+        """该表是否由常驻同步负责（页面据此跳过临时的追赶同步）。"""
+        return SYNC_ENGINE_ENABLED and any(s.table == table for s in cls.specs)
+
+    @classmethod
+    async def start(cls):
+        """幂等：为每张表启动一个同步 task。"""
+        await asyncio.gather(MySQLPool.init_pool(), PGPool.init_pool())
+        await cls.ensure_table()
+        for spec in cls.specs:
+            task = cls._tasks.get(spec.table)
+            if task is None or task.done():
+                cls._tasks[spec.table] = asyncio.create_task(cls._run_table(spec), name=f"sync:{spec.table}")
+        print(f"✅ SyncEngine 已启动: {[s.table for s in cls.specs]}", flush=True)
+
+    @classmethod
+    async def stop(cls):
+        tasks, cls._tasks = cls._tasks, {}
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        for spec in cls.specs:
+            await cls._release_lease(spec.table)
+
+    # ========= 水位 =========
+    @classmethod
+    async def ensure_table(cls):
+        if cls._table_ready:
+            return
+        await PGPool.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sync_watermark (
+                table_name  TEXT        PRIMARY KEY,
+                ts_value    TEXT        NULL,
+                last_pk     TEXT        NULL,
+                rows_synced BIGINT      NOT NULL DEFAULT 0,
+                updated_at  TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            )
+            """
+        )
+        cls._table_ready = True
+
+    @classmethod
+    async def load_watermark(cls, table: str) -> Dict[str, Any]:
+        row = await PGPool.fetchrow(
+            "SELECT ts_value, last_pk, rows_synced FROM sync_watermark WHERE table_name = $1", table
+        )
+        return row or {"ts_value": None, "last_pk": None, "rows_synced": 0}
+
+    @classmethod
+    async def save_watermark(cls, table: str, ts: Any, pk: Any, rows: int):
+        # 以文本保存：MySQL 比较 DATETIME / INT 列时会自动转换
+        await PGPool.execute(
+            """
+            INSERT INTO sync_watermark (table_name, ts_value, last_pk, rows_synced, updated_at)
+            VALUES ($1, $2, $3, $4, NOW())
+            ON CONFLICT (table_name) DO UPDATE SET
+                ts_value    = EXCLUDED.ts_value,
+                last_pk     = EXCLUDED.last_pk,
+                rows_synced = sync_watermark.rows_synced + EXCLUDED.rows_synced,
+                updated_at  = NOW()
+            """,
+            table,
+            None if ts is None else str(ts),
+            None if pk is None else str(pk),
+            int(rows),
+        )
+
+    @classmethod
+    async def reset_watermark(cls, table: str):
+        """从头重新同步某张表（下一轮生效）。"""
+        await PGPool.execute("DELETE FROM sync_watermark WHERE table_name = $1", table)
+
+    # ========= 租约（多进程只跑一个）=========
+    @classmethod
+    async def _hold_lease(cls, table: str) -> bool:
+        key = f"sync:lease:{table}"
+        try:
+            r = ValkeyPool.get_client()
+            if await r.set(key, cls._token, nx=True, ex=SYNC_LEASE_TTL):
+                return True
+            if await r.get(key) == cls._token:
+                await r.expire(key, SYNC_LEASE_TTL)
+                return True
+            return False
+        except Exception as e:
+            # Valkey 不可用时照常同步（upsert 幂等，重复跑只是浪费）
+            print(f"⚠️ SyncEngine lease 检查失败 table={table}: {e}", flush=True)
+            return True
+
+    @classmethod
+    async def _release_lease(cls, table: str):
+        try:
+            r = ValkeyPool.get_client()
+            key = f"sync:lease:{table}"
+            if await r.get(key) == cls._token:
+                await r.delete(key)
+        except Exception:
+            pass
+
+    # ========= 主循环 =========
+    @classmethod
+    async def _fetch(cls, spec: SyncSpec, ts: Any, pk: Any) -> List[dict]:
+        return await MySQLPool.fetch_records_after_cursor(
+            spec.table, spec.ts_field, spec.pk, ts, pk, limit=spec.batch
+        )
+
+    @classmethod
+    async def _run_table(cls, spec: SyncSpec):
+        state = cls._state.setdefault(spec.table, {
+            "rows": 0, "batches": 0, "errors": 0, "last_error": None,
+            "last_batch_ms": 0.0, "caught_up": False, "ts": None, "pk": None,
+            "owner": False, "last_sync_at": None,
+        })
+        delay = 1.0
+        while True:
+            prefetch: Optional[asyncio.Task] = None
+            try:
+                state["owner"] = await cls._hold_lease(spec.table)
+                if not state["owner"]:
+                    await asyncio.sleep(SYNC_LEASE_TTL / 2)
+                    continue
+
+                # 每轮都从已落盘的水位出发：上一轮失败时自动回到最后成功的位置
+                mark = await cls.load_watermark(spec.table)
+                ts, pk = mark["ts_value"], mark["last_pk"]
+                state["ts"], state["pk"] = ts, pk
+
+                prefetch = asyncio.create_task(cls._fetch(spec, ts, pk))
+                while True:
+                    rows = await prefetch
+                    prefetch = None
+                    if not rows:
+                        state["caught_up"] = True
+                        break
+
+                    last = rows[-1]
+                    ts = last.get(spec.ts_field) if spec.ts_field else None
+                    pk = last.get(spec.pk)
+                    full = len(rows) >= spec.batch
+                    # 写 PG 的同时预取下一页（最多领先一页 = 背压）
+                    if full:
+                        prefetch = asyncio.create_task(cls._fetch(spec, ts, pk))
+
+                    t0 = time.perf_counter()
+                    await PGPool.upsert_records_generic(spec.table, spec.pk, rows)
+                    await cls.save_watermark(spec.table, ts, pk, len(rows))
+                    state["last_batch_ms"] = round((time.perf_counter() - t0) * 1000, 1)
+                    state["rows"] += len(rows)
+                    state["batches"] += 1
+                    state["ts"], state["pk"] = ts, pk
+                    state["last_sync_at"] = time.time()
+                    state["caught_up"] = not full
+                    if not full:
+                        break
+                    # 长时间追赶时续租，避免租约过期被别的进程接手
+                    await cls._hold_lease(spec.table)
+
+                delay = 1.0
+                await asyncio.sleep(SYNC_IDLE_INTERVAL)
+            except asyncio.CancelledError:
+                if prefetch is not None:
+                    prefetch.cancel()
+                raise
+            except Exception as e:
+                if prefetch is not None:
+                    prefetch.cancel()
+                state["errors"] += 1
+                state["last_error"] = str(e)
+                print(f"⚠️ SyncEngine table={spec.table} 同步失败，{delay:.0f}s 后重试: {e}", flush=True)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 60)
+
+    # ========= 观测 =========
+    @classmethod
+    def lag(cls, table: str) -> Optional[float]:
+        """落后秒数：已追平为 0；否则为水位时间戳距今的秒数（无时间列的表为 None）。"""
+        state = cls._state.get(table)
+        if not state:
+            return None
+        if state["caught_up"]:
+            return 0.0
+        return _ts_age(state["ts"])
+
+    @classmethod
+    def stats(cls) -> Dict[str, Dict[str, Any]]:
+        out = {}
+        for spec in cls.specs:
+            state = cls._state.get(spec.table) or {}
+            out[spec.table] = {
+                **{k: v for k, v in state.items() if k not in ("ts", "pk")},
+                "watermark": [None if state.get("ts") is None else str(state["ts"]), state.get("pk")],
+                "lag_seconds": cls.lag(spec.table),
+                "running": spec.table in cls._tasks and not cls._tasks[spec.table].done(),
+            }
+        return out
+
+
+async def main():
+    await SyncEngine.start()
+    try:
+        while True:
+            await asyncio.sleep(60)
+            print(f"[SyncEngine] {SyncEngine.stats()}", flush=True)
+    finally:
+        await SyncEngine.stop()
+        await asyncio.gather(MySQLPool.close(), PGPool.close(), ValkeyPool.close(), return_exceptions=True)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
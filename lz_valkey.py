@@ -0,0 +1,159 @@
+# lz_valkey.py  —— @classmethod 风格，与 PGPool / MySQLPool 一致
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import redis.asyncio as redis_async
+import redis.exceptions
+from redis.asyncio.retry import Retry
+from redis.backoff import ExponentialBackoff
+
+from lz_config import VALKEY_URL
+
+
+# ====== 连接池参数（支持环境变量覆盖）======
+MAX_CONNECTIONS = int(os.getenv("VALKEY_MAX_CONNECTIONS", "20"))
+CONNECT_TIMEOUT = float(os.getenv("VALKEY_CONNECT_TIMEOUT", "5"))
+SOCKET_TIMEOUT = float(os.getenv("VALKEY_SOCKET_TIMEOUT", "5"))
+# Render KeyValue 是 serverless：默认关闭 keepalive / 健康检查，断线交给 Retry 重连
+HEALTH_CHECK_INTERVAL = int(os.getenv("VALKEY_HEALTH_CHECK_INTERVAL", "0"))
+SOCKET_KEEPALIVE = os.getenv("VALKEY_SOCKET_KEEPALIVE", "0") == "1"
+RETRIES = int(os.getenv("VALKEY_RETRIES", "3"))
+
+
+class _InstrumentedRedis(redis_async.Redis):
+    """每条命令计时，统计写回 ValkeyPool。"""
+
+    async def execute_command(self, *args, **options):
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            result = await super().execute_command(*args, **options)
+            ok = True
+            return result
+        finally:
+            name = str(args[0]).upper() if args else "?"
+            ValkeyPool._record(name, time.perf_counter() - t0, ok)
+
+
+class ValkeyPool:
+    """
+    进程级 Valkey 连接池管理：
+    - 同一个 URL（+ decode_responses）只建一个 ConnectionPool / client，所有模块共用
+    - 断线 / 超时自动按指数回退重试重连（冷启动不会每次都重建 TCP）
+    - 提供 pipeline 批量 get / set / delete
+    - 记录每种命令的次数、错误数与耗时，stats() 查看
+    """
+
+    _clients: Dict[Tuple[str, bool], redis_async.Redis] = {}
+    _latency: Dict[str, List[float]] = {}  # cmd -> [count, errors, total_sec, max_sec]
+
+    # ========= 连接池生命周期 =========
+    @classmethod
+    def get_client(cls, url: Optional[str] = None, decode_responses: bool = True) -> redis_async.Redis:
+        """
+        取得共享 client（同步调用即可；真正的连接在第一条命令时才建立）。
+        """
+        url = url or VALKEY_URL
+        key = (url, bool(decode_responses))
+        client = cls._clients.get(key)
+        if client is not None:
+            return client
+
+        pool = redis_async.ConnectionPool.from_url(
+            url,
+            decode_responses=decode_responses,
+            max_connections=MAX_CONNECTIONS,
+            socket_connect_timeout=CONNECT_TIMEOUT,
+            socket_timeout=SOCKET_TIMEOUT,
+            socket_keepalive=SOCKET_KEEPALIVE,
+            health_check_interval=HEALTH_CHECK_INTERVAL,
+            retry=Retry(ExponentialBackoff(cap=1.0, base=0.05), RETRIES),
+            retry_on_error=[redis.exceptions.ConnectionError, redis.exceptions.TimeoutError],
+        )
+        client = _InstrumentedRedis(connection_pool=pool)
+        cls._clients[key] = client
+        return client
+
+    @classmethod
+    async def close(cls):
+        clients, cls._clients = cls._clients, {}
+        for client in clients.values():
+            try:
+                await client.aclose() if hasattr(client, "aclose") else await client.close()
+                await client.connection_pool.disconnect()
+            except Exception as e:
+                print(f"⚠️ ValkeyPool close error: {e}", flush=True)
+        if clients:
+            print("🛑 Valkey 连接池已关闭")
+
+    # ========= pipeline 批量操作 =========
+    @classmethod
+    async def get_many(cls, keys: List[str], url: Optional[str] = None, decode_responses: bool = True) -> List[Any]:
+        """MGET：一次往返取回多个 key，顺序与 keys 对齐，缺失为 None。"""
+        if not keys:
+            return []
+        return await cls.get_client(url, decode_responses).mget(keys)
+
+    @classmethod
+    async def set_many(
+        cls,
+        items: Dict[str, Any],
+        ttl: Optional[int] = None,
+        url: Optional[str] = None,
+        decode_responses: bool = True,
+    ) -> None:
+        """pipeline SET（可带 EX）：一次往返写入多个 key。"""
+        if not items:
+            return
+        client = cls.get_client(url, decode_responses)
+        t0 = time.perf_counter()
+        ok = False
+        try:
+            async with client.pipeline(transaction=False) as pipe:
+                for k, v in items.items():
+                    if ttl:
+                        pipe.set(k, v, ex=int(ttl))
+                    else:
+                        pipe.set(k, v)
+                await pipe.execute()
+            ok = True
+        finally:
+            cls._record("PIPELINE_SET", time.perf_counter() - t0, ok)
+
+    @classmethod
+    async def delete_many(cls, keys: Iterable[str], url: Optional[str] = None) -> int:
+        """UNLINK 多个 key（非阻塞删除），返回删除数量。"""
+        keys = list(keys)
+        if not keys:
+            return 0
+        return int(await cls.get_client(url).unlink(*keys) or 0)
+
+    # ========= 统计 =========
+    @classmethod
+    def _record(cls, cmd: str, elapsed: float, ok: bool):
+        stat = cls._latency.get(cmd)
+        if stat is None:
+            stat = cls._latency[cmd] = [0, 0, 0.0, 0.0]
+        stat[0] += 1
+        if not ok:
+            stat[1] += 1
+        stat[2] += elapsed
+        if elapsed > stat[3]:
+            stat[3] = elapsed
+
+    @classmethod
+    def stats(cls) -> dict:
+        commands = {}
+        for cmd, (count, errors, total, peak) in cls._latency.items():
+            commands[cmd] = {
+                "count": count,
+                "errors": errors,
+                "avg_ms": round(total * 1000 / count, 3) if count else 0.0,
+                "max_ms": round(peak * 1000, 3),
+            }
+        return {"clients": len(cls._clients), "commands": commands}
+
+    @classmethod
+    def reset_stats(cls):
+        cls._latency = {}
@@ -1,11 +1,34 @@
 # pg_stats_db.py
 import asyncpg
 import asyncio
+import os
+import re
+import time
+from datetime import date, datetime, timedelta, timezone
 from typing import Any, Dict, List,Optional  # ⬅ 新增
 from typing import Iterable
 import json
 
 
+# thumbnail_task 新增时 pg_notify 的频道（ensure_table 里建触发器）
+THUMB_TASK_CHANNEL = "thumbnail_task"
+
+# tg_group_messages_raw 按 stat_date 分区（每天一个分区）
+RAW_TABLE = "tg_group_messages_raw"
+RAW_LEGACY_TABLE = "tg_group_messages_raw_legacy"
+# 提前建好未来几天的分区
+RAW_PREMAKE_DAYS = int(os.getenv("RAW_MSG_PREMAKE_DAYS", "3"))
+# 保留天数；0 = 不自动 detach。超过的分区从父表 detach（RAW_MSG_DROP_DETACHED=1 时顺便 DROP）
+RAW_RETENTION_DAYS = int(os.getenv("RAW_MSG_RETENTION_DAYS", "0"))
+RAW_DROP_DETACHED = os.getenv("RAW_MSG_DROP_DETACHED", "0") == "1"
+
+_BOUND_RE = re.compile(r"FROM \((?:'([0-9-]+)'|MINVALUE)\) TO \((?:'([0-9-]+)'|MAXVALUE)\)")
+
+
+def _local_today() -> date:
+    """与 stat_date 同口径（UTC+8）的今天。"""
+    return (datetime.now(timezone.utc) + timedelta(hours=8)).date()
+
 
 class PGStatsDB:
     """
@@ -17,6 +40,11 @@ class PGStatsDB:
     pool: asyncpg.Pool | None = None
     _lock = asyncio.Lock()
     _offline_tx_table_inited: bool = False 
+    # 批量写入统计：table -> [flushes, rows, errors, total_sec, last_sec]
+    _ingest_stats: Dict[str, list] = {}
+    # raw 表分区：分区名 -> (下界, 上界)，None 表示 MINVALUE / MAXVALUE
+    _raw_partitions: Dict[str, tuple] = {}
+    _raw_maintained_on: Optional[date] = None
 
     @classmethod
     async def init_pool(cls, dsn: str, min_size: int = 1, max_size: int = 5):
@@ -83,34 +111,7 @@ class PGStatsDB:
             );
             """,
 
-            # 3) 群消息 raw 表（BERTopic 用）
-            """
-            CREATE TABLE IF NOT EXISTS tg_group_messages_raw (
-                chat_id      BIGINT      NOT NULL,
-                thread_id    BIGINT      NOT NULL DEFAULT 0,
-                message_id   BIGINT      NOT NULL,
-                user_id      BIGINT      NOT NULL,
-                from_bot     BOOLEAN     NOT NULL DEFAULT FALSE,
-                msg_time_utc TIMESTAMPTZ NOT NULL,
-                stat_date    DATE        NOT NULL,
-                hour         SMALLINT    NOT NULL,
-                text         TEXT        NOT NULL,
-
-                topic_id     INTEGER     NULL,
-                topic_ver    INTEGER     NOT NULL DEFAULT 1,
-                topic_at     TIMESTAMPTZ NULL,
-
-                PRIMARY KEY (chat_id, message_id)
-            );
-            """,
-            """
-            CREATE INDEX IF NOT EXISTS idx_raw_chat_date_hour
-            ON tg_group_messages_raw (chat_id, stat_date, hour);
-            """,
-            """
-            CREATE INDEX IF NOT EXISTS idx_raw_topic_lookup
-            ON tg_group_messages_raw (chat_id, stat_date, hour, topic_id);
-            """,
+            # 3) 群消息 raw 表（BERTopic 用）：按 stat_date 分区，见 _ensure_raw_table
 
             # 4) 每小时话题摘要表
             """
@@ -181,6 +182,23 @@ class PGStatsDB:
             CREATE INDEX IF NOT EXISTS idx_thumb_bot_status
             ON thumbnail_task (assigned_bot_name, status, updated_at);
             """,
+            # 新任务入库即 NOTIFY，派工端不用轮询
+            f"""
+            CREATE OR REPLACE FUNCTION thumbnail_task_notify() RETURNS trigger AS $$
+            BEGIN
+                PERFORM pg_notify('{THUMB_TASK_CHANNEL}', NEW.id::text);
+                RETURN NEW;
+            END;
+            $$ LANGUAGE plpgsql;
+            """,
+            """
+            DROP TRIGGER IF EXISTS trg_thumbnail_task_notify ON thumbnail_task;
+            """,
+            """
+            CREATE TRIGGER trg_thumbnail_task_notify
+            AFTER INSERT ON thumbnail_task
+            FOR EACH ROW EXECUTE FUNCTION thumbnail_task_notify();
+            """,
             """
             CREATE TABLE IF NOT EXISTS board (
                 board_id integer NOT NULL GENERATED BY DEFAULT AS IDENTITY,
@@ -225,44 +243,256 @@ class PGStatsDB:
             async with cls.pool.acquire() as conn:
                 for ddl in ddls:
                     await conn.execute(ddl)
+                await cls._ensure_raw_table(conn)
 
+        await cls.maintain_raw_partitions()
 
 
 
+
+    # ================== 群消息 raw 表分区 ==================
+
     @classmethod
-    async def upsert_daily_counts(cls, items: list[tuple[tuple, int]]):
+    async def _ensure_raw_table(cls, conn: asyncpg.Connection):
         """
-        items:
-          [ ((stat_date,user_id,chat_id,thread_id,msg_type,from_bot,hour), cnt), ... ]
+        建分区父表；若库里还是旧的普通表：
+          改名为 tg_group_messages_raw_legacy，作为 [MINVALUE, 最大 stat_date + 1) 的分区挂回父表，
+          历史数据不搬动，之后的日期按天建新分区。
+        多进程同时启动时用 advisory lock 串行。
         """
-        if not items:
-            return
-       
-        sql = """
-        INSERT INTO tg_msg_stats_daily
-            (stat_date, user_id, chat_id, thread_id, msg_type, from_bot, hour, cnt)
-        VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
-        ON CONFLICT (
-            stat_date, user_id, chat_id, thread_id,
-            msg_type, from_bot, hour
+        async with conn.transaction():
+            await conn.execute(f"SELECT pg_advisory_xact_lock(hashtext('{RAW_TABLE}'))")
+            kind = await conn.fetchval(
+                "SELECT relkind::text FROM pg_class WHERE oid = to_regclass($1)", RAW_TABLE
+            )
+            legacy_upper = None
+            if kind == "r":
+                legacy_upper = await conn.fetchval(f"SELECT MAX(stat_date) FROM {RAW_TABLE}")
+                legacy_upper = legacy_upper + timedelta(days=1) if legacy_upper else _local_today()
+                # 旧主键 (chat_id, message_id) 不含分区键，挂载时由父表主键重建；索引改名让出名字
+                await conn.execute(f"ALTER TABLE {RAW_TABLE} RENAME TO {RAW_LEGACY_TABLE}")
+                await conn.execute(f"ALTER TABLE {RAW_LEGACY_TABLE} DROP CONSTRAINT IF EXISTS {RAW_TABLE}_pkey")
+                await conn.execute(f"ALTER TABLE {RAW_LEGACY_TABLE} ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMPTZ NULL")
+                await conn.execute("ALTER INDEX IF EXISTS idx_raw_chat_date_hour RENAME TO idx_raw_legacy_chat_date_hour")
+                await conn.execute("ALTER INDEX IF EXISTS idx_raw_topic_lookup RENAME TO idx_raw_legacy_topic_lookup")
+
+            await conn.execute(
+                f"""
+                CREATE TABLE IF NOT EXISTS {RAW_TABLE} (
+                    chat_id      BIGINT      NOT NULL,
+                    thread_id    BIGINT      NOT NULL DEFAULT 0,
+                    message_id   BIGINT      NOT NULL,
+                    user_id      BIGINT      NOT NULL,
+                    from_bot     BOOLEAN     NOT NULL DEFAULT FALSE,
+                    msg_time_utc TIMESTAMPTZ NOT NULL,
+                    stat_date    DATE        NOT NULL,
+                    hour         SMALLINT    NOT NULL,
+                    text         TEXT        NOT NULL,
+
+                    topic_id     INTEGER     NULL,
+                    topic_ver    INTEGER     NOT NULL DEFAULT 1,
+                    topic_at     TIMESTAMPTZ NULL,
+                    deleted_at   TIMESTAMPTZ NULL,
+
+                    -- 分区表的主键必须包含分区键；编辑消息的 msg.date 不变，stat_date 也不变
+                    PRIMARY KEY (chat_id, message_id, stat_date)
+                ) PARTITION BY RANGE (stat_date)
+                """
+            )
+            await conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_raw_chat_date_hour ON {RAW_TABLE} (chat_id, stat_date, hour)"
+            )
+            await conn.execute(
+                f"CREATE INDEX IF NOT EXISTS idx_raw_topic_lookup ON {RAW_TABLE} (chat_id, stat_date, hour, topic_id)"
+            )
+            if legacy_upper is not None:
+                await conn.execute(
+                    f"ALTER TABLE {RAW_TABLE} ATTACH PARTITION {RAW_LEGACY_TABLE} "
+                    f"FOR VALUES FROM (MINVALUE) TO ('{legacy_upper.isoformat()}')"
+                )
+                print(f"✅ {RAW_TABLE} 已转为分区表，旧数据挂为 {RAW_LEGACY_TABLE}（< {legacy_upper}）", flush=True)
+
+        await cls._load_raw_partitions(conn)
+
+    @classmethod
+    async def _load_raw_partitions(cls, conn: asyncpg.Connection):
+        rows = await conn.fetch(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) AS bound
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass($1)
+            """,
+            RAW_TABLE,
         )
-        DO UPDATE SET cnt = tg_msg_stats_daily.cnt + EXCLUDED.cnt;
+        parts = {}
+        for r in rows:
+            m = _BOUND_RE.search(r["bound"] or "")
+            if not m:
+                continue
+            lo, hi = m.groups()
+            parts[r["relname"]] = (
+                date.fromisoformat(lo) if lo else None,
+                date.fromisoformat(hi) if hi else None,
+            )
+        cls._raw_partitions = parts
+
+    @classmethod
+    def _raw_partition_for(cls, d: date) -> Optional[str]:
+        for name, (lo, hi) in cls._raw_partitions.items():
+            if (lo is None or lo <= d) and (hi is None or d < hi):
+                return name
+        return None
+
+    @classmethod
+    async def ensure_raw_partitions(cls, dates: Iterable[date]):
+        """确保这些 stat_date 都有分区（已覆盖的直接跳过，只查本地缓存）。"""
+        missing = sorted({d for d in dates if cls._raw_partition_for(d) is None})
+        if not missing:
+            return
+        if cls.pool is None:
+            raise RuntimeError("PGStatsDB.pool 尚未初始化，请先调用 init_pool()")
+        async with cls.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(f"SELECT pg_advisory_xact_lock(hashtext('{RAW_TABLE}'))")
+                await cls._load_raw_partitions(conn)  # 别的进程可能刚建过
+                for d in missing:
+                    if cls._raw_partition_for(d) is not None:
+                        continue
+                    name = f"{RAW_TABLE}_p{d:%Y%m%d}"
+                    await conn.execute(
+                        f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {RAW_TABLE} "
+                        f"FOR VALUES FROM ('{d.isoformat()}') TO ('{(d + timedelta(days=1)).isoformat()}')"
+                    )
+                    cls._raw_partitions[name] = (d, d + timedelta(days=1))
+
+    @classmethod
+    async def detach_raw_partitions(cls, before: date, drop: bool = False) -> List[str]:
+        """
+        retention：把上界 <= before 的分区从父表 detach（可选 DROP）。
+        detach 出来的表保持原名，可另行归档 / 导出。返回处理的分区名。
         """
+        if cls.pool is None:
+            raise RuntimeError("PGStatsDB.pool 尚未初始化，请先调用 init_pool()")
+        done = []
+        async with cls.pool.acquire() as conn:
+            await cls._load_raw_partitions(conn)
+            for name, (lo, hi) in sorted(cls._raw_partitions.items(), key=lambda kv: kv[1][1] or date.max):
+                if hi is None or hi > before:
+                    continue
+                async with conn.transaction():
+                    await conn.execute(f"ALTER TABLE {RAW_TABLE} DETACH PARTITION {name}")
+                    if drop:
+                        await conn.execute(f"DROP TABLE IF EXISTS {name}")
+                cls._raw_partitions.pop(name, None)
+                done.append(name)
+        if done:
+            print(f"🧹 {RAW_TABLE} {'drop' if drop else 'detach'} 分区: {done}", flush=True)
+        return done
 
-        async with cls._lock:
+    @classmethod
+    async def maintain_raw_partitions(cls):
+        """每天一次：预建 [昨天, 今天 + RAW_PREMAKE_DAYS] 的分区，并按 RAW_RETENTION_DAYS 清理旧分区。"""
+        today = _local_today()
+        if cls._raw_maintained_on == today:
+            return
+        await cls.ensure_raw_partitions(today + timedelta(days=i) for i in range(-1, RAW_PREMAKE_DAYS + 1))
+        if RAW_RETENTION_DAYS > 0:
+            await cls.detach_raw_partitions(today - timedelta(days=RAW_RETENTION_DAYS), drop=RAW_DROP_DETACHED)
+        cls._raw_maintained_on = today
+
+    # ================== 批量写入（COPY → 临时表 → 一次 merge）==================
+
+    @classmethod
+    async def _copy_merge(
+        cls,
+        table: str,
+        columns: List[str],
+        records: List[tuple],
+        merge_sql: str,
+    ) -> int:
+        """
+        在一个事务里：
+          1) 建 ON COMMIT DROP 的临时表（结构同目标表）
+          2) COPY 全部 records 进临时表（一次往返）
+          3) 执行 merge_sql（INSERT ... SELECT ... FROM {stage} ON CONFLICT ...）
+        merge_sql 里用 {stage} 引用临时表。返回写入行数，并记录耗时统计。
+        """
+        if not records:
+            return 0
+        if cls.pool is None:
+            raise RuntimeError("PGStatsDB.pool 尚未初始化，请先调用 init_pool()")
+
+        stage = f"_stage_{table}"
+        t0 = time.perf_counter()
+        ok = False
+        try:
             async with cls.pool.acquire() as conn:
                 async with conn.transaction():
-                    for (key, c) in items:
-                        (
-                            stat_date, user_id, chat_id,
-                            thread_id, msg_type, from_bot, hour
-                        ) = key
+                    await conn.execute(
+                        f"CREATE TEMP TABLE {stage} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"
+                    )
+                    await conn.copy_records_to_table(stage, records=records, columns=columns)
+                    await conn.execute(merge_sql.format(stage=stage))
+            ok = True
+            return len(records)
+        finally:
+            elapsed = time.perf_counter() - t0
+            stat = cls._ingest_stats.setdefault(table, [0, 0, 0, 0.0, 0.0])
+            stat[0] += 1
+            if ok:
+                stat[1] += len(records)
+            else:
+                stat[2] += 1
+            stat[3] += elapsed
+            stat[4] = elapsed
 
-                        await conn.execute(
-                            sql,
-                            stat_date, user_id, chat_id,
-                            thread_id, msg_type, from_bot, hour, c
-                        )
+    @classmethod
+    def ingest_stats(cls) -> dict:
+        out = {}
+        for table, (flushes, rows, errors, total, last) in cls._ingest_stats.items():
+            out[table] = {
+                "flushes": flushes,
+                "rows": rows,
+                "errors": errors,
+                "last_ms": round(last * 1000, 1),
+                "avg_ms": round(total * 1000 / flushes, 1) if flushes else 0.0,
+                "rows_per_sec": round(rows / total, 1) if total else 0.0,
+            }
+        return out
+
+    @classmethod
+    async def upsert_daily_counts(cls, items: list[tuple[tuple, int]]):
+        """
+        items:
+          [ ((stat_date,user_id,chat_id,thread_id,msg_type,from_bot,hour), cnt), ... ]
+
+        COPY 进临时表后一次 merge；同一批内重复的 key 先 SUM 再累加。
+        """
+        if not items:
+            return 0
+
+        records = [
+            (stat_date, int(user_id), int(chat_id), int(thread_id), msg_type, bool(from_bot), int(hour), int(c))
+            for (stat_date, user_id, chat_id, thread_id, msg_type, from_bot, hour), c in items
+        ]
+        return await cls._copy_merge(
+            "tg_msg_stats_daily",
+            ["stat_date", "user_id", "chat_id", "thread_id", "msg_type", "from_bot", "hour", "cnt"],
+            records,
+            """
+            INSERT INTO tg_msg_stats_daily
+                (stat_date, user_id, chat_id, thread_id, msg_type, from_bot, hour, cnt)
+            SELECT stat_date, user_id, chat_id, thread_id, msg_type, from_bot, hour, SUM(cnt)
+            FROM {stage}
+            GROUP BY stat_date, user_id, chat_id, thread_id, msg_type, from_bot, hour
+            ON CONFLICT (
+                stat_date, user_id, chat_id, thread_id,
+                msg_type, from_bot, hour
+            )
+            DO UPDATE SET cnt = tg_msg_stats_daily.cnt + EXCLUDED.cnt;
+            """,
+        )
 
     # ================== 离线交易队列表 ==================
 
@@ -690,43 +920,56 @@ class PGStatsDB:
         ]
         """
         if not rows:
-            return
-
-        sql = """
-        INSERT INTO tg_group_messages_raw
-            (chat_id, thread_id, message_id, user_id, from_bot,
-             msg_time_utc, stat_date, hour, text)
-        VALUES
-            ($1,$2,$3,$4,$5,$6,$7,$8,$9)
-        ON CONFLICT (chat_id, message_id)
-        DO UPDATE SET
-            thread_id    = EXCLUDED.thread_id,
-            user_id      = EXCLUDED.user_id,
-            from_bot     = EXCLUDED.from_bot,
-            msg_time_utc = EXCLUDED.msg_time_utc,
-            stat_date    = EXCLUDED.stat_date,
-            hour         = EXCLUDED.hour,
-            text         = EXCLUDED.text;
-        """
+            return 0
 
-        async with cls._lock:
-            if cls.pool is None:
-                raise RuntimeError("PGStatsDB.pool 尚未初始化，请先调用 init_pool()")
-            async with cls.pool.acquire() as conn:
-                async with conn.transaction():
-                    for r in rows:
-                        await conn.execute(
-                            sql,
-                            int(r["chat_id"]),
-                            int(r.get("thread_id") or 0),
-                            int(r["message_id"]),
-                            int(r["user_id"]),
-                            bool(r.get("from_bot", False)),
-                            r["msg_time_utc"],
-                            r["stat_date"],
-                            int(r["hour"]),
-                            r["text"],
-                        )
+        records = [
+            (
+                int(r["chat_id"]),
+                int(r.get("thread_id") or 0),
+                int(r["message_id"]),
+                int(r["user_id"]),
+                bool(r.get("from_bot", False)),
+                r["msg_time_utc"],
+                r["stat_date"],
+                int(r["hour"]),
+                r["text"],
+            )
+            for r in rows
+        ]
+        dates = {r[6] if isinstance(r[6], date) else date.fromisoformat(str(r[6])) for r in records}
+        await cls.maintain_raw_partitions()
+        await cls.ensure_raw_partitions(dates)
+
+        # 整批同一天（常态）时直接写那一个分区，省掉逐行路由；跨天时写父表由 PG 路由
+        target = RAW_TABLE
+        if len(dates) == 1:
+            target = cls._raw_partition_for(next(iter(dates))) or RAW_TABLE
+
+        # 同一批内同一条消息（编辑过）只保留最后一次：DISTINCT ON 取 ctid 最大者
+        return await cls._copy_merge(
+            RAW_TABLE,
+            ["chat_id", "thread_id", "message_id", "user_id", "from_bot",
+             "msg_time_utc", "stat_date", "hour", "text"],
+            records,
+            f"""
+            INSERT INTO {target}
+                (chat_id, thread_id, message_id, user_id, from_bot,
+                 msg_time_utc, stat_date, hour, text)
+            SELECT DISTINCT ON (chat_id, message_id, stat_date)
+                chat_id, thread_id, message_id, user_id, from_bot,
+                msg_time_utc, stat_date, hour, text
+            FROM {{stage}}
+            ORDER BY chat_id, message_id, stat_date, ctid DESC
+            ON CONFLICT (chat_id, message_id, stat_date)
+            DO UPDATE SET
+                thread_id    = EXCLUDED.thread_id,
+                user_id      = EXCLUDED.user_id,
+                from_bot     = EXCLUDED.from_bot,
+                msg_time_utc = EXCLUDED.msg_time_utc,
+                hour         = EXCLUDED.hour,
+                text         = EXCLUDED.text;
+            """,
+        )
 
     @classmethod
     async def mark_message_deleted(cls, chat_id: int, message_ids: list[int]):
@@ -772,22 +1015,25 @@ class PGStatsDB:
         if not mapping:
             return
 
+        # 一条 UPDATE 带 stat_date：只落在当天的分区
         sql = """
-        UPDATE tg_group_messages_raw
-        SET topic_id=$5, topic_ver=$6, topic_at=NOW()
-        WHERE chat_id=$1 AND stat_date=$2 AND hour=$3 AND thread_id=$4 AND message_id=$7
+        UPDATE tg_group_messages_raw r
+        SET topic_id=m.topic_id, topic_ver=$5, topic_at=NOW()
+        FROM unnest($6::bigint[], $7::int[]) AS m(message_id, topic_id)
+        WHERE r.chat_id=$1 AND r.stat_date=$2 AND r.hour=$3 AND r.thread_id=$4
+          AND r.message_id=m.message_id
         """
+        mids = [int(mid) for mid in mapping]
+        tids = [int(tid) for tid in mapping.values()]
         async with cls._lock:
             if cls.pool is None:
                 raise RuntimeError("PGStatsDB.pool 尚未初始化，请先调用 init_pool()")
             async with cls.pool.acquire() as conn:
-                async with conn.transaction():
-                    for mid, tid in mapping.items():
-                        await conn.execute(
-                            sql,
-                            int(chat_id), stat_date, int(hour), int(thread_id),
-                            int(tid), int(topic_ver), int(mid)
-                        )
+                await conn.execute(
+                    sql,
+                    int(chat_id), stat_date, int(hour), int(thread_id),
+                    int(topic_ver), mids, tids,
+                )
 
     @classmethod
     async def upsert_topics_hourly(
@@ -913,6 +1159,34 @@ class PGStatsDB:
             )
         return row is not None
 
+    @classmethod
+    async def listen_thumbnail_tasks(cls, on_notify) -> asyncpg.Connection:
+        """
+        占用一条连接 LISTEN thumbnail_task；每有新任务入库调用一次 on_notify(task_id)。
+        回传该连接：调用方用 is_closed() 判断断线，结束时交给 unlisten_thumbnail_tasks() 归还。
+        """
+        if cls.pool is None:
+            raise RuntimeError("PGStatsDB.pool 尚未初始化，请先调用 init_pool()")
+        conn = await cls.pool.acquire()
+        try:
+            await conn.add_listener(
+                THUMB_TASK_CHANNEL,
+                lambda _conn, _pid, _channel, payload: on_notify(payload),
+            )
+        except Exception:
+            await cls.pool.release(conn)
+            raise
+        return conn
+
+    @classmethod
+    async def unlisten_thumbnail_tasks(cls, conn: asyncpg.Connection) -> None:
+        try:
+            if not conn.is_closed():
+                await conn.execute(f"UNLISTEN {THUMB_TASK_CHANNEL}")
+        finally:
+            if cls.pool is not None:
+                await cls.pool.release(conn)
+
     @classmethod
     async def get_working_counts(cls, bot_names: List[str]) -> Dict[str, int]:
         """
@@ -0,0 +1,13 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# lz_var / lz_config 在 import 时就读这些环境变量；测试只需要能 import，不连真实服务
+os.environ.setdefault(
+    "SWITCHBOT_CONFIGURATION",
+    '{"chat_id": 1, "thread_id": 1, "switchbot_token": "x", "switchbot_username": "x"}',
+)
+os.environ.setdefault("VALKEY_URL", "redis://localhost:1")
@@ -0,0 +1,74 @@
+import datetime as dt
+import json
+from decimal import Decimal
+
+import lz_cache_codec as codec
+
+
+def _roundtrip(value):
+    raw = codec.encode(value)
+    assert raw[:2] == codec.MAGIC
+    return raw, codec.decode(raw)
+
+
+def test_scalars_and_plain_structures():
+    for value in (0, -7, 3.5, "中文", True, None, [], {}, [1, 2, 3], {"a": [1, {"b": None}]}):
+        _, out = _roundtrip(value)
+        assert out == value
+
+
+def test_rows_are_stored_columnar_with_types_restored():
+    rows = [
+        {
+            "id": i,
+            "content": f"第 {i} 笔",
+            "price": Decimal("1.50") * i,
+            "created_at": dt.datetime(2024, 1, 2, 3, 4, 5) + dt.timedelta(hours=i),
+            "day": dt.date(2024, 1, 1) + dt.timedelta(days=i),
+            "blob": bytes([i, 0, 255]),
+            "thumb": None if i % 2 else f"t{i}",
+        }
+        for i in range(50)
+    ]
+    raw, out = _roundtrip(rows)
+    assert raw[3] & codec.COLUMNAR
+    assert out == rows
+    assert isinstance(out[3]["price"], Decimal)
+    assert isinstance(out[3]["created_at"], dt.datetime)
+    assert isinstance(out[3]["day"], dt.date)
+    assert isinstance(out[3]["blob"], bytes)
+
+
+def test_heterogeneous_rows_fall_back_to_row_format():
+    rows = [{"id": 1, "v": "a"}, {"id": 2, "v": 3}, {"id": 3}]
+    raw, out = _roundtrip(rows)
+    assert not raw[3] & codec.COLUMNAR
+    assert out == rows
+
+
+def test_large_payload_is_compressed_and_smaller_than_json():
+    rows = [{"id": i, "source_id": f"AgAD{i:08d}", "file_type": "v", "content": "x" * 40} for i in range(500)]
+    raw, out = _roundtrip(rows)
+    assert raw[3] & codec.ZLIB
+    assert len(raw) < len(json.dumps(rows).encode())
+    assert out == rows
+
+
+def test_legacy_json_values_still_decode():
+    value = {"id": 1, "content": "旧格式"}
+    legacy = json.dumps(value, ensure_ascii=False)
+    assert codec.decode(legacy) == value
+    assert codec.decode(legacy.encode("utf-8")) == value
+
+
+def test_absent_marker():
+    assert codec.is_absent(codec.ABSENT_RAW)
+    assert codec.is_absent("\x00absent")
+    assert not codec.is_absent(codec.encode(None))
+
+
+def test_special_values_inside_row_format_are_tagged():
+    value = {"at": dt.datetime(2024, 5, 6, 7, 8, 9), "amount": Decimal("9.99")}
+    raw, out = _roundtrip(value)
+    assert raw[3] & codec.TAGGED
+    assert out == value
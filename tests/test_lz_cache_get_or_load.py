@@ -0,0 +1,105 @@
+import asyncio
+
+import fakeredis
+
+from lz_cache import TwoLevelCache
+from lz_search_session import SearchSessionStore
+
+
+def _cache(server):
+    return TwoLevelCache(fakeredis.FakeAsyncRedis(server=server), pubsub=False)
+
+
+class _Loader:
+    def __init__(self, value, delay=0.05):
+        self.value = value
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return self.value
+
+
+def test_concurrent_misses_share_one_load():
+    async def main():
+        cache = _cache(fakeredis.FakeServer())
+        loader = _Loader({"rows": [1, 2, 3]})
+        results = await asyncio.gather(*(cache.get_or_load("searchkey:a", loader, ttl=60) for _ in range(20)))
+        assert loader.calls == 1
+        assert all(r == {"rows": [1, 2, 3]} for r in results)
+
+    asyncio.run(main())
+
+
+def test_lock_makes_other_process_wait_for_the_writer():
+    async def main():
+        server = fakeredis.FakeServer()
+        a, b = _cache(server), _cache(server)  # 两个进程：各自的 L1 / in-flight，共用 Valkey
+        loader_a, loader_b = _Loader("A", delay=0.2), _Loader("B")
+        ra, rb = await asyncio.gather(
+            a.get_or_load("searchkey:b", loader_a, ttl=60),
+            b.get_or_load("searchkey:b", loader_b, ttl=60),
+        )
+        assert (ra, rb) == ("A", "A")
+        assert (loader_a.calls, loader_b.calls) == (1, 0)
+
+    asyncio.run(main())
+
+
+def test_stale_value_is_served_while_refreshing():
+    async def main():
+        server = fakeredis.FakeServer()
+        cache = _cache(server)
+        assert await cache.get_or_load("searchkey:c", _Loader("old"), ttl=60, stale_ttl=60) == "old"
+
+        # 新鲜标记过期（值仍在 stale 窗口内），且本进程 L1 已淘汰
+        await cache.rv.delete(cache._k("searchkey:c:fresh"))
+        cache.l1.delete("searchkey:c")
+
+        refresh = _Loader("new")
+        assert await cache.get_or_load("searchkey:c", refresh, ttl=60, stale_ttl=60) == "old"
+        await asyncio.gather(*list(cache._inflight.values()))
+        assert refresh.calls == 1
+        assert await cache.get_or_load("searchkey:c", _Loader("unused"), ttl=60, stale_ttl=60) == "new"
+
+    asyncio.run(main())
+
+
+def test_cache_if_false_results_are_not_cached():
+    async def main():
+        cache = _cache(fakeredis.FakeServer())
+        loader = _Loader([])
+        for _ in range(2):
+            assert await cache.get_or_load("searchkey:d", loader, ttl=60, cache_if=bool) == []
+        assert loader.calls == 2
+
+    asyncio.run(main())
+
+
+def test_search_sessions_load_once_across_processes():
+    async def main():
+        server = fakeredis.FakeServer()
+        a = SearchSessionStore(l2=_cache(server))
+        b = SearchSessionStore(l2=_cache(server))
+        loader = _Loader(list(range(3000)), delay=0.1)
+        results = await asyncio.gather(*(s.get_ids("kw", 1, loader) for s in (a, a, a, b, b)))
+        assert loader.calls == 1
+        assert all(r == list(range(3000)) for r in results)
+        # 会话进的是 SearchSessionStore 自己的 L1，不占通用 L1
+        assert a.l1.get("ss:kw:1:v1") is not None
+        assert a.l2.l1.get("ss:kw:1:v1") is None
+
+    asyncio.run(main())
+
+
+def test_history_sessions_are_not_truncated():
+    async def main():
+        store = SearchSessionStore(l2=_cache(fakeredis.FakeServer()))
+        ids = list(range(10**6, 10**6 + 4500))
+        got = await store.get_ids("fd", 7, _Loader(ids))
+        assert got == ids
+        assert len(store.slice_page(got, 4499 // 10, 10)) == 10
+
+    asyncio.run(main())
@@ -0,0 +1,111 @@
+import asyncio
+import gc
+import weakref
+
+import lz_memory_cache
+from lz_memory_cache import MemoryCache, estimate_size
+from lz_search_session import SearchSessionStore
+
+
+def test_id_list_is_sized_by_pointer():
+    ids = list(range(10**6, 10**6 + 3000))
+    size = estimate_size(ids)
+    assert 3000 * 8 <= size < 32 * 1024
+
+
+def test_full_search_session_fits_in_session_l1():
+    store = SearchSessionStore()
+    ids = list(range(10**6, 10**6 + 3000))
+    store.l1.set("ss:kw:1:v1", ids, ttl=60)
+    assert store.l1.get("ss:kw:1:v1") == ids
+    assert store.l1.stats()["rejected"] == 0
+
+
+def test_nested_rows_are_sized_by_content():
+    small = [{"id": i, "content": "x"} for i in range(100)]
+    large = [{"id": i, "content": "x" * 2000} for i in range(100)]
+    assert estimate_size(large) > estimate_size(small) + 100 * 1900
+
+
+def test_oversized_value_is_rejected_and_old_value_dropped():
+    cache = MemoryCache(max_value_bytes=1024)
+    cache.set("k", "small")
+    cache.set("k", "x" * 4096)
+    assert cache.get("k") is None
+    assert cache.stats()["rejected"] == 1
+
+
+def test_lru_eviction_by_items_and_bytes():
+    cache = MemoryCache(max_items=3)
+    for k in "abcd":
+        cache.set(k, k)
+    assert cache.get("a") is None
+    assert [cache.get(k) for k in "bcd"] == ["b", "c", "d"]
+
+    cache = MemoryCache(max_bytes=3 * 5000)
+    for k in "abc":
+        cache.set(k, "x" * 4000)
+    cache.get("a")  # a 变成最近使用
+    cache.set("d", "x" * 4000)
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("d") is not None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] <= 3 * 5000
+
+
+def test_process_budget_evicts_largest_instance_not_new_key(monkeypatch):
+    big, small = MemoryCache(), MemoryCache()
+    for i in range(5):
+        big.set(f"b{i}", "x" * 20000)
+    monkeypatch.setattr(lz_memory_cache, "MEMORY_CACHE_TOTAL_BYTES", MemoryCache._total_bytes + 10000)
+
+    small.set("s", "y" * 30000)
+    assert small.get("s") is not None
+    # 超出 ~20KB：只淘汰占用最多那个实例里最旧的一条
+    assert big.get("b0") is None
+    assert all(big.get(f"b{i}") is not None for i in range(1, 5))
+    assert MemoryCache._total_bytes <= lz_memory_cache.MEMORY_CACHE_TOTAL_BYTES
+
+
+def test_expired_entries_and_stats():
+    cache = MemoryCache()
+    cache.set("k", "v", ttl=60)
+    cache._now = lambda: 10**12  # 直接跳到过期之后
+    assert cache.get("k") is None
+    st = cache.stats()
+    assert (st["items"], st["bytes"], st["expirations"], st["misses"]) == (0, 0, 1, 1)
+
+
+def test_close_releases_bytes_and_stops_purger():
+    async def main():
+        before = MemoryCache._total_bytes
+        cache = MemoryCache(purge_interval=0.01)
+        cache.set("k", "x" * 10000)
+        purger = cache._purger
+        assert purger is not None and MemoryCache._total_bytes > before
+        cache.close()
+        await asyncio.sleep(0)
+        assert purger.cancelled()
+        assert MemoryCache._total_bytes == before
+        assert cache not in MemoryCache._instances
+        cache.close()  # 可重复调用
+        assert MemoryCache._total_bytes == before
+
+    asyncio.run(main())
+
+
+def test_dropped_instance_is_collected_and_uncounted():
+    async def main():
+        before = MemoryCache._total_bytes
+        cache = MemoryCache(purge_interval=0.01)
+        cache.set("k", "x" * 10000)
+        purger, ref = cache._purger, weakref.ref(cache)
+        del cache
+        gc.collect()
+        # 后台清理 task 不应让实例一直活着
+        assert ref() is None
+        assert MemoryCache._total_bytes == before
+        await asyncio.sleep(0.05)
+        assert purger.done()
+
+    asyncio.run(main())
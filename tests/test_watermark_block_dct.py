@@ -0,0 +1,136 @@
+import numpy as np
+import pytest
+
+from watermark import pattern_watermark as pw
+from watermark.pattern_watermark import dct2, idct2, generate_pattern
+
+
+# 宽高故意不是 8 的倍数，边缘的残余行列不应被改动
+SHAPES = [(24, 40), (17, 33), (64, 64), (200, 301)]
+
+
+def _image(h, w, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8)
+
+
+def _luma(img):
+    import cv2
+
+    return cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)[:, :, 0].astype(np.float32)
+
+
+def _finish(img, y):
+    import cv2
+
+    ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
+    ycrcb[:, :, 0] = np.clip(y, 0, 255)
+    return cv2.cvtColor(ycrcb.astype(np.uint8), cv2.COLOR_YCrCb2BGR)
+
+
+# ---------- 逐块参考实现（批量化之前的写法） ----------
+def _reference_embed_pattern(img, transaction_id, alpha=8.0):
+    y = _luma(img)
+    h8, w8 = y.shape[0] // 8 * 8, y.shape[1] // 8 * 8
+    pattern = generate_pattern(transaction_id)
+    for y0 in range(0, h8, 8):
+        for x0 in range(0, w8, 8):
+            coeff = dct2(y[y0:y0 + 8, x0:x0 + 8])
+            coeff[1:4, 1:4] += alpha * pattern[1:4, 1:4]
+            y[y0:y0 + 8, x0:x0 + 8] = idct2(coeff)
+    return _finish(img, y)
+
+
+def _reference_score_pattern(img, transaction_id):
+    y = _luma(img)
+    h8, w8 = y.shape[0] // 8 * 8, y.shape[1] // 8 * 8
+    pattern = generate_pattern(transaction_id)[1:4, 1:4]
+    scores = []
+    for y0 in range(0, h8, 8):
+        for x0 in range(0, w8, 8):
+            coeff = dct2(y[y0:y0 + 8, x0:x0 + 8])[1:4, 1:4]
+            scores.append(float(np.mean(coeff * pattern)))
+    return float(np.mean(scores)) if scores else 0.0
+
+
+def _reference_embed_short_key(img, bits, block_indices, bx_count, delta=26.0):
+    y = _luma(img)
+    for k, flat_idx in enumerate(block_indices):
+        by, bx = int(flat_idx) // bx_count, int(flat_idx) % bx_count
+        y0, x0 = by * 8, bx * 8
+        coeff = dct2(y[y0:y0 + 8, x0:x0 + 8])
+        target_diff = delta if bits[k % len(bits)] == 1 else -delta
+        amid = (float(coeff[3, 4]) + float(coeff[4, 3])) / 2.0
+        coeff[3, 4] = amid + target_diff / 2.0
+        coeff[4, 3] = amid - target_diff / 2.0
+        bmid = (float(coeff[2, 3]) + float(coeff[3, 2])) / 2.0
+        coeff[2, 3] = bmid + target_diff / 2.0
+        coeff[3, 2] = bmid - target_diff / 2.0
+        y[y0:y0 + 8, x0:x0 + 8] = idct2(coeff)
+    return _finish(img, y)
+
+
+# ---------- pattern 水印 ----------
+@pytest.mark.parametrize("shape", SHAPES)
+def test_embed_pattern_matches_per_block_loop(shape):
+    img = _image(*shape)
+    assert np.array_equal(pw.embed_pattern_image(img, 123456), _reference_embed_pattern(img, 123456))
+
+
+@pytest.mark.parametrize("shape", SHAPES)
+def test_score_pattern_matches_per_block_loop(shape):
+    img = pw.embed_pattern_image(_image(*shape, seed=1), 42)
+    for tid in (42, 43, 999):
+        assert pw.score_pattern_image(img, tid) == _reference_score_pattern(img, tid)
+
+
+def test_score_pattern_image_smaller_than_one_block():
+    assert pw.score_pattern_image(_image(7, 30), 1) == 0.0
+
+
+# ---------- 短码水印（依赖 imwatermark） ----------
+@pytest.mark.parametrize("shape", [(24, 40), (17, 33), (64, 64), (200, 301), (480, 640)])
+def test_embed_short_key_matches_per_block_loop(shape):
+    # imwatermark 会连带 import torch，环境里没有就跳过
+    tws = pytest.importorskip("watermark.transaction_watermark_service")
+    svc = tws.TransactionWatermarkService
+
+    img = _image(*shape, seed=2)
+    h8, w8 = shape[0] // 8 * 8, shape[1] // 8 * 8
+    bits = svc._short_key_to_bits("a9Z")
+    block_indices, bx_count = svc._plan_block_indices(h8=h8, w8=w8, bit_count=len(bits), max_repeats=40)
+
+    expected = _reference_embed_short_key(img, bits, block_indices, bx_count)
+    assert np.array_equal(svc._embed_short_key_dct_image(img, "a9Z"), expected)
+
+
+def test_occurrence_rank_orders_repeated_blocks():
+    tws = pytest.importorskip("watermark.transaction_watermark_service")
+    rank = tws.TransactionWatermarkService._occurrence_rank(np.array([0, 0, 1, 2, 2, 2, 3], dtype=np.int32))
+    assert rank.tolist() == [0, 1, 0, 0, 1, 2, 0]
+
+
+# ---------- 批量打分（investigate 用） ----------
+@pytest.mark.parametrize("shape", SHAPES)
+def test_score_patterns_image_matches_single_scores(shape):
+    img = pw.embed_pattern_image(_image(*shape, seed=3), 7)
+    tids = [7, 8, 9, 10_000, 7]
+    batched = pw.score_patterns_image(img, tids)
+    assert batched.shape == (len(tids),)
+    # 先对 block 取平均再乘 pattern：与逐个打分只差浮点舍入
+    assert batched == pytest.approx([pw.score_pattern_image(img, t) for t in tids], rel=1e-6, abs=1e-6)
+
+
+def test_score_patterns_image_empty_inputs():
+    assert pw.score_patterns_image(_image(64, 64), []).shape == (0,)
+    assert pw.score_patterns_image(_image(7, 30), [1, 2]).tolist() == [0.0, 0.0]
+
+
+def test_rank_candidates_puts_embedded_id_first():
+    tws = pytest.importorskip("watermark.transaction_watermark_service")
+    img = pw.embed_pattern_image(_image(256, 256, seed=4), 31337)
+    tids = [101, 202, 31337, 404, 505]
+    ranked = tws.TransactionWatermarkService.rank_candidates(img, tids, top_n=3)
+    assert [r["transaction_id"] for r in ranked][0] == 31337
+    assert len(ranked) == 3 and ranked[0]["margin"] > 0
+    assert ranked[0]["score"] == pytest.approx(pw.score_pattern_image(img, 31337), rel=1e-6, abs=1e-6)
@@ -0,0 +1,79 @@
+import asyncio
+from dataclasses import replace
+
+import cv2
+import numpy as np
+import pytest
+
+# watermark_workflow 依赖 imwatermark（会连带 import torch），环境里没有就整个模块跳过
+watermark_workflow = pytest.importorskip("watermark.watermark_workflow")
+
+from watermark import watermark_pool
+from watermark.watermark_pool import WatermarkPool
+from watermark.watermark_workflow import WatermarkWorkflow, WatermarkWorkflowParams
+
+
+def _image(h=240, w=320, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 256, size=(h, w, 3), dtype=np.uint8)
+
+
+def _params(**kw):
+    img = _image()
+    ok, buf = cv2.imencode(".png", img)
+    assert ok
+    base = WatermarkWorkflowParams(
+        transaction_id=12345,
+        input_bytes=buf.tobytes(),
+        return_output_bytes=True,
+        return_output_ndarray=True,
+    )
+    return replace(base, **kw)
+
+
+@pytest.fixture(params=[0, 1], ids=["thread", "process"])
+def pool(request, monkeypatch):
+    monkeypatch.setattr(watermark_pool, "WATERMARK_WORKERS", request.param)
+    monkeypatch.setattr(WatermarkPool, "_slots", None)  # Semaphore 绑定事件循环，每个测试重建
+    yield WatermarkPool
+    WatermarkPool.shutdown()
+
+
+def _assert_same(got, expected):
+    assert np.array_equal(got.pop("output_ndarray"), expected.pop("output_ndarray"))
+    assert got.pop("output_bytes") == expected.pop("output_bytes")
+    assert got == expected
+
+
+def test_submit_bytes_matches_render(pool):
+    params = _params()
+    expected = WatermarkWorkflow.render(params)
+    got = asyncio.run(pool.submit(params))
+    _assert_same(got, expected)
+
+
+def test_submit_ndarray_matches_render(pool):
+    params = _params(input_bytes=None, input_ndarray=_image(seed=1), output_format="jpg")
+    expected = WatermarkWorkflow.render(params)
+    got = asyncio.run(pool.submit(params))
+    _assert_same(got, expected)
+
+
+def test_submit_fullscreen_matches_render(pool):
+    from watermark.visible_watermark import _resolve_font_path
+
+    try:
+        _resolve_font_path(None)
+    except FileNotFoundError:
+        pytest.skip("没有可用的中文字型")
+    params = _params(visible_mode="fullscreen")
+    expected = WatermarkWorkflow.render(params)
+    got = asyncio.run(pool.submit(params))
+    _assert_same(got, expected)
+
+
+def test_submit_propagates_render_errors(pool):
+    params = _params(input_bytes=b"not an image")
+    with pytest.raises(ValueError):
+        asyncio.run(pool.submit(params))
+    assert pool.stats()["failed"] >= 1
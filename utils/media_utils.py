@@ -1,7 +1,6 @@
 # utils/media_utils.py
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.base import StorageKey
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import Message, InputMediaPhoto
@@ -295,39 +294,85 @@ class Media:
             return msg
 
 
+    # ========= 向仓库人 (x-man) 要文件 =========
+    # file_unique_id -> [future, 到期 handle, 到期时刻]；同一个 uid 同时只发一次请求，
+    # 回覆由 handle_x_media_when_waiting 调 resolve_x_file 直接完成 future，不再轮询 FSM
+    _x_pending: dict[str, list] = {}
+    _x_stats = {"requests": 0, "merged": 0, "resolved": 0, "timeouts": 0, "late": 0}
+
     @classmethod
-    async def fetch_file_by_file_uid_from_x(cls, state: FSMContext, ask_file_unique_id: str | None = None, timeout_sec: float = 10.0):
+    def _x_request(cls, file_unique_id: str, timeout_sec: float) -> tuple[asyncio.Future, bool]:
+        """取得（或建立）该 uid 的等待 future。返回 (future, 是否新建——新建的才需要发请求)。"""
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout_sec
+        entry = cls._x_pending.get(file_unique_id)
+        if entry is not None and not entry[0].done():
+            cls._x_stats["merged"] += 1
+            if deadline > entry[2]:
+                # 后来的调用方等得更久：延后到期，免得它还在等时登记已被清掉
+                entry[1].cancel()
+                entry[1] = loop.call_at(deadline, cls._expire_x_request, file_unique_id, entry[0])
+                entry[2] = deadline
+            return entry[0], False
+
+        fut = loop.create_future()
+        handle = loop.call_at(deadline, cls._expire_x_request, file_unique_id, fut)
+        cls._x_pending[file_unique_id] = [fut, handle, deadline]
+        cls._x_stats["requests"] += 1
+        return fut, True
+
+    @classmethod
+    def _expire_x_request(cls, file_unique_id: str, fut: asyncio.Future):
+        entry = cls._x_pending.get(file_unique_id)
+        if entry is not None and entry[0] is fut:
+            cls._x_pending.pop(file_unique_id, None)
+            if not fut.done():
+                cls._x_stats["timeouts"] += 1
+                fut.set_result(None)
+
+    @classmethod
+    def resolve_x_file(cls, file_unique_id: str, file_id: str, asked_file_unique_id: str | None = None) -> bool:
         """
-        进入等待态 -> 清空状态数据 -> 轮询每 0.5 秒看是否收到 file_unique_id
-        - 要求：由 仓库人 以「回覆」的方式把媒体回到你发出的那条 ask 消息
-        - lz_media_parser.py 会在满足条件时把 FSM 内容写入 {"x_media_unique_id": "..."} 并打印
-        - 不负责发送“召唤消息”，仅负责等待与取值；召唤逻辑由业务处发送后再调用本函数
+        仓库人回覆媒体时调用：完成所有在等这个 uid 的调用方。
+        asked_file_unique_id 是被回覆的那条 ask 消息的文字（即当初请求的 uid）；
+        仓库回的可能是另一个尺寸 / 重新编码的文件，uid 不同，所以两个都要唤醒。
+        没有人在等（超时后才到的回覆）返回 False；file_id 照常由 handler 写进 file_extension。
         """
+        resolved = False
+        for uid in {file_unique_id, asked_file_unique_id}:
+            entry = cls._x_pending.pop(uid, None) if uid else None
+            if entry is None or entry[0].done():
+                continue
+            entry[1].cancel()
+            entry[0].set_result(file_id)
+            resolved = True
+        cls._x_stats["resolved" if resolved else "late"] += 1
+        return resolved
 
-        bot = lz_var.bot
-        if state:
-            storage = state.storage  # 与全局 Dispatcher 共享的同一个 storage
-
-            x_uid = lz_var.x_man_bot_id          
-            x_chat_id = x_uid                     # 私聊里 chat_id == user_id
-            key = StorageKey(bot_id=lz_var.bot.id, chat_id=x_chat_id, user_id=x_uid)
+    @classmethod
+    def x_request_stats(cls) -> dict:
+        return {**cls._x_stats, "pending": len(cls._x_pending)}
 
-            await storage.set_state(key, ProductPreviewFSM.waiting_for_x_media.state)
-        # await storage.set_data(key, {})  # 清空
+    @classmethod
+    async def fetch_file_by_file_uid_from_x(cls, state: FSMContext, ask_file_unique_id: str | None = None, timeout_sec: float = 10.0):
+        """
+        向仓库人要 ask_file_unique_id 的文件，等它回覆后返回 file_id（超时返回 None）
+        - 要求：由 仓库人 以「回覆」的方式把媒体回到你发出的那条 ask 消息
+        - lz_media_parser.py / ananbot.py 的 handle_x_media_when_waiting 收到后调 resolve_x_file 唤醒这里
+        - 同一个 uid 正在等待中时，不再重复发请求，直接一起等同一个结果
+        - state 为 None 时只发请求不等待（预加载用），结果由 handler 写进 file_extension
+        """
+        if not ask_file_unique_id:
+            return None
 
-        # 可选：你想把召唤语塞给状态，方便对方检查 reply_to（不必须）
-        if ask_file_unique_id:
+        fut, is_new = cls._x_request(ask_file_unique_id, timeout_sec)
+        if is_new:
             try:
                 # 直接发文字请求
                 await lz_var.bot.send_message(
                     chat_id=lz_var.x_man_bot_id,
                     text=f"{ask_file_unique_id}"
                 )
-
-                # 或者如果你要发的是具体文件，可以这样：
-                # file = FSInputFile(path_to_file)
-                # await lz_var.bot.send_document(chat_id=target_user_id, document=file)
-
                 print(f"--->  🏚 已向仓库 ( {lz_var.x_man_bot_id} ) 请求文件 {ask_file_unique_id}", flush=True)
 
             except Exception as e:
@@ -335,37 +380,18 @@ class Media:
                     print(f"❌ 发送 ask_file_unique_id 给用户失败：Bot 未与用户建立对话，请先让 {lz_var.x_man_bot_id} 给 {lz_var.bot_username} 发一条消息再试。 |_kick_|{lz_var.bot_username}", flush=True)
                 else:
                     print(f"❌ 发送 ask_file_unique_id 给用户失败: {e}", flush=True)
-        
+                # 请求没发出去，不必等到超时
+                cls._expire_x_request(ask_file_unique_id, fut)
+                return None
+
         if state is None:
             return None
-        
-        max_loop = int((timeout_sec / 0.5) + 0.5)
-        for _ in range(max_loop):
-            data = await storage.get_data(key)
-            x_file_id = data.get("x_file_id")
-            x_file_unique_id = data.get("x_file_unique_id")
-            if x_file_id:
-                # 清掉对方上下文的等待态 
-                await storage.set_state(key, None)
-                data["x_file_id"] = None
-                data["x_file_unique_id"] = None
-                await storage.set_data(key, data)
-                # print(f"  ✅ (fetch_file_by_file_uid_from_x) [X-MEDIA] 收到 file_id={x_file_id} | {ask_file_unique_id}", flush=True)
-                return x_file_id
-            await asyncio.sleep(0.5)
-
-        # if not x_file_id:
-            # print(f"❌ (fetch_file_by_file_uid_from_x)[X-MEDIA] 超时未收到 x_file_unique_id {ask_file_unique_id} ，已等待 {timeout_sec} 秒后清理状态", flush=True)
-
-        # 超时清理 
-        
-        await storage.set_state(key, None)
-        data = await storage.get_data(key)
-        data["x_file_id"] = None
-        data["x_file_unique_id"] = None
-        await storage.set_data(key, data)
-        
-        return None
+
+        try:
+            # shield：单个调用方超时 / 被取消，不影响其它在等同一个 uid 的调用方
+            return await asyncio.wait_for(asyncio.shield(fut), timeout=timeout_sec)
+        except asyncio.TimeoutError:
+            return None
 
 
     @classmethod
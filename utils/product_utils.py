@@ -4,12 +4,12 @@ from aiogram import Bot
 
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.types import InputMediaPhoto, InputMediaDocument, InputMediaVideo, InputMediaAudio, InputMediaAnimation
-from aiogram.types import FSInputFile
+from aiogram.types import BufferedInputFile
 from utils.aes_crypto import AESCrypto
 from utils.tpl import Tplate
 
 from lz_mysql import MySQLPool
-from lz_pgsql import PGPool
+from lz_pgsql import PGPool, album_cache_key
 from lz_config import AES_KEY,UPLOADER_BOT_NAME
 import lz_var
 from lz_db import db
@@ -22,8 +22,6 @@ import asyncio
 import time
 import io
 import hashlib
-import tempfile
-import os
 from aiogram.fsm.storage.base import StorageKey
 from shared_config import SharedConfig
 SharedConfig.load()
@@ -461,6 +459,12 @@ async def sync_album_items(content_id: int):
     deleted = await PGPool.delete_album_items_except(int(content_id), keep_ids)
     print(f"[sync_album_items] Delete extras in PG = {deleted}", flush=True)
 
+    # 成员有变动 → 失效 get_album_list 的缓存（db / PGPool 两份）
+    album_key = album_cache_key(lz_var.bot_username, content_id)
+    db.cache.delete(album_key)
+    if PGPool.cache:
+        PGPool.cache.delete(album_key)
+
     # 4) 小结
     summary = {
         "content_id": int(content_id),
@@ -512,40 +516,62 @@ async def sync_sora(content_id: int):
         album_sync_summary = None
 
 
+# copy_from_pg_to_mysql 的断点续传水位（存在 PG sync_watermark，与 SyncEngine 共用）
+COPY_PG_CHECKPOINT = "copy:file_extension_pgbk"
+
+
 async def copy_from_pg_to_mysql(
     progress_cb: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None,
+    *,
+    chunk_size: int = 1000,
+    writers: int = 4,
+    resume: bool = True,
+    count_total: bool = False,
 ):
     """
     从 PostgreSQL.file_extension 取指定条件记录，写入 MySQL.file_extension_pgbk。
     - PG 端使用 DISTINCT ON(file_unique_id) 规则选出优先记录。
     - MySQL 端按 id 主键做 UPSERT。
+
+    流式执行，内存占用与总行数无关：
+    - PG 服务端游标按 file_unique_id 顺序读出，每 chunk_size 笔放进有界队列（写不动时游标停读）
+    - writers 个 MySQL 连接并发取队列，每个 chunk 一个事务，提交即生效
+    - 已连续提交的最大 file_unique_id 记为水位；中途失败后再次执行（resume=True）从水位之后继续，
+      整轮完成后清掉水位，下次重新全量
+    - 进度按已写入的行数回报；count_total=True 时先 COUNT 出总数以便显示百分比
+      （COUNT 要把 NOT EXISTS 反连接完整再跑一遍，大表上成本翻倍，默认不做）
     """
+    from lz_sync_engine import SyncEngine  # 延迟引入，避免循环依赖
+
     await asyncio.gather(
         MySQLPool.init_pool(),
         PGPool.init_pool(),
     )
     await MySQLPool.ensure_pool()
     await PGPool.ensure_pool()
+    await SyncEngine.ensure_table()
 
     publish_bot_name = SharedConfig.get("publish_bot_name") or ""
 
-    
-
-    pg_sql = """
-        SELECT DISTINCT ON (f.file_unique_id)
-            f.id,
-            f.file_type,
-            f.file_unique_id,
-            f.file_id,
-            f.bot
+    pg_where = """
         FROM public.file_extension f
         WHERE f.bot IN ('luzaitestbot', 'xiaojuhua010bot', 'luzai10005bot')
+          AND f.file_unique_id > $2
           AND NOT EXISTS (
               SELECT 1
               FROM public.file_extension x
               WHERE x.file_unique_id = f.file_unique_id
                 AND x.bot = $1
           )
+    """
+    pg_sql = f"""
+        SELECT DISTINCT ON (f.file_unique_id)
+            f.id,
+            f.file_type,
+            f.file_unique_id,
+            f.file_id,
+            f.bot
+        {pg_where}
         ORDER BY
             f.file_unique_id,
             CASE
@@ -565,47 +591,47 @@ async def copy_from_pg_to_mysql(
 
     await _notify({"stage": "init"})
 
-    try:
-        pg_rows = await PGPool.fetch(pg_sql, publish_bot_name)
-    except Exception as e:
-        await _notify({"stage": "error", "error": str(e)})
-        print(f"[copy_from_pg_to_mysql] PG query failed: {e}", flush=True)
-        return {
-            "pg_rows": 0,
-            "mysql_upserted": 0,
-            "status": "pg_query_failed",
-            "error": str(e),
-        }
+    resumed_from = ""
+    if resume:
+        mark = await SyncEngine.load_watermark(COPY_PG_CHECKPOINT)
+        resumed_from = mark.get("last_pk") or ""
+    else:
+        await SyncEngine.reset_watermark(COPY_PG_CHECKPOINT)
 
-    if not pg_rows:
+    total_rows: Optional[int] = None
+    if count_total:
+        try:
+            count_row = await PGPool.fetchrow(
+                f"SELECT COUNT(DISTINCT f.file_unique_id) AS n {pg_where}", publish_bot_name, resumed_from
+            )
+            total_rows = int((count_row or {}).get("n") or 0)
+        except Exception as e:
+            await _notify({"stage": "error", "error": str(e)})
+            print(f"[copy_from_pg_to_mysql] PG query failed: {e}", flush=True)
+            return {
+                "pg_rows": 0,
+                "mysql_upserted": 0,
+                "status": "pg_query_failed",
+                "error": str(e),
+            }
+
+    if total_rows == 0:
+        await SyncEngine.reset_watermark(COPY_PG_CHECKPOINT)
         summary = {
             "pg_rows": 0,
             "mysql_upserted": 0,
             "status": "ok",
+            "resumed_from": resumed_from,
         }
         await _notify({"stage": "done", "summary": summary})
         print(f"[copy_from_pg_to_mysql] Done (no data): {summary}", flush=True)
         return summary
 
-    await _notify({"stage": "fetched", "total": len(pg_rows)})
-
-    payload = [
-        (
-            int(r["id"]),
-            str(r.get("file_type")) if r.get("file_type") is not None else None,
-            str(r.get("file_unique_id") or "")[:100],
-            str(r.get("file_id") or ""),
-            str(r.get("bot")) if r.get("bot") is not None else None,
-            None,
-        )
-        for r in pg_rows
-    ]
+    await _notify({"stage": "fetched", "total": total_rows})
 
     conn = cur = None
     try:
         conn, cur = await MySQLPool.get_conn_cursor()
-        await conn.begin()
-
         await cur.execute(
             """
             CREATE TABLE IF NOT EXISTS file_extension_pgbk (
@@ -625,65 +651,11 @@ async def copy_from_pg_to_mysql(
                 MODIFY COLUMN file_id TEXT NOT NULL
             """
         )
-
-        batch_size = 100
-        total_rows = len(payload)
-        total_batches = (total_rows + batch_size - 1) // batch_size
-        report_every = max(1, total_batches // 20)
-        mysql_upserted = 0
-
-        for i in range(0, len(payload), batch_size):
-            batch = payload[i:i + batch_size]
-            batch_no = (i // batch_size) + 1
-            placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(batch))
-            flat_params = [v for row in batch for v in row]
-            sql = f"""
-                INSERT INTO file_extension_pgbk
-                    (id, file_type, file_unique_id, file_id, bot, work_stats)
-                VALUES {placeholders}
-                ON DUPLICATE KEY UPDATE
-                    file_type = VALUES(file_type),
-                    file_unique_id = VALUES(file_unique_id),
-                    file_id = VALUES(file_id),
-                    bot = VALUES(bot),
-                    work_stats = VALUES(work_stats)
-            """
-            await cur.execute(sql, flat_params)
-            mysql_upserted += len(batch)
-
-            if batch_no % report_every == 0 or batch_no == total_batches:
-                percent = round((mysql_upserted / total_rows) * 100, 2)
-                await _notify(
-                    {
-                        "stage": "running",
-                        "total": total_rows,
-                        "processed": mysql_upserted,
-                        "batch_no": batch_no,
-                        "total_batches": total_batches,
-                        "percent": percent,
-                    }
-                )
-
-        await conn.commit()
-
-        summary = {
-            "pg_rows": len(pg_rows),
-            "mysql_upserted": mysql_upserted,
-            "status": "ok",
-        }
-        await _notify({"stage": "done", "summary": summary})
-        print(f"[copy_from_pg_to_mysql] Done: {summary}", flush=True)
-        return summary
     except Exception as e:
-        if conn:
-            try:
-                await conn.rollback()
-            except Exception:
-                pass
         await _notify({"stage": "error", "error": str(e)})
-        print(f"[copy_from_pg_to_mysql] MySQL upsert failed: {e}", flush=True)
+        print(f"[copy_from_pg_to_mysql] MySQL prepare failed: {e}", flush=True)
         return {
-            "pg_rows": len(pg_rows),
+            "pg_rows": 0,
             "mysql_upserted": 0,
             "status": "mysql_upsert_failed",
             "error": str(e),
@@ -692,6 +664,168 @@ async def copy_from_pg_to_mysql(
         if conn or cur:
             await MySQLPool.release(conn, cur)
 
+    chunk_size = max(1, int(chunk_size))
+    writers = max(1, int(writers))
+    # 知道总数时约每 5% 回报一次；不知道时按时间回报
+    total_batches = (total_rows + chunk_size - 1) // chunk_size if total_rows is not None else None
+    report_every = max(1, total_batches // 20) if total_batches else None
+    report_interval = 5.0
+    last_report = [time.monotonic()]
+
+    queue: asyncio.Queue = asyncio.Queue(maxsize=writers * 2)
+    state = {
+        "pg_rows": 0,
+        "mysql_upserted": 0,
+        "batches": 0,
+        "checkpoint": resumed_from,
+    }
+    done_seqs: Dict[int, tuple] = {}  # 已提交但前面还有未提交 chunk 的 seq -> (末笔 file_unique_id, 行数)
+    next_seq = [0]                     # 下一个等待连续提交的 seq
+    checkpoint_lock = asyncio.Lock()
+
+    async def _produce():
+        seq = 0
+        chunk: List[tuple] = []
+        pg_conn = await PGPool.acquire()
+        try:
+            async with pg_conn.transaction(readonly=True):
+                async for r in pg_conn.cursor(pg_sql, publish_bot_name, resumed_from, prefetch=chunk_size):
+                    chunk.append(
+                        (
+                            int(r["id"]),
+                            str(r["file_type"]) if r["file_type"] is not None else None,
+                            str(r["file_unique_id"] or "")[:100],
+                            str(r["file_id"] or ""),
+                            str(r["bot"]) if r["bot"] is not None else None,
+                            None,
+                        )
+                    )
+                    if len(chunk) >= chunk_size:
+                        state["pg_rows"] += len(chunk)
+                        await queue.put((seq, chunk, r["file_unique_id"]))
+                        seq += 1
+                        chunk = []
+        finally:
+            await PGPool.release(pg_conn)
+        if chunk:
+            state["pg_rows"] += len(chunk)
+            await queue.put((seq, chunk, chunk[-1][2]))
+        for _ in range(writers):
+            await queue.put(None)
+
+    async def _advance_checkpoint(seq: int, last_uid: str, rows: int):
+        # 只有 seq 之前的 chunk 全部提交后水位才前进，避免续传时跳过未写入的行
+        async with checkpoint_lock:
+            done_seqs[seq] = (last_uid, rows)
+            advanced_rows = 0
+            new_mark = None
+            while next_seq[0] in done_seqs:
+                new_mark, n = done_seqs.pop(next_seq[0])
+                advanced_rows += n
+                next_seq[0] += 1
+            if new_mark is not None:
+                await SyncEngine.save_watermark(COPY_PG_CHECKPOINT, None, new_mark, advanced_rows)
+                state["checkpoint"] = new_mark
+
+    async def _write():
+        w_conn, w_cur = await MySQLPool.get_conn_cursor()
+        try:
+            while True:
+                item = await queue.get()
+                try:
+                    if item is None:
+                        return
+                    seq, batch, last_uid = item
+                    placeholders = ", ".join(["(%s, %s, %s, %s, %s, %s)"] * len(batch))
+                    flat_params = [v for row in batch for v in row]
+                    sql = f"""
+                        INSERT INTO file_extension_pgbk
+                            (id, file_type, file_unique_id, file_id, bot, work_stats)
+                        VALUES {placeholders}
+                        ON DUPLICATE KEY UPDATE
+                            file_type = VALUES(file_type),
+                            file_unique_id = VALUES(file_unique_id),
+                            file_id = VALUES(file_id),
+                            bot = VALUES(bot),
+                            work_stats = VALUES(work_stats)
+                    """
+                    await w_conn.begin()
+                    try:
+                        await w_cur.execute(sql, flat_params)
+                        await w_conn.commit()
+                    except Exception:
+                        await w_conn.rollback()
+                        raise
+                    state["mysql_upserted"] += len(batch)
+                    state["batches"] += 1
+                    await _advance_checkpoint(seq, last_uid, len(batch))
+
+                    batch_no = state["batches"]
+                    if report_every:
+                        due = batch_no % report_every == 0 or batch_no == total_batches
+                    else:
+                        due = time.monotonic() - last_report[0] >= report_interval
+                    if due:
+                        last_report[0] = time.monotonic()
+                        processed = state["mysql_upserted"]
+                        await _notify(
+                            {
+                                "stage": "running",
+                                "total": total_rows,
+                                "processed": processed,
+                                "batch_no": batch_no,
+                                "total_batches": total_batches,
+                                "percent": round(min(processed / total_rows, 1.0) * 100, 2) if total_rows else None,
+                            }
+                        )
+                finally:
+                    queue.task_done()
+        finally:
+            await MySQLPool.release(w_conn, w_cur)
+
+    t0 = time.perf_counter()
+    producer = asyncio.create_task(_produce())
+    writer_tasks = [asyncio.create_task(_write()) for _ in range(writers)]
+    tasks = [producer, *writer_tasks]
+    # 任一端出错就停：写入端挂掉时 producer 会卡在 queue.put 上，需要一起取消
+    await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    failed = next((t for t in tasks if t.done() and not t.cancelled() and t.exception()), None)
+    if failed is not None:
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        status = "pg_query_failed" if failed is producer else "mysql_upsert_failed"
+        error = str(failed.exception())
+        await _notify({"stage": "error", "error": error})
+        print(
+            f"[copy_from_pg_to_mysql] {status}: {error} "
+            f"(checkpoint={state['checkpoint']!r}，再次执行会从这里继续)",
+            flush=True,
+        )
+        return {
+            "pg_rows": state["pg_rows"],
+            "mysql_upserted": state["mysql_upserted"],
+            "status": status,
+            "error": error,
+            "resumed_from": resumed_from,
+            "checkpoint": state["checkpoint"],
+        }
+
+    # 整轮完成：清掉水位，下次重新全量
+    await SyncEngine.reset_watermark(COPY_PG_CHECKPOINT)
+    elapsed = time.perf_counter() - t0
+    summary = {
+        "pg_rows": state["pg_rows"],
+        "mysql_upserted": state["mysql_upserted"],
+        "status": "ok",
+        "resumed_from": resumed_from,
+        "elapsed_sec": round(elapsed, 1),
+        "rows_per_sec": round(state["mysql_upserted"] / elapsed, 1) if elapsed > 0 else 0.0,
+    }
+    await _notify({"stage": "done", "summary": summary})
+    print(f"[copy_from_pg_to_mysql] Done: {summary}", flush=True)
+    return summary
+
 async def _build_content_seg(content: str | None, tag: str | None) -> str:
     """
     生成用于 MySQL.sora_content.content_seg 的分词结果：
@@ -1739,46 +1873,44 @@ async def watermark_from_file_id(
     if not file_path:
         raise ValueError("无法从 file_id 取得 file_path")
 
-    with tempfile.TemporaryDirectory(prefix="lz_wm_") as temp_dir:
-        input_path = os.path.join(temp_dir, "input_image")
-        output_path = os.path.join(temp_dir, "watermarked.png")
-
-        await bot.download_file(file_path, destination=input_path)
-        if not os.path.exists(input_path) or os.path.getsize(input_path) == 0:
-            raise RuntimeError("下载原图失败：内容为空")
-
-        params = WatermarkWorkflowParams(
-            transaction_id=transaction_id,
-            input_path=input_path,
-            output_path=output_path,
-            return_output_bytes=False,
-            output_format="png",
-            enable_invisible_watermark=enable_invisible_watermark,
-            enable_pattern_watermark=enable_pattern_watermark,
-            visible_mode=visible_mode,
-            visible_position=visible_position,
-            visible_text=visible_text,
-            fullscreen_text=fullscreen_text,
-            visible_font_path=visible_font_path,
-            visible_opacity=visible_opacity,
-            visible_font_scale=visible_font_scale,
-            visible_thickness=visible_thickness,
-            fullscreen_opacity=fullscreen_opacity,
-            fullscreen_font_scale=fullscreen_font_scale,
-            fullscreen_thickness=fullscreen_thickness,
-            fullscreen_angle=fullscreen_angle,
-            fullscreen_x_gap=fullscreen_x_gap,
-            fullscreen_y_gap=fullscreen_y_gap,
-        )
+    # 原图 / 成品都留在内存：下载进 BytesIO，经共享内存交给水印 worker，成品直接上传
+    source = io.BytesIO()
+    await bot.download_file(file_path, destination=source)
+    if source.getbuffer().nbytes == 0:
+        raise RuntimeError("下载原图失败：内容为空")
+
+    params = WatermarkWorkflowParams(
+        transaction_id=transaction_id,
+        input_bytes=source.getbuffer(),
+        return_output_bytes=True,
+        output_format="png",
+        enable_invisible_watermark=enable_invisible_watermark,
+        enable_pattern_watermark=enable_pattern_watermark,
+        visible_mode=visible_mode,
+        visible_position=visible_position,
+        visible_text=visible_text,
+        fullscreen_text=fullscreen_text,
+        visible_font_path=visible_font_path,
+        visible_opacity=visible_opacity,
+        visible_font_scale=visible_font_scale,
+        visible_thickness=visible_thickness,
+        fullscreen_opacity=fullscreen_opacity,
+        fullscreen_font_scale=fullscreen_font_scale,
+        fullscreen_thickness=fullscreen_thickness,
+        fullscreen_angle=fullscreen_angle,
+        fullscreen_x_gap=fullscreen_x_gap,
+        fullscreen_y_gap=fullscreen_y_gap,
+    )
 
-        workflow_result = await WatermarkWorkflow.run(params)
-        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
-            raise RuntimeError("水印输出为空")
+    workflow_result = await WatermarkWorkflow.run(params)
+    output_bytes = workflow_result.pop("output_bytes", None)
+    if not output_bytes:
+        raise RuntimeError("水印输出为空")
 
-        sent = await bot.send_photo(
-            chat_id=upload_chat_id,
-            photo=FSInputFile(output_path, filename="watermarked.png"),
-        )
+    sent = await bot.send_photo(
+        chat_id=upload_chat_id,
+        photo=BufferedInputFile(output_bytes, filename="watermarked.png"),
+    )
     watermarked_file_id = sent.photo[-1].file_id if sent.photo else None
     if not watermarked_file_id:
         raise RuntimeError("上传水印图片后未取得新的 file_id")
@@ -1796,17 +1928,20 @@ async def watermark_from_file_id(
 async def sync_table(
     table: str,
     pk: str,
-    last_ts: int,
+    last_ts: Any,
     *,
+    last_pk: Any = None,
     update_field: str = "update_at",
     limit: int = 5000,
     chunk_size: int = 1000,
 ) -> Dict[str, Any]:
     """
-    单向同步：以 MySQL 为源，将指定 table 的增量记录同步到 PostgreSQL。
+    单向同步：以 MySQL 为源，将指定 table 的增量记录同步到 PostgreSQL（单次）。
     规则：
-      - 仅同步 MySQL 中 {update_field} > last_ts 的记录
+      - 按复合游标 (update_field, pk) 取 (last_ts, last_pk) 之后的记录
       - PG 端使用 UPSERT（新增或取代）
+      - 下一次调用传回 summary 里的 last_ts_out / last_pk_out 续页
+    常驻的增量同步见 lz_sync_engine.SyncEngine。
 
     返回示例：
     {
@@ -1815,7 +1950,8 @@ async def sync_table(
         "last_ts_in": 1700000000000,
         "mysql_count": 120,
         "pg_upserted": 120,
-        "max_update_at": 1700000001234,
+        "last_ts_out": 1700000001234,
+        "last_pk_out": 981,
     }
     """
 
@@ -1825,37 +1961,31 @@ async def sync_table(
         PGPool.init_pool(),
     )
 
-    await MySQLPool.ensure_pool()
-    await PGPool.ensure_pool()
-
     table = (table or "").strip()
     pk = (pk or "").strip()
-    last_ts = int(last_ts or 0)
 
     # 2) 从 MySQL 拉增量
-    mysql_rows = await MySQLPool.fetch_records_updated_after(
-        table=table,
-        timestamp=last_ts,
-        update_field=update_field,
-        limit=limit,
+    mysql_rows = await MySQLPool.fetch_records_after_cursor(
+        table, update_field, pk, last_ts, last_pk, limit=limit
     )
     mysql_count = len(mysql_rows)
 
     print(
         f"[sync_table] MySQL rows = {mysql_count} "
-        f"for table={table}, {update_field}>{last_ts}",
+        f"for table={table}, ({update_field}, {pk}) > ({last_ts}, {last_pk})",
         flush=True,
     )
 
+    summary = {
+        "table": table,
+        "pk": pk,
+        "last_ts_in": last_ts,
+        "mysql_count": mysql_count,
+        "pg_upserted": 0,
+        "last_ts_out": last_ts,
+        "last_pk_out": last_pk,
+    }
     if not mysql_rows:
-        summary = {
-            "table": table,
-            "pk": pk,
-            "last_ts_in": last_ts,
-            "mysql_count": 0,
-            "pg_upserted": 0,
-            "max_update_at": last_ts,
-        }
         print(f"[sync_table] Done (no data): {summary}", flush=True)
         return summary
 
@@ -1867,21 +1997,10 @@ async def sync_table(
         chunk_size=chunk_size,
     )
 
-    # 4) 计算本次最大 update_at，用于推进水位
-    max_update_at = last_ts
-    try:
-        max_update_at = max(int(r.get(update_field) or 0) for r in mysql_rows) or last_ts
-    except Exception:
-        max_update_at = last_ts
-
-    summary = {
-        "table": table,
-        "pk": pk,
-        "last_ts_in": last_ts,
-        "mysql_count": mysql_count,
-        "pg_upserted": int(pg_upserted or 0),
-        "max_update_at": int(max_update_at),
-    }
+    # 4) 结果按游标排序，最后一笔就是新的水位
+    summary["pg_upserted"] = int(pg_upserted or 0)
+    summary["last_ts_out"] = mysql_rows[-1].get(update_field)
+    summary["last_pk_out"] = mysql_rows[-1].get(pk)
 
     print(f"[sync_table] Done: {summary}", flush=True)
     return summary
@@ -0,0 +1,47 @@
+import os
+import numpy as np
+from scipy.fft import dct, idct
+
+
+BLOCK = 8
+# scipy.fft 的并行线程数（-1 = 全部核心）；与 scipy.fftpack 同为 pocketfft，结果逐位一致
+DCT_WORKERS = int(os.getenv("WATERMARK_DCT_WORKERS", "-1"))
+
+
+def block_view(plane: np.ndarray) -> np.ndarray:
+    """
+    把 2D 平面裁到 8 的倍数，返回 (nby, nbx, 8, 8) 的视图（不拷贝）。
+    对视图的写入会直接落回原平面。
+    """
+    h, w = plane.shape
+    nby, nbx = h // BLOCK, w // BLOCK
+    cropped = plane[:nby * BLOCK, :nbx * BLOCK]
+    return cropped.reshape(nby, BLOCK, nbx, BLOCK).swapaxes(1, 2)
+
+
+def dct2_blocks(blocks: np.ndarray) -> np.ndarray:
+    """
+    对最后两维做 2D DCT（ortho），一次处理所有 block。
+    运算顺序与逐块的 dct(dct(block.T).T) 相同：先列（axis=-2）后行（axis=-1），结果逐位一致。
+    """
+    cols = dct(blocks, axis=-2, norm="ortho", workers=DCT_WORKERS)
+    return dct(cols, axis=-1, norm="ortho", workers=DCT_WORKERS)
+
+
+def dct2_blocks_band(blocks: np.ndarray, lo: int, hi: int) -> np.ndarray:
+    """只要 [lo:hi, lo:hi] 这块系数时用：第二遍只对需要的行做，结果与 dct2_blocks(...)[..., lo:hi, lo:hi] 相同。"""
+    cols = dct(blocks, axis=-2, norm="ortho", workers=DCT_WORKERS)[..., lo:hi, :]
+    return dct(cols, axis=-1, norm="ortho", workers=DCT_WORKERS)[..., lo:hi]
+
+
+def idct2_blocks(coeffs: np.ndarray) -> np.ndarray:
+    """dct2_blocks 的逆变换，顺序同 idct(idct(block.T).T)。"""
+    cols = idct(coeffs, axis=-2, norm="ortho", workers=DCT_WORKERS)
+    return idct(cols, axis=-1, norm="ortho", workers=DCT_WORKERS)
+
+
+def gather_blocks(view: np.ndarray, flat_indices: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """按行优先的 block 序号取出 (n, 8, 8) 的副本，同时回传 (by, bx) 供 scatter 写回。"""
+    flat = np.asarray(flat_indices, dtype=np.int64)
+    by, bx = np.divmod(flat, view.shape[1])
+    return view[by, bx], by, bx
@@ -4,6 +4,7 @@ import numpy as np
 from scipy.fftpack import dct, idct
 
 from watermark.watermark_utils import generate_seed_from_transaction_id
+from watermark.block_dct import block_view, dct2_blocks, dct2_blocks_band, idct2_blocks
 
 
 def dct2(block):
@@ -42,17 +43,13 @@ def embed_pattern_image(img, transaction_id, alpha=8.0):
     ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
     y = ycrcb[:, :, 0].astype(np.float32)
 
-    h, w = y.shape
-    h8, w8 = h // 8 * 8, w // 8 * 8
-
     pattern = generate_pattern(transaction_id)
 
-    for y0 in range(0, h8, 8):
-        for x0 in range(0, w8, 8):
-            block = y[y0:y0+8, x0:x0+8]
-            coeff = dct2(block)
-            coeff[1:4, 1:4] += alpha * pattern[1:4, 1:4]
-            y[y0:y0+8, x0:x0+8] = idct2(coeff)
+    # 所有 8x8 block 一次做 DCT / IDCT，写回视图即写回 y
+    blocks = block_view(y)
+    coeff = dct2_blocks(blocks)
+    coeff[..., 1:4, 1:4] += alpha * pattern[1:4, 1:4]
+    blocks[...] = idct2_blocks(coeff)
 
     ycrcb[:, :, 0] = np.clip(y, 0, 255)
     return cv2.cvtColor(ycrcb.astype(np.uint8), cv2.COLOR_YCrCb2BGR)
@@ -71,24 +68,60 @@ def score_pattern_image(img, transaction_id):
     ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
     y = ycrcb[:, :, 0].astype(np.float32)
 
-    h, w = y.shape
-    h8, w8 = h // 8 * 8, w // 8 * 8
-
     pattern = generate_pattern(transaction_id)[1:4, 1:4]
-    scores = []
-
-    for y0 in range(0, h8, 8):
-        for x0 in range(0, w8, 8):
-            block = y[y0:y0+8, x0:x0+8]
-            coeff = dct2(block)[1:4, 1:4]
-            scores.append(float(np.mean(coeff * pattern)))
 
-    if not scores:
+    coeff = dct2_blocks_band(block_view(y), 1, 4)
+    if coeff.size == 0:
         return 0.0
 
+    # 先逐块求均值（float32，同逐块版本），再对所有块取 float64 均值
+    scores = (coeff * pattern).reshape(-1, 9).mean(axis=1).astype(np.float64)
     return float(np.mean(scores))
 
 
 def score_pattern(image_path, transaction_id):
     img = load_image(image_path)
-    return score_pattern_image(img, transaction_id)
\ No newline at end of file
+    return score_pattern_image(img, transaction_id)
+
+
+# 打分只看每个 block 的 [1:4, 1:4] 这 9 个系数
+_BAND = (1, 4)
+
+
+def pattern_band_coefficients(img):
+    """
+    影像只解码、转换、做一次 DCT：回传每个 block 的 [1:4, 1:4] 系数，形状 (block 数, 9)。
+    之后对任意多个 transaction_id 打分都复用这份结果（见 score_patterns_from_coefficients）。
+    """
+    if img is None:
+        raise ValueError("img is None")
+
+    ycrcb = cv2.cvtColor(img, cv2.COLOR_BGR2YCrCb)
+    y = ycrcb[:, :, 0].astype(np.float32)
+    coeff = dct2_blocks_band(block_view(y), *_BAND)
+    return coeff.reshape(-1, 9)
+
+
+def generate_band_patterns(transaction_ids):
+    """每个 transaction_id 的 [1:4, 1:4] pattern，形状 (候选数, 9)。"""
+    lo, hi = _BAND
+    if not transaction_ids:
+        return np.zeros((0, 9), dtype=np.float32)
+    return np.stack([generate_pattern(tid)[lo:hi, lo:hi].reshape(9) for tid in transaction_ids])
+
+
+def score_patterns_from_coefficients(coeffs, transaction_ids):
+    """
+    score_pattern_image 的批量版：一次矩阵乘法给所有候选打分，回传 float64 (候选数,)。
+    分数 = 所有 block 上 mean(coeff * pattern) 的平均；打分是线性的，
+    先对 block 取平均再乘 pattern，与逐块计算只差浮点舍入。
+    """
+    patterns = generate_band_patterns(transaction_ids)
+    if coeffs.size == 0 or patterns.size == 0:
+        return np.zeros(len(patterns), dtype=np.float64)
+    mean_coeff = coeffs.astype(np.float64).mean(axis=0)
+    return patterns.astype(np.float64) @ mean_coeff / 9.0
+
+
+def score_patterns_image(img, transaction_ids):
+    return score_patterns_from_coefficients(pattern_band_coefficients(img), transaction_ids)
@@ -1,29 +1,25 @@
 import os
+import asyncio
 import cv2
 import numpy as np
-from scipy.fftpack import dct, idct
 from imwatermark import WatermarkEncoder, WatermarkDecoder
 
 from watermark.watermark_utils import (
     encode_transaction_id_to_short_key,
     decode_short_key_to_suffix,
 )
-from watermark.pattern_watermark import embed_pattern_image
-from lz_mysql import MySQLPool
+from watermark.pattern_watermark import (
+    embed_pattern_image,
+    pattern_band_coefficients,
+    score_patterns_from_coefficients,
+)
+from watermark.block_dct import block_view, dct2_blocks, idct2_blocks, gather_blocks
 
 
 BASE62_CHARS = set("0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz")
 BASE62_ALPHABET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
 
 
-def _dct2(block: np.ndarray) -> np.ndarray:
-    return dct(dct(block.T, norm="ortho").T, norm="ortho")
-
-
-def _idct2(block: np.ndarray) -> np.ndarray:
-    return idct(idct(block.T, norm="ortho").T, norm="ortho")
-
-
 class TransactionWatermarkService:
 
     @staticmethod
@@ -88,6 +84,35 @@ class TransactionWatermarkService:
 
         return "".join(BASE62_ALPHABET[v] for v in vals[:3])
 
+    @staticmethod
+    def _occurrence_rank(indices: np.ndarray) -> np.ndarray:
+        """每个位置是该 block 序号的第几次出现（0 起算）。"""
+        order = np.argsort(indices, kind="stable")
+        sorted_idx = indices[order]
+        starts = np.r_[0, np.flatnonzero(np.diff(sorted_idx)) + 1]
+        group_start = np.repeat(starts, np.diff(np.r_[starts, len(sorted_idx)]))
+        rank = np.empty(len(indices), dtype=np.int64)
+        rank[order] = np.arange(len(indices)) - group_start
+        return rank
+
+    @staticmethod
+    def _embed_pairs(view: np.ndarray, block_indices: np.ndarray, half: np.ndarray) -> None:
+        """对互不重复的 block 批量改两组中频系数对，结果写回 view。"""
+        blocks, by, bx = gather_blocks(view, block_indices)
+        coeff = dct2_blocks(blocks)
+
+        # Pair A (mid-frequency)
+        amid = (coeff[:, 3, 4].astype(np.float64) + coeff[:, 4, 3].astype(np.float64)) / 2.0
+        coeff[:, 3, 4] = amid + half
+        coeff[:, 4, 3] = amid - half
+
+        # Pair B (nearby mid-frequency) as redundancy.
+        bmid = (coeff[:, 2, 3].astype(np.float64) + coeff[:, 3, 2].astype(np.float64)) / 2.0
+        coeff[:, 2, 3] = bmid + half
+        coeff[:, 3, 2] = bmid - half
+
+        view[by, bx] = idct2_blocks(coeff)
+
     @staticmethod
     def _embed_short_key_dct_image(img: np.ndarray, short_key: str, delta: float = 26.0, max_repeats: int = 40) -> np.ndarray:
         bits = TransactionWatermarkService._short_key_to_bits(short_key)
@@ -109,33 +134,17 @@ class TransactionWatermarkService:
             fixed_top_rows=24,
         )
 
-        for k, flat_idx in enumerate(block_indices):
-            bit = bits[k % bit_count]
-
-            by = int(flat_idx) // bx_count
-            bx = int(flat_idx) % bx_count
-            y0, x0 = by * 8, bx * 8
-
-            block = y[y0:y0 + 8, x0:x0 + 8]
-            coeff = _dct2(block)
-
-            target_diff = delta if bit == 1 else -delta
-
-            # Pair A (mid-frequency)
-            a1 = float(coeff[3, 4])
-            a2 = float(coeff[4, 3])
-            amid = (a1 + a2) / 2.0
-            coeff[3, 4] = amid + target_diff / 2.0
-            coeff[4, 3] = amid - target_diff / 2.0
+        bit_arr = np.asarray(bits, dtype=np.int64)[np.arange(len(block_indices)) % bit_count]
+        half = np.where(bit_arr == 1, delta, -delta).astype(np.float64) / 2.0
 
-            # Pair B (nearby mid-frequency) as redundancy.
-            b1 = float(coeff[2, 3])
-            b2 = float(coeff[3, 2])
-            bmid = (b1 + b2) / 2.0
-            coeff[2, 3] = bmid + target_diff / 2.0
-            coeff[3, 2] = bmid - target_diff / 2.0
-
-            y[y0:y0 + 8, x0:x0 + 8] = _idct2(coeff)
+        # 选中的 block 一次取出、一次 DCT、改系数后一次写回。
+        # 小图时 linspace 会给出重复的 block：同一 block 的多次修改必须依序叠加，
+        # 所以按「第几次出现」分轮，每轮内 block 不重复，轮与轮之间保持原顺序
+        view = block_view(y)
+        occurrence = TransactionWatermarkService._occurrence_rank(block_indices)
+        for rnd in range(int(occurrence.max()) + 1):
+            sel = np.flatnonzero(occurrence == rnd)
+            TransactionWatermarkService._embed_pairs(view, block_indices[sel], half[sel])
 
         ycrcb[:, :, 0] = np.clip(y, 0, 255)
         return cv2.cvtColor(ycrcb.astype(np.uint8), cv2.COLOR_YCrCb2BGR)
@@ -163,22 +172,14 @@ class TransactionWatermarkService:
             fixed_top_rows=fixed_top_rows,
         )
 
-        votes = [[] for _ in range(bit_count)]
-        for k, flat_idx in enumerate(block_indices):
-            bit_idx = k % bit_count
-
-            by = int(flat_idx) // bx_count
-            bx = int(flat_idx) % bx_count
-            y0, x0 = by * 8, bx * 8
+        blocks, _, _ = gather_blocks(block_view(y), block_indices)
+        coeff = dct2_blocks(blocks)
+        diff_a = (coeff[:, 3, 4] - coeff[:, 4, 3]).astype(np.float64)
+        diff_b = (coeff[:, 2, 3] - coeff[:, 3, 2]).astype(np.float64)
+        diffs = diff_a + diff_b
 
-            block = y[y0:y0 + 8, x0:x0 + 8]
-            coeff = _dct2(block)
-            diff_a = float(coeff[3, 4] - coeff[4, 3])
-            diff_b = float(coeff[2, 3] - coeff[3, 2])
-            diff = diff_a + diff_b
-            votes[bit_idx].append(diff)
-
-        bits = [1 if float(np.mean(v)) >= 0.0 else 0 for v in votes]
+        # 第 k 个 block 投给 bit k % bit_count
+        bits = [1 if float(np.mean(diffs[i::bit_count])) >= 0.0 else 0 for i in range(bit_count)]
         return TransactionWatermarkService._bits_to_short_key(bits)
 
     @staticmethod
@@ -302,33 +303,57 @@ class TransactionWatermarkService:
             "output": output_path
         }
 
+    @staticmethod
+    def rank_candidates(img: np.ndarray, transaction_ids: list[int], top_n: int = 5) -> list[dict]:
+        """
+        一次 DCT、一次矩阵乘法给所有候选打分，按分数降序回传前 top_n 笔：
+        margin = 与下一名的分差；z = 相对全部候选分数的标准分（候选 >= 3 时才有）。
+        """
+        if not transaction_ids:
+            return []
+
+        coeffs = pattern_band_coefficients(img)
+        scores = score_patterns_from_coefficients(coeffs, transaction_ids)
+
+        order = np.argsort(-scores, kind="stable")
+        std = float(scores.std()) if len(scores) >= 3 else 0.0
+        mean = float(scores.mean())
+
+        ranked = []
+        for pos, i in enumerate(order[:top_n]):
+            score = float(scores[i])
+            nxt = float(scores[order[pos + 1]]) if pos + 1 < len(order) else None
+            ranked.append({
+                "transaction_id": transaction_ids[i],
+                "score": score,
+                "margin": (score - nxt) if nxt is not None else None,
+                "z": ((score - mean) / std) if std > 0 else None,
+            })
+        return ranked
+
     @classmethod
     async def investigate(cls, image_path):
+        from lz_mysql import MySQLPool  # 延迟引入：worker 进程渲染水印时不需要数据库
+
         print(f"Investigating image: {image_path}", flush=True)
-        short_key = cls.decode_short_key(image_path)
+        # 影像只读一次：解码短码与候选打分共用
+        img = cv2.imread(image_path)
+        if img is None:
+            raise FileNotFoundError(image_path)
+
+        short_key = await asyncio.to_thread(cls.decode_short_key_image, img)
         print(f"Decoded short key: {short_key}", flush=True)
         suffix = decode_short_key_to_suffix(short_key)
         print(f"Derived suffix from short key: {suffix}", flush=True)
 
         candidates = await MySQLPool.list_transactions_by_suffix(suffix)
+        tids = [row["transaction_id"] for row in candidates]
 
-        result = []
-
-        from watermark.pattern_watermark import score_pattern
-
-        for row in candidates:
-            tid = row["transaction_id"]
-            score = score_pattern(image_path, tid)
-
-            result.append({
-                "transaction_id": tid,
-                "score": score
-            })
-
-        result.sort(key=lambda x: x["score"], reverse=True)
+        top = await asyncio.to_thread(cls.rank_candidates, img, tids, 5)
 
         return {
             "short_key": short_key,
             "suffix": suffix,
-            "top": result[:5]
-        }
\ No newline at end of file
+            "candidates": len(tids),
+            "top": top
+        }
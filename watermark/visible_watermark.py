@@ -1,11 +1,24 @@
 import math
 import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
 
 import cv2
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 
 
+# 满屏水印旋转图层的 LRU 上限（MB）；每个渲染进程各自一份
+WATERMARK_LAYER_CACHE_MB = int(os.getenv("WATERMARK_LAYER_CACHE_MB", "256"))
+# 画布边长按此粒度向上取整：尺寸相近的图共用同一张图层
+_LAYER_BUCKET = 256
+
+_layer_cache: "OrderedDict[tuple, Image.Image]" = OrderedDict()
+_layer_cache_bytes = 0
+_layer_lock = threading.Lock()
+
+
 def _resolve_font_path(font_path: str | None) -> str:
     candidates = []
 
@@ -29,7 +42,18 @@ def _resolve_font_path(font_path: str | None) -> str:
 
 
 def _load_font(font_path: str | None, font_size: int) -> ImageFont.FreeTypeFont:
-    return ImageFont.truetype(_resolve_font_path(font_path), font_size)
+    return _load_font_cached(_resolve_font_path(font_path), font_size)
+
+
+@lru_cache(maxsize=32)
+def _load_font_cached(path: str, font_size: int) -> ImageFont.FreeTypeFont:
+    return ImageFont.truetype(path, font_size)
+
+
+@lru_cache(maxsize=256)
+def _text_size(path: str, font_size: int, text: str) -> tuple[int, int]:
+    probe = ImageDraw.Draw(Image.new("RGBA", (1, 1), (0, 0, 0, 0)))
+    return _measure_text(probe, text, _load_font_cached(path, font_size))
 
 
 def _measure_text(draw: ImageDraw.ImageDraw, text: str, font: ImageFont.FreeTypeFont) -> tuple[int, int]:
@@ -118,25 +142,75 @@ def draw_fullscreen_watermark_image(
     base = Image.fromarray(cv2.cvtColor(img, cv2.COLOR_BGR2RGB)).convert("RGBA")
     w, h = base.size
     font_size = max(12, int(round(font_scale * 48)))
-    font = _load_font(font_path, font_size)
-
-    probe = Image.new("RGBA", (1, 1), (0, 0, 0, 0))
-    probe_draw = ImageDraw.Draw(probe)
-    tw, th = _measure_text(probe_draw, text, font)
+    path = _resolve_font_path(font_path)
+    tw, th = _text_size(path, font_size, text)
     x_gap, y_gap = _resolve_fullscreen_spacing(tw, th, font_size, x_gap, y_gap)
 
-    canvas_w = int(math.sqrt(w * w + h * h)) + max(x_gap, y_gap) * 2
-    canvas_h = canvas_w
-    canvas = Image.new("RGBA", (canvas_w, canvas_h), (0, 0, 0, 0))
+    need = int(math.sqrt(w * w + h * h)) + max(x_gap, y_gap) * 2
+    canvas_w = -(-need // _LAYER_BUCKET) * _LAYER_BUCKET
+    alpha = _opacity_to_alpha(opacity)
+    rotated = _fullscreen_layer(path, font_size, text, angle, x_gap, y_gap, alpha, canvas_w)
+
+    x0 = (canvas_w - w) // 2
+    y0 = (canvas_w - h) // 2
+    overlay = rotated.crop((x0, y0, x0 + w, y0 + h))
+
+    result = Image.alpha_composite(base, overlay).convert("RGB")
+    return cv2.cvtColor(np.array(result), cv2.COLOR_RGB2BGR)
+
+
+def _fullscreen_layer(
+    path: str,
+    font_size: int,
+    text: str,
+    angle: float,
+    x_gap: int,
+    y_gap: int,
+    alpha: int,
+    canvas_w: int,
+) -> Image.Image:
+    """取（或栅格化并缓存）旋转后的满屏图层；调用方只读，裁切后再合成。"""
+    global _layer_cache_bytes
+
+    key = (path, font_size, text, float(angle), x_gap, y_gap, alpha, canvas_w)
+    with _layer_lock:
+        layer = _layer_cache.get(key)
+        if layer is not None:
+            _layer_cache.move_to_end(key)
+            return layer
+
+        layer = _render_fullscreen_layer(path, font_size, text, angle, x_gap, y_gap, alpha, canvas_w)
+        size = canvas_w * canvas_w * 4
+        _layer_cache[key] = layer
+        _layer_cache_bytes += size
+        while len(_layer_cache) > 1 and _layer_cache_bytes > WATERMARK_LAYER_CACHE_MB * 1024 * 1024:
+            _, old = _layer_cache.popitem(last=False)
+            _layer_cache_bytes -= old.width * old.height * 4
+        return layer
+
+
+def _render_fullscreen_layer(
+    path: str,
+    font_size: int,
+    text: str,
+    angle: float,
+    x_gap: int,
+    y_gap: int,
+    alpha: int,
+    canvas_w: int,
+) -> Image.Image:
+    canvas = Image.new("RGBA", (canvas_w, canvas_w), (0, 0, 0, 0))
     draw = ImageDraw.Draw(canvas)
+    font = _load_font_cached(path, font_size)
 
-    start_x = 50
-    start_y = 80
-    alpha = _opacity_to_alpha(opacity)
+    # 网格以画布中心为原点（相对中心偏移 (50, 80)），不同大小的画布裁出来的图案一致
+    center = canvas_w // 2
+    start_x = center - (center // x_gap + 2) * x_gap + 50
+    start_y = center - (center // (2 * y_gap) + 1) * 2 * y_gap + 80
 
     y = start_y
     row_idx = 0
-    while y < canvas_h:
+    while y < canvas_w:
         x_offset = 0 if row_idx % 2 == 0 else x_gap // 2
         x = start_x + x_offset
         while x < canvas_w:
@@ -145,14 +219,17 @@ def draw_fullscreen_watermark_image(
         y += y_gap
         row_idx += 1
 
-    rotated = canvas.rotate(angle, resample=Image.BICUBIC, center=(canvas_w // 2, canvas_h // 2))
+    return canvas.rotate(angle, resample=Image.BICUBIC, center=(center, center))
 
-    x0 = (canvas_w - w) // 2
-    y0 = (canvas_h - h) // 2
-    overlay = rotated.crop((x0, y0, x0 + w, y0 + h))
 
-    result = Image.alpha_composite(base, overlay).convert("RGB")
-    return cv2.cvtColor(np.array(result), cv2.COLOR_RGB2BGR)
+def layer_cache_stats() -> dict:
+    with _layer_lock:
+        return {
+            "layers": len(_layer_cache),
+            "bytes": _layer_cache_bytes,
+            "limit_mb": WATERMARK_LAYER_CACHE_MB,
+            "fonts": _load_font_cached.cache_info()._asdict(),
+        }
 
 
 def draw_visible_watermark(
@@ -0,0 +1,241 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import replace
+from multiprocessing.shared_memory import SharedMemory
+from typing import Optional
+
+import numpy as np
+
+
+# 渲染进程数；0 = 不开进程，改在线程里跑（cv2 / numpy / scipy 大多会释放 GIL）
+WATERMARK_WORKERS = int(os.getenv("WATERMARK_WORKERS", "2"))
+# 等待渲染槽位的任务上限，超过直接拒绝（避免兑换高峰把内存堆爆）
+WATERMARK_QUEUE_MAX = int(os.getenv("WATERMARK_QUEUE_MAX", "16"))
+# 单个任务（不含排队）的超时秒数；超时会重建进程池，卡住的 worker 一并结束
+WATERMARK_JOB_TIMEOUT = float(os.getenv("WATERMARK_JOB_TIMEOUT", "60"))
+
+
+class WatermarkQueueFullError(RuntimeError):
+    pass
+
+
+# ========= 共享内存：大块图片不经 pickle 传递 =========
+# spawn 出来的 worker 与父进程共用同一个 resource_tracker，挂载 / 建立都只登记一次，
+# 最终由父进程 unlink（同时注销），不需要手动 unregister。
+def _share(buf) -> tuple[SharedMemory, int]:
+    view = memoryview(buf).cast("B")
+    shm = SharedMemory(create=True, size=max(1, view.nbytes))
+    shm.buf[:view.nbytes] = view
+    return shm, view.nbytes
+
+
+def _share_from_child(buf) -> tuple[str, int]:
+    """worker 建好后把所有权交给父进程（父进程读完负责 unlink）。"""
+    shm, size = _share(buf)
+    name = shm.name
+    shm.close()
+    return name, size
+
+
+def _run_job(params, shm_in: dict) -> tuple[dict, dict]:
+    """在 worker 进程里执行：从共享内存还原输入，渲染，输出再放回共享内存。"""
+    from watermark.watermark_workflow import WatermarkWorkflow
+
+    attached = []
+    try:
+        if "bytes" in shm_in:
+            name, size = shm_in["bytes"]
+            shm = SharedMemory(name=name)
+            attached.append(shm)
+            params = replace(params, input_bytes=shm.buf[:size])
+        if "ndarray" in shm_in:
+            name, shape, dtype = shm_in["ndarray"]
+            shm = SharedMemory(name=name)
+            attached.append(shm)
+            params = replace(params, input_ndarray=np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+        result = WatermarkWorkflow.render(params)
+        params = None  # 释放对共享内存的引用，才能 close
+    finally:
+        for shm in attached:
+            try:
+                shm.close()
+            except BufferError:
+                pass  # 渲染抛错时 traceback 还引用着 buffer；进程内下次 GC 再释放
+
+    shm_out = {}
+    if result.get("output_bytes") is not None:
+        shm_out["output_bytes"] = _share_from_child(result.pop("output_bytes"))
+    if result.get("output_ndarray") is not None:
+        arr = np.ascontiguousarray(result.pop("output_ndarray"))
+        name, _ = _share_from_child(arr)
+        shm_out["output_ndarray"] = (name, arr.shape, arr.dtype.str)
+    return result, shm_out
+
+
+def _collect(shm_out: dict, result: dict) -> dict:
+    """父进程：把 worker 放在共享内存里的输出读回来并 unlink。"""
+    if "output_bytes" in shm_out:
+        name, size = shm_out["output_bytes"]
+        shm = SharedMemory(name=name)
+        try:
+            result["output_bytes"] = bytes(shm.buf[:size])
+        finally:
+            shm.close()
+            shm.unlink()
+    if "output_ndarray" in shm_out:
+        name, shape, dtype = shm_out["output_ndarray"]
+        shm = SharedMemory(name=name)
+        try:
+            result["output_ndarray"] = np.ndarray(shape, dtype=dtype, buffer=shm.buf).copy()
+        finally:
+            shm.close()
+            shm.unlink()
+    result.setdefault("output_bytes", None)
+    result.setdefault("output_ndarray", None)
+    return result
+
+
+class WatermarkPool:
+    """
+    WatermarkWorkflow 的离开事件循环执行器（@classmethod 单例）：
+    - WATERMARK_WORKERS 个 spawn 进程渲染；输入 / 输出的图片走共享内存，不经 pickle
+    - 同时最多 WATERMARK_WORKERS 个在跑，排队超过 WATERMARK_QUEUE_MAX 直接拒绝
+    - 单任务超时 WATERMARK_JOB_TIMEOUT 秒；超时后重建进程池
+    - stats() 提供排队深度、执行中数量与排队 / 执行耗时
+    """
+
+    _executor: Optional[ProcessPoolExecutor] = None
+    _slots: Optional[asyncio.Semaphore] = None
+    _waiting = 0
+    _running = 0
+    # submitted, completed, failed, timeouts, rejected, total_wait_sec, total_run_sec, max_run_sec, last_run_sec
+    _stats = [0, 0, 0, 0, 0, 0.0, 0.0, 0.0, 0.0]
+
+    @classmethod
+    def _get_executor(cls) -> ProcessPoolExecutor:
+        if cls._executor is None:
+            cls._executor = ProcessPoolExecutor(
+                max_workers=WATERMARK_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return cls._executor
+
+    @classmethod
+    def _reset_executor(cls):
+        executor, cls._executor = cls._executor, None
+        if executor is None:
+            return
+        # 卡住的 worker 不会自己结束，直接终止（同一池里其他在跑的任务会收到 BrokenProcessPool）
+        for proc in list(getattr(executor, "_processes", {}).values()):
+            try:
+                proc.terminate()
+            except Exception:
+                pass
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    @classmethod
+    async def submit(cls, params, timeout: Optional[float] = None) -> dict:
+        if cls._slots is None:
+            cls._slots = asyncio.Semaphore(max(1, WATERMARK_WORKERS))
+        if cls._slots.locked() and cls._waiting >= WATERMARK_QUEUE_MAX:
+            cls._stats[4] += 1
+            raise WatermarkQueueFullError(f"水印队列已满（排队 {cls._waiting}）")
+
+        cls._stats[0] += 1
+        timeout = WATERMARK_JOB_TIMEOUT if timeout is None else timeout
+        t_enq = time.perf_counter()
+        cls._waiting += 1
+        try:
+            await cls._slots.acquire()
+        finally:
+            cls._waiting -= 1
+
+        t_start = time.perf_counter()
+        cls._stats[5] += t_start - t_enq
+        cls._running += 1
+        try:
+            if WATERMARK_WORKERS <= 0:
+                result = await asyncio.wait_for(
+                    asyncio.to_thread(cls._render_inline, params), timeout=timeout
+                )
+            else:
+                result = await cls._submit_process(params, timeout)
+            cls._stats[1] += 1
+            return result
+        except asyncio.TimeoutError:
+            cls._stats[3] += 1
+            if WATERMARK_WORKERS > 0:
+                cls._reset_executor()
+            raise TimeoutError(f"水印渲染超时（>{timeout:.0f}s）")
+        except Exception:
+            cls._stats[2] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - t_start
+            cls._stats[6] += elapsed
+            cls._stats[7] = max(cls._stats[7], elapsed)
+            cls._stats[8] = elapsed
+            cls._running -= 1
+            cls._slots.release()
+
+    @staticmethod
+    def _render_inline(params) -> dict:
+        from watermark.watermark_workflow import WatermarkWorkflow
+
+        return WatermarkWorkflow.render(params)
+
+    @classmethod
+    async def _submit_process(cls, params, timeout: float) -> dict:
+        owned = []
+        shm_in = {}
+        try:
+            if params.input_bytes is not None:
+                shm, size = _share(params.input_bytes)
+                owned.append(shm)
+                shm_in["bytes"] = (shm.name, size)
+                params = replace(params, input_bytes=None)
+            if params.input_ndarray is not None:
+                arr = np.ascontiguousarray(params.input_ndarray)
+                shm, _ = _share(arr)
+                owned.append(shm)
+                shm_in["ndarray"] = (shm.name, arr.shape, arr.dtype.str)
+                params = replace(params, input_ndarray=None)
+
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(cls._get_executor(), _run_job, params, shm_in)
+            result, shm_out = await asyncio.wait_for(future, timeout=timeout)
+            return _collect(shm_out, result)
+        finally:
+            for shm in owned:
+                shm.close()
+                shm.unlink()
+
+    @classmethod
+    def shutdown(cls):
+        executor, cls._executor = cls._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    @classmethod
+    def stats(cls) -> dict:
+        submitted, completed, failed, timeouts, rejected, wait_sec, run_sec, max_run, last_run = cls._stats
+        started = completed + failed + timeouts
+        return {
+            "workers": WATERMARK_WORKERS,
+            "queue_depth": cls._waiting,
+            "queue_max": WATERMARK_QUEUE_MAX,
+            "running": cls._running,
+            "submitted": submitted,
+            "completed": completed,
+            "failed": failed,
+            "timeouts": timeouts,
+            "rejected": rejected,
+            "avg_wait_ms": round(wait_sec / started * 1000, 1) if started else 0.0,
+            "avg_run_ms": round(run_sec / started * 1000, 1) if started else 0.0,
+            "max_run_ms": round(max_run * 1000, 1),
+            "last_run_ms": round(last_run * 1000, 1),
+        }
@@ -92,6 +92,17 @@ class WatermarkWorkflow:
 
     @classmethod
     async def run(cls, params: WatermarkWorkflowParams) -> dict:
+        """
+        渲染交给 WatermarkPool（worker 进程 / 线程），不占用事件循环。
+        队列满时抛 WatermarkQueueFullError，超时抛 TimeoutError。
+        """
+        from watermark.watermark_pool import WatermarkPool
+
+        return await WatermarkPool.submit(params)
+
+    @classmethod
+    def render(cls, params: WatermarkWorkflowParams) -> dict:
+        """同步渲染（CPU 密集）；在 worker 里执行，也可在脚本中直接调用。"""
         current_img, input_source = cls._load_input_image(params)
 
         short_key = encode_transaction_id_to_short_key(params.transaction_id)
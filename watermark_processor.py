@@ -5,15 +5,20 @@ watermark_processor.py (classmethod style)
 - 全图平铺水印
 - 单独水印
 - rembg 抠图排除主体水印
-- 全局缓存 font / rembg session
+- 全局缓存 font / rembg session / 旋转后的平铺图层（LRU）
+- rembg 推理服务：启动时预热 session，并发请求合并到同一推理线程，主体 mask 按图片哈希缓存
 """
 
 import os
 import shutil
 import tempfile
 import hashlib
+import threading
+import time
 import urllib.request
-from typing import Tuple, Optional, Dict
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Tuple, Optional, Dict, List
 from dataclasses import dataclass
 
 from PIL import Image, ImageDraw, ImageFont, ImageChops
@@ -22,6 +27,14 @@ from rembg import remove, new_session
 
 RGB = Tuple[int, int, int]
 
+# 平铺图层 LRU 上限（MB）；画布边长按 LAYER_BUCKET 向上取整，尺寸相近的图共用一张
+LAYER_CACHE_MB = int(os.getenv("WATERMARK_LAYER_CACHE_MB", "256"))
+LAYER_BUCKET = 256
+# 主体 mask 缓存条数（同一封面重复处理不再跑模型）
+MASK_CACHE_SIZE = int(os.getenv("REMBG_MASK_CACHE_SIZE", "64"))
+# 推理线程数：onnxruntime 自己会用满多核，默认 1 个线程串行跑，避免多个 run 互相抢核
+REMBG_WORKERS = int(os.getenv("REMBG_WORKERS", "1"))
+
 
 # =========================
 # 配置对象
@@ -73,6 +86,16 @@ class RembgConfig:
 class WatermarkProcessor:
     _FONT_CACHE: Dict[Tuple[str, int], ImageFont.FreeTypeFont] = {}
     _REMBG_SESSION_CACHE: Dict[Tuple[str, str], object] = {}
+    _LAYER_CACHE: "OrderedDict[Tuple[TiledWatermarkConfig, int], Image.Image]" = OrderedDict()
+    _LAYER_CACHE_BYTES = 0
+    _LAYER_LOCK = threading.Lock()
+    _MASK_CACHE: "OrderedDict[Tuple[str, str], Image.Image]" = OrderedDict()
+    _MASK_INFLIGHT: Dict[Tuple[str, str], Future] = {}
+    _MASK_LOCK = threading.Lock()
+    _SESSION_LOCK = threading.Lock()
+    _REMBG_EXECUTOR: Optional[ThreadPoolExecutor] = None
+    # hits, misses, coalesced, inferences, total_infer_sec
+    _MASK_STATS = [0, 0, 0, 0, 0.0]
 
     # ---------- public API ----------
 
@@ -119,13 +142,17 @@ class WatermarkProcessor:
 
         # 平铺水印
         if tiled_cfg:
-            tiled_layer = cls._build_tiled_layer(base.size, tiled_cfg)
-
+            mask_future = None
             if exclude_subject:
                 if not rembg_cfg:
                     raise ValueError("exclude_subject=True 时必须提供 rembg_cfg")
-                subject_alpha = cls._extract_subject_alpha(base, rembg_cfg)
-                tiled_layer = cls._exclude_subject_area(tiled_layer, subject_alpha)
+                # 抠图在推理线程里跑，这边同时准备平铺图层
+                mask_future = cls._submit_mask(base, rembg_cfg)
+
+            tiled_layer = cls._build_tiled_layer(base.size, tiled_cfg)
+
+            if mask_future is not None:
+                tiled_layer = cls._exclude_subject_area(tiled_layer, mask_future.result())
 
             base = Image.alpha_composite(base, tiled_layer)
 
@@ -140,11 +167,38 @@ class WatermarkProcessor:
     @classmethod
     def _build_tiled_layer(cls, size: Tuple[int, int], cfg: TiledWatermarkConfig) -> Image.Image:
         width, height = size
-        layer = Image.new("RGBA", size, (0, 0, 0, 0))
-        font = cls._get_font(cfg.font_path, cfg.font_size)
+        diag = int((width ** 2 + height ** 2) ** 0.5)
+        bucket = -(-diag // LAYER_BUCKET) * LAYER_BUCKET
+        stamp = cls._get_tiled_stamp(cfg, bucket)
+
+        # 图层以中心对齐，裁出与图片等大的部分（crop 返回副本，可放心修改）
+        x0 = -((width - stamp.width) // 2)
+        y0 = -((height - stamp.height) // 2)
+        return stamp.crop((x0, y0, x0 + width, y0 + height))
 
-        dummy_draw = ImageDraw.Draw(layer)
-        text_w, text_h = cls._measure_text(dummy_draw, cfg.text, font)
+    @classmethod
+    def _get_tiled_stamp(cls, cfg: TiledWatermarkConfig, diag: int) -> Image.Image:
+        key = (cfg, diag)
+        with cls._LAYER_LOCK:
+            stamp = cls._LAYER_CACHE.get(key)
+            if stamp is not None:
+                cls._LAYER_CACHE.move_to_end(key)
+                return stamp
+
+            stamp = cls._render_tiled_stamp(cfg, diag)
+            cls._LAYER_CACHE[key] = stamp
+            cls._LAYER_CACHE_BYTES += stamp.width * stamp.height * 4
+            while len(cls._LAYER_CACHE) > 1 and cls._LAYER_CACHE_BYTES > LAYER_CACHE_MB * 1024 * 1024:
+                _, old = cls._LAYER_CACHE.popitem(last=False)
+                cls._LAYER_CACHE_BYTES -= old.width * old.height * 4
+            return stamp
+
+    @classmethod
+    def _render_tiled_stamp(cls, cfg: TiledWatermarkConfig, diag: int) -> Image.Image:
+        font = cls._get_font(cfg.font_path, cfg.font_size)
+        tmp = Image.new("RGBA", (diag, diag), (0, 0, 0, 0))
+        draw = ImageDraw.Draw(tmp)
+        text_w, text_h = cls._measure_text(draw, cfg.text, font)
 
         density_map = {"dense": 1.2, "normal": 1.7, "sparse": 2.2}
         factor = density_map.get(cfg.density, 1.7)
@@ -153,23 +207,26 @@ class WatermarkProcessor:
         y_gap = cfg.y_gap or int(text_h * factor)
         offset = cfg.offset or (x_gap // 2)
 
-        diag = int((width ** 2 + height ** 2) ** 0.5)
-        tmp = Image.new("RGBA", (diag, diag), (0, 0, 0, 0))
-        draw = ImageDraw.Draw(tmp)
+        # 网格以画布中心为原点：不同 diag 的画布，中心裁出的图案一致
+        center = diag // 2
+        start_x = center - (center // x_gap + 2) * x_gap
+        start_y = center - (center // (2 * y_gap) + 1) * 2 * y_gap
+        fill = cfg.color + (cls._clamp(cfg.opacity),)
 
-        for y in range(0, diag, y_gap):
-            xo = offset if (y // y_gap) % 2 else 0
-            for x in range(-diag, diag, x_gap):
-                draw.text(
-                    (x + xo, y),
-                    cfg.text,
-                    font=font,
-                    fill=cfg.color + (cls._clamp(cfg.opacity),),
-                )
+        for row, y in enumerate(range(start_y, diag, y_gap)):
+            xo = offset if row % 2 else 0
+            for x in range(start_x, diag, x_gap):
+                draw.text((x + xo, y), cfg.text, font=font, fill=fill)
 
         tmp = tmp.rotate(cfg.angle, expand=True, resample=Image.BICUBIC)
-        layer.paste(tmp, ((width - tmp.width) // 2, (height - tmp.height) // 2), tmp)
-        return layer
+        # expand 多出来的四角任何图都用不到（宽高都不超过 diag），只留中心 diag x diag
+        x0 = (tmp.width - diag) // 2
+        y0 = (tmp.height - diag) // 2
+        tmp = tmp.crop((x0, y0, x0 + diag, y0 + diag))
+        # 与原先 layer.paste(tmp, box, tmp) 相同的混合结果，只做一次
+        stamp = Image.new("RGBA", tmp.size, (0, 0, 0, 0))
+        stamp.paste(tmp, (0, 0), tmp)
+        return stamp
 
     # ---------- single watermark ----------
 
@@ -257,30 +314,133 @@ class WatermarkProcessor:
     # ---------- rembg ----------
 
     @classmethod
-    def _extract_subject_alpha(cls, img: Image.Image, cfg: RembgConfig) -> Image.Image:
+    def warmup(cls, cfg: RembgConfig, background: bool = False):
+        """
+        预热推理服务：下载 / 校验模型、建 session，并用一张小图跑一次推理
+        （onnxruntime 首次 run 要做图优化，放在启动时而不是第一个请求上）。
+        background=True 时丢到推理线程里做，立即返回 Future。
+        """
+        if background:
+            return cls._get_rembg_executor().submit(cls.warmup, cfg)
         sess = cls._get_rembg_session(cfg)
-        fg = remove(img, session=sess).convert("RGBA")
-        return fg.split()[-1]
+        remove(Image.new("RGBA", (64, 64), (0, 0, 0, 255)), session=sess)
+        print(f"[Rembg] session ready: {cfg.model_name}", flush=True)
+
+    @classmethod
+    def extract_subject_alphas(cls, imgs: List[Image.Image], cfg: RembgConfig) -> List[Image.Image]:
+        """
+        批量取主体 alpha：先查 mask 缓存，同一批 / 并发中相同的图只推理一次，
+        其余全部排进推理线程，复用同一个常驻 session。
+        """
+        futures = [cls._submit_mask(img, cfg) for img in imgs]
+        return [f.result() for f in futures]
+
+    @classmethod
+    def _extract_subject_alpha(cls, img: Image.Image, cfg: RembgConfig) -> Image.Image:
+        return cls._submit_mask(img, cfg).result()
+
+    @classmethod
+    def _submit_mask(cls, img: Image.Image, cfg: RembgConfig) -> Future:
+        key = (cfg.model_name, cls._image_digest(img))
+        with cls._MASK_LOCK:
+            hit = cls._MASK_CACHE.get(key)
+            if hit is not None:
+                cls._MASK_CACHE.move_to_end(key)
+                cls._MASK_STATS[0] += 1
+                done = Future()
+                done.set_result(hit)
+                return done
+
+            pending = cls._MASK_INFLIGHT.get(key)
+            if pending is not None:
+                cls._MASK_STATS[2] += 1
+                return pending
+
+            cls._MASK_STATS[1] += 1
+            future = cls._get_rembg_executor().submit(cls._infer_mask, key, img.copy(), cfg)
+            cls._MASK_INFLIGHT[key] = future
+            return future
+
+    @classmethod
+    def _infer_mask(cls, key: Tuple[str, str], img: Image.Image, cfg: RembgConfig) -> Image.Image:
+        try:
+            t0 = time.perf_counter()
+            sess = cls._get_rembg_session(cfg)
+            alpha = remove(img, session=sess).convert("RGBA").split()[-1]
+            with cls._MASK_LOCK:
+                cls._MASK_STATS[3] += 1
+                cls._MASK_STATS[4] += time.perf_counter() - t0
+                cls._MASK_CACHE[key] = alpha
+                while len(cls._MASK_CACHE) > MASK_CACHE_SIZE:
+                    cls._MASK_CACHE.popitem(last=False)
+            return alpha
+        finally:
+            with cls._MASK_LOCK:
+                cls._MASK_INFLIGHT.pop(key, None)
+
+    @classmethod
+    def _get_rembg_executor(cls) -> ThreadPoolExecutor:
+        if cls._REMBG_EXECUTOR is None:
+            with cls._SESSION_LOCK:
+                if cls._REMBG_EXECUTOR is None:
+                    cls._REMBG_EXECUTOR = ThreadPoolExecutor(
+                        max_workers=max(1, REMBG_WORKERS), thread_name_prefix="rembg"
+                    )
+        return cls._REMBG_EXECUTOR
+
+    @staticmethod
+    def _image_digest(img: Image.Image) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{img.mode}:{img.width}x{img.height}".encode())
+        h.update(img.tobytes())
+        return h.hexdigest()
 
     @classmethod
     def _get_rembg_session(cls, cfg: RembgConfig):
         here = os.path.dirname(os.path.abspath(__file__))
         model_path = cfg.model_path if os.path.isabs(cfg.model_path) else os.path.join(here, cfg.model_path)
         model_path = os.path.abspath(model_path)
+        key = (cfg.model_name, model_path)
 
-        # 若模型不存在，尝试按配置自动下载（Render 等环境推荐）
-        if not os.path.exists(model_path):
-            model_path = cls.ensure_model(cfg)
+        sess = cls._REMBG_SESSION_CACHE.get(key)
+        if sess is not None:
+            return sess
+
+        # 下载 / 建 session 只做一次：并发的首个请求都在这里等同一个结果
+        with cls._SESSION_LOCK:
+            if key not in cls._REMBG_SESSION_CACHE:
+                # 若模型不存在，尝试按配置自动下载（Render 等环境推荐）
+                if not os.path.exists(model_path):
+                    model_path = cls.ensure_model(cfg)
+
+                os.environ["U2NET_HOME"] = cfg.u2net_home or here
+                cls._REMBG_SESSION_CACHE[key] = new_session(
+                    model_name=cfg.model_name,
+                    model_path=model_path
+                )
+            return cls._REMBG_SESSION_CACHE[key]
 
-        os.environ["U2NET_HOME"] = cfg.u2net_home or here
-        key = (cfg.model_name, model_path)
+    @classmethod
+    def rembg_stats(cls) -> dict:
+        hits, misses, coalesced, inferences, infer_sec = cls._MASK_STATS
+        with cls._MASK_LOCK:
+            return {
+                "sessions": len(cls._REMBG_SESSION_CACHE),
+                "mask_cache": len(cls._MASK_CACHE),
+                "mask_cache_max": MASK_CACHE_SIZE,
+                "inflight": len(cls._MASK_INFLIGHT),
+                "hits": hits,
+                "misses": misses,
+                "coalesced": coalesced,
+                "inferences": inferences,
+                "avg_infer_ms": round(infer_sec / inferences * 1000, 1) if inferences else 0.0,
+            }
 
-        if key not in cls._REMBG_SESSION_CACHE:
-            cls._REMBG_SESSION_CACHE[key] = new_session(
-                model_name=cfg.model_name,
-                model_path=model_path
-            )
-        return cls._REMBG_SESSION_CACHE[key]
+    @classmethod
+    def shutdown(cls):
+        executor, cls._REMBG_EXECUTOR = cls._REMBG_EXECUTOR, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
 
     # ---------- utils ----------
 
@@ -291,6 +451,16 @@ class WatermarkProcessor:
             cls._FONT_CACHE[key] = ImageFont.truetype(font_path, size)
         return cls._FONT_CACHE[key]
 
+    @classmethod
+    def layer_cache_stats(cls) -> dict:
+        with cls._LAYER_LOCK:
+            return {
+                "layers": len(cls._LAYER_CACHE),
+                "bytes": cls._LAYER_CACHE_BYTES,
+                "limit_mb": LAYER_CACHE_MB,
+                "fonts": len(cls._FONT_CACHE),
+            }
+
     @staticmethod
     def _measure_text(draw, text, font):
         try:
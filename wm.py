@@ -5,6 +5,13 @@ from watermark_processor import (
     RembgConfig,
 )
 
+rembg_cfg = RembgConfig(
+    model_path="u2net.onnx",
+)
+
+# 启动时就在推理线程里建 session / 跑一次图优化，不让第一张图付这笔开销
+WatermarkProcessor.warmup(rembg_cfg, background=True)
+
 WatermarkProcessor.process_file(
     img_path="./input/487317/01.jpg",
     output_path="./output/487317/wm_01.png",
@@ -19,7 +26,5 @@ WatermarkProcessor.process_file(
         font_path="./font/msyh.ttc",
         position="上方",
     ),
-    rembg_cfg=RembgConfig(
-        model_path="u2net.onnx",
-    ),
+    rembg_cfg=rembg_cfg,
 )